@@ -2,21 +2,31 @@
 # ==========================================================
 # BOT DAAQUI JOYAS - VERSIÓN LIMPIA Y FINAL
 # ==========================================================
-from flask import Flask, request, jsonify
-import requests
+import time
+_IMPORT_STARTED = time.perf_counter()
+from flask import Flask, request, jsonify, Response
 import logging
 from logging import getLogger
 import os
 import re
 import json
-import time
-import firebase_admin
-from firebase_admin import credentials, firestore
+import copy
+import hashlib
+import heapq
+import itertools
+import string
+import random
+import difflib
 from datetime import datetime
 import uuid
-import gspread
 import unicodedata
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+# firebase_admin, gspread y requests se importan de forma perezosa (ver get_db, get_worksheet_pedidos
+# y WhatsAppClient) para que un arranque en frío no los cargue si la petición no los necesita.
 
 # Configuración del logger
 logging.basicConfig(level=logging.INFO)
@@ -28,6 +38,7 @@ app = Flask(__name__)
 # 1. INICIALIZACIÓN DE SERVICIOS Y VARIABLES GLOBALES
 # ==========================================================
 db = None
+session_store = None
 gc = None
 worksheet_pedidos = None
 BUSINESS_RULES = {}
@@ -39,69 +50,547 @@ MENU_PRINCIPAL = {}
 CATALOGO_PRODUCTOS = {}
 MENU_FAQ = {}
 CAMPAIGNS_CONFIG = {} # <-- NUEVA VARIABLE AÑADIDA
+RUC_EMPRESA = 'RUC_NO_CONFIGURADO'
+TITULAR_YAPE = 'TITULAR_NO_CONFIGURADO'
+YAPE_NUMERO = 'YAPE_NO_CONFIGURADO'
+
+# Documentos de la colección 'configuracion' que forman la configuración del bot
+CONFIG_DOCS = ('reglas_envio', 'respuestas_faq', 'datos_negocio', 'menu_principal', 'catalogo_productos',
+               'menu_faq', 'configuracion_general', 'campañas_y_ofertas')
+# Recarga en caliente: 'poll' (revisión periódica barata), 'listener' (on_snapshot de Firestore) u 'off'
+CONFIG_RELOAD_MODE = os.environ.get('CONFIG_RELOAD_MODE', 'poll')
+CONFIG_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', '60'))
+CONFIG_VERSION = 0
+CONFIG_SNAPSHOT = {'version': 0, 'docs': {}, 'update_times': {}}
+_config_lock = threading.Lock()
+_config_last_check = time.monotonic()
+_config_check_running = False
+
+# --- REPORTE DE TIEMPOS DE ARRANQUE ---
+STARTUP_TIMINGS = {}
+
+@contextmanager
+def startup_stage(name):
+    """Mide una etapa del arranque en frío y deja el reporte en el log."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info("⏱️ Arranque: " + ", ".join(f"{k}={v}ms" for k, v in STARTUP_TIMINGS.items()))
+
+# --- ALMACENAMIENTO ---
+# Toda la persistencia pasa por un Storage: Firestore en producción, o un backend local (memoria / SQLite)
+# para pruebas de carga, perfiles y desarrollo sin un proyecto de Firebase.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firestore')  # 'firestore' | 'memory' | 'sqlite'
+SQLITE_PATH = os.environ.get('SQLITE_PATH', '/tmp/daaqui-bot.sqlite3')
+# Backend propio para las sesiones (p. ej. 'sqlite' para una ruta caliente de baja latencia); vacío = el principal
+SESSION_STORAGE_BACKEND = os.environ.get('SESSION_STORAGE_BACKEND', '')
+
+class _WriteMarker:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+# Marcadores de escritura independientes del backend (FirestoreStorage los traduce a los de Firestore)
+SERVER_TIMESTAMP = _WriteMarker('SERVER_TIMESTAMP')
+DELETE_FIELD = _WriteMarker('DELETE_FIELD')
+
+class Increment:
+    def __init__(self, amount):
+        self.amount = amount
+
+StoredDoc = namedtuple('StoredDoc', ['data', 'version'])
+
+class Storage:
+    """Operaciones de persistencia que usa el bot. `version` cambia con cada escritura del documento.
+    Las escrituras (`set`, `commit`) aceptan los marcadores SERVER_TIMESTAMP, DELETE_FIELD e Increment."""
+    def get_all(self, collection, doc_ids, fields=None):
+        """{id: StoredDoc} de los documentos que existen, en una sola lectura."""
+        raise NotImplementedError
+
+    def get(self, collection, doc_id):
+        doc = self.get_all(collection, [doc_id]).get(doc_id)
+        return doc.data if doc else None
+
+    def versions(self, collection, doc_ids):
+        return {doc_id: doc.version for doc_id, doc in self.get_all(collection, doc_ids).items()}
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.commit([('set', collection, doc_id, data, merge)])
+
+    def delete(self, collection, doc_id):
+        self.commit([('delete', collection, doc_id)])
+
+    def create(self, collection, doc_id, data):
+        """Crea el documento solo si no existe. Devuelve False si ya existía."""
+        raise NotImplementedError
+
+    def update_if_unchanged(self, collection, doc_id, version, data):
+        """Combina `data` en el documento solo si sigue en `version` (escritura condicional). False si cambió o no existe."""
+        raise NotImplementedError
+
+    def commit(self, writes):
+        """Aplica de forma atómica ('set', colección, id, datos, merge) y ('delete', colección, id)."""
+        raise NotImplementedError
+
+    def stream(self, collection):
+        """Itera (id, datos) de toda la colección."""
+        raise NotImplementedError
+
+    def list_ids(self, collection):
+        return [doc_id for doc_id, _ in self.stream(collection)]
+
+    def ids_where_less(self, collection, field, value, limit):
+        ids = []
+        for doc_id, data in self.stream(collection):
+            try:
+                if data.get(field) is not None and data[field] < value:
+                    ids.append(doc_id)
+            except TypeError:
+                continue
+            if len(ids) >= limit:
+                break
+        return ids
+
+    def ids_where_equal(self, collection, field, value, limit):
+        return [doc_id for doc_id, data in self.stream(collection) if data.get(field) == value][:limit]
+
+    def watch(self, collection, callback):
+        """Llama a callback({id: StoredDoc}) con cada cambio de la colección. False si el backend no lo soporta."""
+        return False
 
-try:
-    # --- CONEXIÓN CON FIREBASE ---
-    service_account_info_str = os.environ.get('FIREBASE_SERVICE_ACCOUNT_JSON')
-    if service_account_info_str:
-        service_account_info = json.loads(service_account_info_str)
-        cred = credentials.Certificate(service_account_info)
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(cred)
-        db = firestore.client()
-        logger.info("✅ Conexión con Firebase establecida correctamente.")
-
-        # Carga de toda la configuración desde Firestore...
-        docs_a_cargar = {
-            'reglas_envio': BUSINESS_RULES,
-            'respuestas_faq': FAQ_RESPONSES,
-            'datos_negocio': BUSINESS_DATA,
-            'menu_principal': MENU_PRINCIPAL,
-            'catalogo_productos': CATALOGO_PRODUCTOS,
-            'menu_faq': MENU_FAQ
-        }
-        for doc_id, var in docs_a_cargar.items():
-            doc = db.collection('configuracion').document(doc_id).get()
-            if doc.exists:
-                var.update(doc.to_dict())
-                logger.info(f"✅ Documento '{doc_id}' cargado.")
+class FirestoreStorage(Storage):
+    def __init__(self, client):
+        self.client = client
+
+    def _ref(self, collection, doc_id):
+        return self.client.collection(collection).document(doc_id)
+
+    @staticmethod
+    def _encode(data):
+        from firebase_admin import firestore
+        def convert(value):
+            if value is SERVER_TIMESTAMP:
+                return firestore.SERVER_TIMESTAMP
+            if value is DELETE_FIELD:
+                return firestore.DELETE_FIELD
+            if isinstance(value, Increment):
+                return firestore.Increment(value.amount)
+            return value
+        return {key: convert(value) for key, value in data.items()}
+
+    def get(self, collection, doc_id):
+        snapshot = self._ref(collection, doc_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def get_all(self, collection, doc_ids, fields=None):
+        refs = [self._ref(collection, doc_id) for doc_id in doc_ids]
+        return {snapshot.id: StoredDoc(snapshot.to_dict(), snapshot.update_time)
+                for snapshot in self.client.get_all(refs, field_paths=fields) if snapshot.exists}
+
+    def versions(self, collection, doc_ids):
+        # La máscara de campos hace que solo viajen los metadatos (update_time), no el contenido
+        return {doc_id: doc.version for doc_id, doc in self.get_all(collection, doc_ids, fields=['__version_check__']).items()}
+
+    def set(self, collection, doc_id, data, merge=False):
+        self._ref(collection, doc_id).set(self._encode(data), merge=merge)
+
+    def delete(self, collection, doc_id):
+        self._ref(collection, doc_id).delete()
+
+    def create(self, collection, doc_id, data):
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            self._ref(collection, doc_id).create(self._encode(data))
+            return True
+        except AlreadyExists:
+            return False
+
+    def update_if_unchanged(self, collection, doc_id, version, data):
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+        try:
+            # La precondición last_update_time la evalúa el servidor: de dos escritores, solo uno gana
+            self._ref(collection, doc_id).update(self._encode(data), option=self.client.write_option(last_update_time=version))
+            return True
+        except (FailedPrecondition, NotFound):
+            return False
+
+    def commit(self, writes):
+        batch = self.client.batch()
+        for write in writes:
+            if write[0] == 'delete':
+                batch.delete(self._ref(write[1], write[2]))
             else:
-                logger.warning(f"⚠️ Documento '{doc_id}' no encontrado.")
-        
-        config_doc = db.collection('configuracion').document('configuracion_general').get()
-        if config_doc.exists:
-            config_data = config_doc.to_dict()
-            PALABRAS_CANCELACION = config_data.get('palabras_cancelacion', ['cancelar'])
-            FAQ_KEYWORD_MAP = config_data.get('faq_keyword_map', {})
-            logger.info("✅ Configuración general cargada.")
-        else:
-            logger.warning("⚠️ Documento 'configuracion_general' no encontrado.")
-            
-        # --- INICIO DEL NUEVO BLOQUE ---
-        # Carga la configuración de campañas
-        campaigns_doc = db.collection('configuracion').document('campañas_y_ofertas').get()
-        if campaigns_doc.exists:
-            CAMPAIGNS_CONFIG = campaigns_doc.to_dict()
-            logger.info("✅ Configuración de campañas y ofertas cargada.")
-        else:
-            logger.warning("⚠️ Documento 'campañas_y_ofertas' no encontrado.")
-        # --- FIN DEL NUEVO BLOQUE ---
-
-        # --- CONEXIÓN CON GOOGLE SHEETS ---
-        creds_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-        sheet_name = os.environ.get('GOOGLE_SHEET_NAME')
-        if creds_json_str and sheet_name:
-            creds_dict = json.loads(creds_json_str)
-            gc = gspread.service_account_from_dict(creds_dict)
-            spreadsheet = gc.open(sheet_name)
-            worksheet_pedidos = spreadsheet.worksheet("Pedidos")
-            logger.info("✅ Conexión con Google Sheets establecida correctamente.")
+                _, collection, doc_id, data, merge = write
+                batch.set(self._ref(collection, doc_id), self._encode(data), merge=merge)
+        batch.commit()
+
+    def stream(self, collection):
+        return ((doc.id, doc.to_dict()) for doc in self.client.collection(collection).stream())
+
+    def list_ids(self, collection):
+        return [ref.id for ref in self.client.collection(collection).list_documents()]
+
+    def ids_where_less(self, collection, field, value, limit):
+        return [doc.id for doc in self.client.collection(collection).where(field, '<', value).limit(limit).stream()]
+
+    def ids_where_equal(self, collection, field, value, limit):
+        return [doc.id for doc in self.client.collection(collection).where(field, '==', value).limit(limit).stream()]
+
+    def watch(self, collection, callback):
+        def on_snapshot(col_snapshot, changes, read_time):
+            callback({doc.id: StoredDoc(doc.to_dict(), doc.update_time) for doc in col_snapshot})
+        self.client.collection(collection).on_snapshot(on_snapshot)
+        return True
+
+# Valores que no hace falta copiar al escribir en los backends locales (deepcopy de un datetime es caro)
+_IMMUTABLE_VALUES = (str, int, float, bool, type(None), datetime, bytes)
+
+def apply_write(current, data, merge, now):
+    """Resultado de escribir `data` sobre `current` con la semántica de Firestore (backends locales)."""
+    result = dict(current) if merge and current else {}
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            result.pop(key, None)
+        elif value is SERVER_TIMESTAMP:
+            result[key] = now
+        elif isinstance(value, Increment):
+            result[key] = (result.get(key) or 0) + value.amount
+        elif isinstance(value, _IMMUTABLE_VALUES):
+            result[key] = value
         else:
-            logger.warning("⚠️ Faltan variables de entorno para Google Sheets.")
-    else:
-        logger.error("❌ La variable de entorno FIREBASE_SERVICE_ACCOUNT_JSON no está configurada.")
-except Exception as e:
-    logger.error(f"❌ Error crítico durante la inicialización: {e}")
+            result[key] = copy.deepcopy(value)
+    return result
+
+class MemoryStorage(Storage):
+    """Almacenamiento en la memoria del proceso. Los datos se copian al leer y al escribir, como con un servidor."""
+    def __init__(self):
+        self._collections = {}  # colección -> {id: StoredDoc}
+        self._lock = threading.RLock()
+        self._version = 0
+
+    def get_all(self, collection, doc_ids, fields=None):
+        with self._lock:
+            docs = self._collections.get(collection, {})
+            found = {doc_id: docs[doc_id] for doc_id in doc_ids if doc_id in docs}
+        return {doc_id: StoredDoc(copy.deepcopy(doc.data), doc.version) for doc_id, doc in found.items()}
+
+    def create(self, collection, doc_id, data):
+        with self._lock:
+            if doc_id in self._collections.get(collection, {}):
+                return False
+            self.commit([('set', collection, doc_id, data, False)])
+            return True
+
+    def update_if_unchanged(self, collection, doc_id, version, data):
+        with self._lock:
+            current = self._collections.get(collection, {}).get(doc_id)
+            if current is None or current.version != version:
+                return False
+            self.commit([('set', collection, doc_id, data, True)])
+            return True
+
+    def commit(self, writes):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for write in writes:
+                docs = self._collections.setdefault(write[1], {})
+                if write[0] == 'delete':
+                    docs.pop(write[2], None)
+                    continue
+                _, _, doc_id, data, merge = write
+                current = docs.get(doc_id)
+                self._version += 1
+                docs[doc_id] = StoredDoc(apply_write(current.data if current else None, data, merge, now), self._version)
+
+    def stream(self, collection):
+        with self._lock:
+            items = list(self._collections.get(collection, {}).items())
+        return [(doc_id, copy.deepcopy(doc.data)) for doc_id, doc in items]
+
+class SQLiteStorage(Storage):
+    """Almacenamiento en un archivo SQLite local: una tabla de documentos JSON (las fechas se guardan en ISO 8601)."""
+    def __init__(self, path):
+        import sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs (collection TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL,"
+                           " version INTEGER NOT NULL, PRIMARY KEY (collection, id))")
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _dumps(data):
+        def default(value):
+            if isinstance(value, datetime):
+                return {'__datetime__': value.isoformat()}
+            raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+        return json.dumps(data, default=default, ensure_ascii=False)
+
+    @staticmethod
+    def _loads(text):
+        def object_hook(obj):
+            if len(obj) == 1 and '__datetime__' in obj:
+                return datetime.fromisoformat(obj['__datetime__'])
+            return obj
+        return json.loads(text, object_hook=object_hook)
+
+    def get_all(self, collection, doc_ids, fields=None):
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return {}
+        placeholders = ','.join('?' * len(doc_ids))
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id, data, version FROM docs WHERE collection = ? AND id IN ({placeholders})",
+                                      [collection, *doc_ids]).fetchall()
+        return {doc_id: StoredDoc(self._loads(data), version) for doc_id, data, version in rows}
+
+    def create(self, collection, doc_id, data):
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM docs WHERE collection = ? AND id = ?", (collection, doc_id)).fetchone():
+                return False
+            self.commit([('set', collection, doc_id, data, False)])
+            return True
+
+    def update_if_unchanged(self, collection, doc_id, version, data):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            # BEGIN IMMEDIATE toma el lock de escritura del archivo: también excluye a otros procesos
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data, version FROM docs WHERE collection = ? AND id = ?", (collection, doc_id)).fetchone()
+                if row is None or row[1] != version:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._conn.execute("UPDATE docs SET data = ?, version = ? WHERE collection = ? AND id = ?",
+                                   (self._dumps(apply_write(self._loads(row[0]), data, True, now)), time.time_ns(), collection, doc_id))
+                self._conn.execute("COMMIT")
+                return True
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def commit(self, writes):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for write in writes:
+                    if write[0] == 'delete':
+                        self._conn.execute("DELETE FROM docs WHERE collection = ? AND id = ?", (write[1], write[2]))
+                        continue
+                    _, collection, doc_id, data, merge = write
+                    current = None
+                    if merge:
+                        row = self._conn.execute("SELECT data FROM docs WHERE collection = ? AND id = ?", (collection, doc_id)).fetchone()
+                        current = self._loads(row[0]) if row else None
+                    self._conn.execute("INSERT OR REPLACE INTO docs (collection, id, data, version) VALUES (?, ?, ?, ?)",
+                                       (collection, doc_id, self._dumps(apply_write(current, data, merge, now)), time.time_ns()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def stream(self, collection):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM docs WHERE collection = ?", (collection,)).fetchall()
+        return [(doc_id, self._loads(data)) for doc_id, data in rows]
+
+    def list_ids(self, collection):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM docs WHERE collection = ?", (collection,))]
+
+def make_storage(backend):
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH)
+    raise ValueError(f"Backend de almacenamiento desconocido: {backend}")
+
+# --- CONEXIÓN CON FIREBASE (perezosa: se conecta en el primer acceso) ---
+_firebase_lock = threading.Lock()
+_firebase_attempted = False
+
+def get_db():
+    global db, _firebase_attempted
+    if db is not None or _firebase_attempted:
+        return db
+    with _firebase_lock:
+        if _firebase_attempted:
+            return db
+        _firebase_attempted = True
+        if STORAGE_BACKEND != 'firestore':
+            db = make_storage(STORAGE_BACKEND)
+            logger.info(f"✅ Almacenamiento local '{STORAGE_BACKEND}' listo.")
+            return db
+        try:
+            service_account_info_str = os.environ.get('FIREBASE_SERVICE_ACCOUNT_JSON')
+            if not service_account_info_str:
+                logger.error("❌ La variable de entorno FIREBASE_SERVICE_ACCOUNT_JSON no está configurada.")
+                return None
+            with startup_stage('credenciales'):
+                import firebase_admin
+                from firebase_admin import credentials
+                cred = credentials.Certificate(json.loads(service_account_info_str))
+            with startup_stage('firestore'):
+                from firebase_admin import firestore
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app(cred)
+                db = FirestoreStorage(firestore.client())
+            logger.info("✅ Conexión con Firebase establecida correctamente.")
+        except Exception as e:
+            logger.error(f"❌ Error crítico durante la inicialización: {e}")
+    return db
+
+_session_store_lock = threading.Lock()
+
+def get_session_store():
+    """Almacenamiento de las sesiones: el principal, o el de SESSION_STORAGE_BACKEND si está configurado."""
+    global session_store
+    if session_store is not None:
+        return session_store
+    if not SESSION_STORAGE_BACKEND or SESSION_STORAGE_BACKEND == STORAGE_BACKEND:
+        return get_db()
+    with _session_store_lock:
+        if session_store is None:
+            try:
+                session_store = make_storage(SESSION_STORAGE_BACKEND)
+            except Exception as e:
+                logger.error(f"❌ Error abriendo el almacenamiento de sesiones '{SESSION_STORAGE_BACKEND}': {e}")
+                return get_db()
+    return session_store
+
+def publish_config(docs, update_times):
+    """Construye un snapshot nuevo de la configuración y lo publica de una sola vez (junto con sus valores derivados)."""
+    global CONFIG_SNAPSHOT, CONFIG_VERSION, BUSINESS_RULES, FAQ_RESPONSES, BUSINESS_DATA, MENU_PRINCIPAL
+    global CATALOGO_PRODUCTOS, MENU_FAQ, CAMPAIGNS_CONFIG, PALABRAS_CANCELACION, FAQ_KEYWORD_MAP
+    global RUC_EMPRESA, TITULAR_YAPE, YAPE_NUMERO
+    general = docs.get('configuracion_general')
+    business_data = docs.get('datos_negocio', {})
+    with _config_lock:
+        CONFIG_SNAPSHOT = {'version': CONFIG_SNAPSHOT['version'] + 1, 'docs': docs, 'update_times': update_times}
+        BUSINESS_RULES = docs.get('reglas_envio', {})
+        FAQ_RESPONSES = docs.get('respuestas_faq', {})
+        BUSINESS_DATA = business_data
+        MENU_PRINCIPAL = docs.get('menu_principal', {})
+        CATALOGO_PRODUCTOS = docs.get('catalogo_productos', {})
+        MENU_FAQ = docs.get('menu_faq', {})
+        CAMPAIGNS_CONFIG = docs.get('campañas_y_ofertas', {})
+        PALABRAS_CANCELACION = general.get('palabras_cancelacion', ['cancelar']) if general is not None else []
+        FAQ_KEYWORD_MAP = general.get('faq_keyword_map', {}) if general is not None else {}
+        RUC_EMPRESA = business_data.get('ruc', 'RUC_NO_CONFIGURADO')
+        TITULAR_YAPE = business_data.get('titular_yape', 'TITULAR_NO_CONFIGURADO')
+        YAPE_NUMERO = business_data.get('yape_numero', 'YAPE_NO_CONFIGURADO')
+        CONFIG_VERSION = CONFIG_SNAPSHOT['version']
+    logger.info(f"✅ Configuración publicada (versión {CONFIG_VERSION}).")
+
+_config_derived = {}
+
+def derived_from_config(name, builder):
+    """Devuelve un valor precalculado a partir de la configuración; se reconstruye solo cuando cambia CONFIG_VERSION."""
+    cached = _config_derived.get(name)
+    if cached is None or cached[0] != CONFIG_VERSION:
+        cached = (CONFIG_VERSION, builder())
+        _config_derived[name] = cached
+    return cached[1]
+
+def load_config():
+    """Lee todos los documentos de configuración en una sola llamada (get_all) y publica el snapshot."""
+    if not db: return
+    stored = db.get_all('configuracion', CONFIG_DOCS)
+    for doc_id in CONFIG_DOCS:
+        if doc_id not in stored:
+            logger.warning(f"⚠️ Documento '{doc_id}' no encontrado.")
+    publish_config({doc_id: doc.data for doc_id, doc in stored.items()},
+                   {doc_id: doc.version for doc_id, doc in stored.items()})
+
+def _check_config_version():
+    global _config_check_running
+    try:
+        if db.versions('configuracion', CONFIG_DOCS) != CONFIG_SNAPSHOT['update_times']:
+            logger.info("🔄 Cambios detectados en 'configuracion', recargando...")
+            load_config()
+    except Exception as e:
+        logger.error(f"Error revisando la versión de la configuración: {e}")
+    finally:
+        _config_check_running = False
+
+def maybe_refresh_config():
+    """En modo 'poll', lanza en segundo plano una revisión de versión como mucho cada CONFIG_CHECK_INTERVAL segundos."""
+    global _config_last_check, _config_check_running
+    ensure_initialized()
+    if not db or CONFIG_RELOAD_MODE != 'poll':
+        return
+    with _config_lock:
+        if _config_check_running or time.monotonic() - _config_last_check < CONFIG_CHECK_INTERVAL:
+            return
+        _config_last_check = time.monotonic()
+        _config_check_running = True
+    threading.Thread(target=_check_config_version, daemon=True).start()
+
+def _on_config_snapshot(stored):
+    docs = {doc_id: doc.data for doc_id, doc in stored.items() if doc_id in CONFIG_DOCS}
+    update_times = {doc_id: doc.version for doc_id, doc in stored.items() if doc_id in CONFIG_DOCS}
+    if update_times != CONFIG_SNAPSHOT['update_times']:
+        publish_config(docs, update_times)
+
+_config_init_lock = threading.Lock()
+_config_initialized = False
+
+def ensure_initialized():
+    """Primera carga de la configuración y del catálogo, hecha cuando llega el primer mensaje y no al importar."""
+    global _config_initialized
+    if _config_initialized:
+        return
+    with _config_init_lock:
+        if _config_initialized:
+            return
+        _config_initialized = True
+        if not get_db():
+            return
+        try:
+            with startup_stage('config'):
+                load_config()
+            if CONFIG_RELOAD_MODE == 'listener':
+                if db.watch('configuracion', _on_config_snapshot):
+                    logger.info("✅ Escuchando cambios en 'configuracion'.")
+                else:
+                    logger.warning(f"⚠️ El almacenamiento '{STORAGE_BACKEND}' no admite escuchar cambios.")
+        except Exception as e:
+            logger.error(f"❌ Error cargando la configuración: {e}")
+        if PRODUCT_CACHE_WARM:
+            try:
+                with startup_stage('productos'):
+                    product_cache.warm()
+            except Exception as e:
+                logger.error(f"❌ Error precargando productos: {e}")
+
+# --- CONEXIÓN CON GOOGLE SHEETS (perezosa: se abre en el primer pedido) ---
+_sheets_lock = threading.Lock()
+
+def get_worksheet_pedidos():
+    global gc, worksheet_pedidos
+    if worksheet_pedidos is not None:
+        return worksheet_pedidos
+    with _sheets_lock:
+        if worksheet_pedidos is None:
+            creds_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+            sheet_name = os.environ.get('GOOGLE_SHEET_NAME')
+            if not (creds_json_str and sheet_name):
+                logger.warning("⚠️ Faltan variables de entorno para Google Sheets.")
+                return None
+            try:
+                with startup_stage('sheets'):
+                    import gspread
+                    gc = gspread.service_account_from_dict(json.loads(creds_json_str))
+                    worksheet_pedidos = gc.open(sheet_name).worksheet("Pedidos")
+                logger.info("✅ Conexión con Google Sheets establecida correctamente.")
+            except Exception as e:
+                logger.error(f"❌ Error conectando con Google Sheets: {e}")
+    return worksheet_pedidos
 
 # ==========================================================
 # 2. CONFIGURACIÓN DEL NEGOCIO Y VARIABLES GLOBALES
@@ -112,68 +601,1615 @@ PHONE_NUMBER_ID = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
 ADMIN_WHATSAPP_NUMBER = os.environ.get('ADMIN_WHATSAPP_NUMBER')
 MAKE_SECRET_TOKEN = os.environ.get('MAKE_SECRET_TOKEN')
 
-RUC_EMPRESA = BUSINESS_DATA.get('ruc', 'RUC_NO_CONFIGURADO')
-TITULAR_YAPE = BUSINESS_DATA.get('titular_yape', 'TITULAR_NO_CONFIGURADO')
-YAPE_NUMERO = BUSINESS_DATA.get('yape_numero', 'YAPE_NO_CONFIGURADO')
+
+# Envío diferido: los mensajes se entregan desde un pool, en paralelo entre clientes y en orden para cada uno.
+# Las pausas entre mensajes no ocupan un hilo del pool (las lleva DelayScheduler).
+# Con OUTBOUND_ASYNC=0 se vuelve al envío en línea (útil para depurar).
+OUTBOUND_ASYNC = os.environ.get('OUTBOUND_ASYNC', '1') == '1'
+OUTBOUND_MAX_WORKERS = int(os.environ.get('OUTBOUND_MAX_WORKERS', '8'))
+# En serverless (@vercel/python) la instancia puede congelarse apenas se responde: antes de responder, el webhook
+# espera hasta REQUEST_DRAIN_TIMEOUT segundos a que salgan los mensajes inmediatos de sus remitentes (los que no
+# llevan pausa) y escribe sus sesiones; así responde en cuanto salen las respuestas directas, sin dormir las pausas.
+# Los mensajes con pausa que quedan detrás los envía DelayScheduler: si la instancia se congela antes, salen
+# cuando vuelva a recibir una petición. Con REQUEST_DRAIN_DELAYED=1 se espera también a esos mensajes (una vuelta
+# típica del embudo tarda entonces 1,5-2,6 s en responder). Por defecto queda por debajo del límite de 10 s de
+# una función @vercel/python. En un servidor de larga vida (WEBHOOK_ASYNC=1, o REQUEST_DRAIN_TIMEOUT=0) se
+# responde sin esperar y el trabajo queda en los hilos en segundo plano.
+REQUEST_DRAIN_TIMEOUT = float(os.environ.get('REQUEST_DRAIN_TIMEOUT', '7'))
+REQUEST_DRAIN_DELAYED = os.environ.get('REQUEST_DRAIN_DELAYED', '0') == '1'
+
+# Webhook "ack-first": con WEBHOOK_ASYNC=1 el webhook solo valida y encola; un pool de hilos procesa
+# los mensajes en paralelo entre clientes y en orden estricto para cada número.
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '0') == '1'
+WEBHOOK_MAX_WORKERS = int(os.environ.get('WEBHOOK_MAX_WORKERS', '8'))
+
+# Deduplicación de mensajes reenviados por Meta (por id de mensaje)
+MESSAGE_DEDUP_TTL = int(os.environ.get('MESSAGE_DEDUP_TTL', '86400'))
+MESSAGE_DEDUP_MAX = int(os.environ.get('MESSAGE_DEDUP_MAX', '5000'))
+# Mientras se procesa, la marca de un mensaje queda reservada estos segundos: si la instancia muere a mitad
+# del turno, el reenvío de Meta posterior a la reserva se procesa de nuevo
+MESSAGE_DEDUP_LEASE = int(os.environ.get('MESSAGE_DEDUP_LEASE', '60'))
+
+# Caché de sesiones en memoria con escritura diferida hacia Firestore
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', '120'))
+SESSION_CACHE_MAX = int(os.environ.get('SESSION_CACHE_MAX', '2000'))
+SESSION_FLUSH_DELAY = float(os.environ.get('SESSION_FLUSH_DELAY', '0.5'))
+# Los mensajes seguidos de un cliente pueden caer en instancias distintas: pasados estos segundos, antes de usar
+# una sesión en caché se compara su revisión con la guardada (una lectura de un solo campo) y si otra instancia
+# la cambió se recarga
+SESSION_CACHE_REVALIDATE = float(os.environ.get('SESSION_CACHE_REVALIDATE', '3'))
+# Vida de una sesión sin actividad; se guarda como expires_at (apto para una política TTL de Firestore)
+SESSION_TTL = timedelta(minutes=int(os.environ.get('SESSION_TTL_MINUTES', '120')))
+SESSION_SWEEP_PAGE_SIZE = int(os.environ.get('SESSION_SWEEP_PAGE_SIZE', '200'))
+SESSION_SWEEP_MAX_PAGES = int(os.environ.get('SESSION_SWEEP_MAX_PAGES', '10'))
+
+# Caché de productos (colección 'productos')
+PRODUCT_CACHE_TTL = int(os.environ.get('PRODUCT_CACHE_TTL', '600'))
+PRODUCT_CACHE_MAX = int(os.environ.get('PRODUCT_CACHE_MAX', '500'))
+PRODUCT_CACHE_WARM = os.environ.get('PRODUCT_CACHE_WARM', '1') == '1'
+# Índice de ids válidos: el texto libre que no es un id conocido se descarta sin ir a Firestore.
+# Se refresca en segundo plano (solo ids) cada PRODUCT_INDEX_TTL segundos.
+PRODUCT_INDEX_TTL = int(os.environ.get('PRODUCT_INDEX_TTL', '300'))
+
+# Outbox de efectos posteriores a la venta (fila en la hoja 'Pedidos' y aviso al administrador).
+# Las entradas se escriben en el mismo commit que la venta y un drenador las procesa en segundo plano:
+# espera OUTBOX_DRAIN_DELAY segundos para agrupar ventas en un solo append y reintenta con espera exponencial.
+OUTBOX_DRAIN_DELAY = float(os.environ.get('OUTBOX_DRAIN_DELAY', '2'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_BACKOFF = float(os.environ.get('OUTBOX_RETRY_BACKOFF', '30'))
+# Tiempo que una entrada queda reservada para la instancia que la procesa (si muere, vuelve a estar lista)
+OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', '120'))
+# Cada cuánto el webhook revisa entradas pendientes de otras instancias
+OUTBOX_CHECK_INTERVAL = float(os.environ.get('OUTBOX_CHECK_INTERVAL', '60'))
+# Las entradas procesadas llevan expires_at (apto para una política TTL de Firestore)
+OUTBOX_RETENTION = timedelta(days=int(os.environ.get('OUTBOX_RETENTION_DAYS', '30')))
+
+# Cliente de la Graph API (timeouts en segundos)
+WHATSAPP_API_VERSION = os.environ.get('WHATSAPP_API_VERSION', 'v20.0')
+WHATSAPP_CONNECT_TIMEOUT = float(os.environ.get('WHATSAPP_CONNECT_TIMEOUT', '3.05'))
+WHATSAPP_READ_TIMEOUT = float(os.environ.get('WHATSAPP_READ_TIMEOUT', '10'))
+WHATSAPP_MAX_RETRIES = int(os.environ.get('WHATSAPP_MAX_RETRIES', '3'))
+WHATSAPP_RETRY_BACKOFF = float(os.environ.get('WHATSAPP_RETRY_BACKOFF', '0.5'))
+WHATSAPP_POOL_SIZE = int(os.environ.get('WHATSAPP_POOL_SIZE', '10'))
+# Duración típica de una llamada de envío a la Graph API; con ella se estima cuántos envíos caben en un plazo
+WHATSAPP_SEND_LATENCY = float(os.environ.get('WHATSAPP_SEND_LATENCY', '0.3'))
+# Presupuesto global de mensajes por segundo hacia la Graph API (0 desactiva el límite) y ritmo por
+# destinatario: Meta admite ~1 mensaje cada 6 s al mismo número, con ráfagas cortas.
+WHATSAPP_MAX_PER_SECOND = float(os.environ.get('WHATSAPP_MAX_PER_SECOND', '20'))
+WHATSAPP_RECIPIENT_PER_SECOND = float(os.environ.get('WHATSAPP_RECIPIENT_PER_SECOND', '0.17'))
+WHATSAPP_RECIPIENT_BURST = int(os.environ.get('WHATSAPP_RECIPIENT_BURST', '20'))
+WHATSAPP_MAX_RETRY_AFTER = float(os.environ.get('WHATSAPP_MAX_RETRY_AFTER', '60'))
+
+# Imágenes por id de media: cada URL se sube una vez a WhatsApp y se envía por id (Meta conserva el id 30 días)
+WHATSAPP_MEDIA_UPLOAD = os.environ.get('WHATSAPP_MEDIA_UPLOAD', '1') == '1'
+MEDIA_ID_TTL = timedelta(days=float(os.environ.get('MEDIA_ID_TTL_DAYS', '29')))
+MEDIA_CACHE_MAX = int(os.environ.get('MEDIA_CACHE_MAX', '500'))
+
+# Envío masivo de códigos de seguimiento: pausa entre los tres mensajes de cada cliente y hasta cuándo espera
+# /api/send-tracking a que terminen los envíos, contado desde que empezó la petición (arranque en frío incluido).
+# Ese plazo más el margen para los envíos en curso quedan por debajo del límite de 10 s de una función
+# @vercel/python; lo que no cabe se devuelve como 'no_enviado'.
+TRACKING_MESSAGE_DELAY = float(os.environ.get('TRACKING_MESSAGE_DELAY', '2'))
+TRACKING_WAIT_TIMEOUT = float(os.environ.get('TRACKING_WAIT_TIMEOUT', '7'))
+TRACKING_CANCEL_GRACE = float(os.environ.get('TRACKING_CANCEL_GRACE', '1.5'))
+
+# Métricas de latencia por etapa (expuestas en /api/metrics, protegidas con METRICS_TOKEN)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """Histogramas y contadores en memoria (por instancia) con salida en formato de texto de Prometheus."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._histograms = {}  # (nombre, etiquetas) -> [conteos por bucket, suma, total]
+        self._counters = {}  # (nombre, etiquetas) -> valor
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"' for k, v in labels)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self, gauges=()):
+        """Texto para Prometheus. `gauges` son tuplas (nombre, etiquetas, valor) calculadas al momento."""
+        lines, typed = [], set()
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, labels, value in gauges:
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
+_metrics_local = threading.local()
+
+def current_handler():
+    return getattr(_metrics_local, 'handler', 'none')
+
+def set_metrics_handler(name):
+    _metrics_local.handler = name
+
+def request_deadline(seconds):
+    """Instante (time.monotonic) en que se cumplen `seconds` desde que empezó la petición en curso: así el
+    arranque en frío, la carga de la configuración y el resto del handler cuentan contra el mismo plazo."""
+    return (getattr(_metrics_local, 'request_started', None) or time.monotonic()) + seconds
+
+@contextmanager
+def metrics_handler(name):
+    """Etiqueta con el handler de estado todas las mediciones hechas dentro del bloque (en este hilo)."""
+    previous = current_handler()
+    _metrics_local.handler = name
+    try:
+        yield
+    finally:
+        _metrics_local.handler = previous
+
+@contextmanager
+def timed(stage):
+    """Mide la duración de una etapa (Firestore, Graph API, Sheets...) y cuenta sus excepciones. Sirve también como decorador."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record_error(stage)
+        raise
+    finally:
+        metrics.observe('bot_stage_seconds', time.perf_counter() - started, stage=stage, handler=current_handler())
+
+def record_error(stage):
+    metrics.inc('bot_errors_total', stage=stage, handler=current_handler())
 
 # ==============================================================================
 # 3. FUNCIONES DE COMUNICACIÓN CON WHATSAPP
 # ==============================================================================
-def send_whatsapp_message(to_number, message_data):
-    if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
-        logger.error("Token de WhatsApp o ID de número no configurados.")
-        return
-    headers = {'Authorization': f'Bearer {WHATSAPP_TOKEN}', 'Content-Type': 'application/json'}
-    url = f"https://graph.facebook.com/v20.0/{PHONE_NUMBER_ID}/messages"
-    data = {"messaging_product": "whatsapp", "to": to_number, **message_data}
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        logger.info(f"Mensaje enviado a {to_number}.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error enviando mensaje a {to_number}: {e.response.text if e.response else e}")
-
-def send_text_message(to_number, text):
-    send_whatsapp_message(to_number, {"type": "text", "text": {"body": text}})
+class DelayScheduler:
+    """Ejecuta funciones cuando vence su plazo. Un solo hilo lleva todos los plazos en un heap y entrega cada
+    función vencida a un pool pequeño: esperar no ocupa ningún hilo de trabajo."""
+    def __init__(self, max_workers, name):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._heap = []  # (vencimiento, orden de llegada, función, argumentos)
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._name = name
+
+    def call_later(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, func, args = heapq.heappop(self._heap)
+            self._executor.submit(self._call, func, args)
+
+    @staticmethod
+    def _call(func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Error en tarea programada: {e}")
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+delay_scheduler = DelayScheduler(4, 'timers')
+
+class SerialKeyedExecutor:
+    """Pool de hilos que ejecuta en paralelo claves distintas y en orden FIFO las tareas de una misma clave.
+    Una tarea con `delay` espera en DelayScheduler, no en el hilo: la cola de su clave queda en pausa y el hilo
+    vuelve al pool para atender otras claves."""
+    def __init__(self, max_workers, name, delays):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._delays = delays
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = {}
+        self._parked = set()  # claves cuya próxima tarea espera en DelayScheduler
+
+    def submit(self, key, func, *args, **kwargs):
+        self.submit_after(key, 0, func, *args, **kwargs)
+
+    def submit_after(self, key, delay, func, *args, **kwargs):
+        """Encola `func` para `key`; se ejecuta `delay` segundos después de que termine la tarea anterior de la clave."""
+        with self._lock:
+            queue = self._queues.get(key)
+            start_worker = queue is None
+            if start_worker:
+                queue = self._queues[key] = deque()
+            queue.append((delay, func, args, kwargs))
+        # Solo un hilo drena la cola de cada clave: así se respeta el orden.
+        if start_worker:
+            self._executor.submit(self._drain, key)
+
+    def defer(self, key, delay, func, *args, **kwargs):
+        """Solo desde una tarea de `key` en curso: pone `func` al frente de su cola, `delay` segundos más tarde."""
+        with self._lock:
+            self._queues[key].appendleft((delay, func, args, kwargs))
+
+    def _resume(self, key):
+        with self._lock:
+            self._parked.discard(key)
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    self._idle.notify_all()
+                    return
+                delay, func, args, kwargs = queue[0]
+                if delay > 0:
+                    # La clave sigue registrada, así que lo que llegue mientras tanto espera detrás
+                    queue[0] = (0, func, args, kwargs)
+                    self._parked.add(key)
+                    self._idle.notify_all()
+                    self._delays.call_later(delay, self._resume, key)
+                    return
+                queue.popleft()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Error en tarea en segundo plano para {key}: {e}")
+
+    def pending(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def wait_idle(self, keys=None, timeout=None, include_delayed=True):
+        """Bloquea hasta que no queden tareas de `keys` (o de ninguna clave) o vence el timeout. False si venció.
+        Con include_delayed=False basta con que lo que queda de cada clave esté esperando su pausa."""
+        def busy(key):
+            return key in self._queues and (include_delayed or key not in self._parked)
+        with self._idle:
+            return self._idle.wait_for(lambda: not any(busy(key) for key in (self._queues if keys is None else keys)), timeout)
+
+outbound_scheduler = SerialKeyedExecutor(OUTBOUND_MAX_WORKERS, 'outbound', delay_scheduler)
+
+class TokenBucket:
+    """Limitador token bucket: `rate` fichas por segundo, con ráfagas de hasta `capacity`."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, now):
+        # Llamar con el lock tomado. Devuelve 0 y consume la ficha si hay una disponible.
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Bloquea hasta obtener una ficha. Devuelve los segundos que tuvo que esperar."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = self._wait_time(time.monotonic())
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self):
+        """Como acquire() pero sin bloquear: toma la ficha y devuelve 0, o devuelve cuánto falta sin tomar nada."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            return self._wait_time(time.monotonic())
+
+    def refund(self):
+        """Devuelve una ficha tomada con try_acquire() que al final no se usó."""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def pause(self, seconds):
+        """Vacía el bucket y no entrega fichas durante `seconds` (p. ej. lo que pide un Retry-After)."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Al reanudar solo hay una ficha: el primer reintento sale a tiempo y el resto vuelve al ritmo normal
+            self._tokens = 1
+            self._updated = self._paused_until
+
+class SendRateLimiter:
+    """Presupuesto global de envíos más un ritmo por destinatario, con cuenta de los hilos en espera."""
+    def __init__(self, global_rate, recipient_rate, recipient_burst, max_recipients=5000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_recipients = max_recipients
+        self._recipients = OrderedDict()  # número -> TokenBucket (LRU)
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    def _recipient_bucket(self, to_number):
+        with self._lock:
+            bucket = self._recipients.get(to_number)
+            if bucket is None:
+                bucket = self._recipients[to_number] = TokenBucket(self.recipient_rate, self.recipient_burst)
+                while len(self._recipients) > self.max_recipients:
+                    self._recipients.popitem(last=False)
+            self._recipients.move_to_end(to_number)
+            return bucket
+
+    def acquire(self, to_number):
+        """Bloquea hasta que el envío a `to_number` cabe en ambos presupuestos. Devuelve los segundos esperados."""
+        with self._lock:
+            self.waiting += 1
+        try:
+            # Primero el ritmo del destinatario, para no gastar fichas globales mientras se espera a un solo número
+            waited = self._recipient_bucket(to_number).acquire() if self.recipient_rate > 0 else 0.0
+            waited += self.global_bucket.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if waited:
+            metrics.observe('bot_rate_limit_wait_seconds', waited, handler=current_handler())
+        return waited
+
+    def try_acquire(self, to_number):
+        """Como acquire() pero sin bloquear: 0 si el envío cabe ya (y consume las fichas), o los segundos que faltan."""
+        recipient = self._recipient_bucket(to_number) if self.recipient_rate > 0 else None
+        if recipient and (wait := recipient.try_acquire()):
+            return wait
+        if wait := self.global_bucket.try_acquire():
+            if recipient:
+                recipient.refund()
+            return wait
+        return 0.0
+
+    def throttle(self, seconds, to_number=None):
+        """Frena los envíos tras un 429: solo al destinatario si el límite es por par, o a todos si es global."""
+        metrics.inc('bot_throttled_total', scope='recipient' if to_number else 'global')
+        if to_number:
+            self._recipient_bucket(to_number).pause(seconds)
+        else:
+            self.global_bucket.pause(seconds)
+
+class SendDeferred(Exception):
+    """Un envío sin bloqueo (defer=True) debe esperar `wait` segundos antes de su intento número `attempt`."""
+    def __init__(self, wait, attempt):
+        super().__init__(f"envío diferido {wait:.2f}s (intento {attempt})")
+        self.wait = wait
+        self.attempt = attempt
+
+class WhatsAppClient:
+    """Cliente compartido de la Graph API: sesión keep-alive con pool de conexiones, timeouts y reintentos con backoff."""
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    PAIR_RATE_LIMIT_CODE = 131056  # demasiados mensajes al mismo número
+    # Errores de Meta que indican un id de media inválido o vencido (el resto no dice nada del id)
+    MEDIA_ERROR_CODES = {131009, 131052, 131053}
+
+    def __init__(self, token, phone_number_id, api_version, connect_timeout, read_timeout, max_retries, backoff, pool_size, rate_limiter=None):
+        self.token = token
+        self.phone_number_id = phone_number_id
+        self.url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/messages"
+        self.media_url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/media"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # La sesión vive a nivel de módulo, así que se reutiliza entre invocaciones de una instancia caliente.
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                    session.headers.update({'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'})
+                    self._session = session
+        return self._session
+
+    def _backoff_delay(self, attempt):
+        return self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+
+    def _post(self, body):
+        # Solo se mide la llamada HTTP: la espera del limitador ya va en bot_rate_limit_wait_seconds
+        started = time.perf_counter()
+        try:
+            return self.session.post(self.url, timeout=self.timeout, **body)
+        finally:
+            metrics.observe('bot_stage_seconds', time.perf_counter() - started, stage='whatsapp_send', handler=current_handler())
+
+    @staticmethod
+    def _failed_to_connect(error):
+        """True si el error ocurrió al abrir la conexión (timeout de conexión, DNS, conexión rechazada)."""
+        import requests
+        from urllib3.exceptions import NewConnectionError
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        cause = error.args[0] if error.args else None
+        return isinstance(cause, NewConnectionError) or isinstance(getattr(cause, 'reason', None), NewConnectionError)
+
+    @staticmethod
+    def _error_code(response):
+        try:
+            return response.json().get('error', {}).get('code')
+        except (ValueError, AttributeError):
+            return None
+
+    def send(self, to_number, message_data):
+        """Envía un mensaje. Devuelve True si Meta lo aceptó."""
+        return self.send_status(to_number, message_data)[0]
+
+    def send_status(self, to_number, message_data, first_attempt=0, defer=False):
+        """Como send(), pero devuelve (aceptado, código de error de Meta o None).
+        Con defer=True nunca duerme: si el limitador o un reintento piden esperar, lanza SendDeferred para que
+        quien llama reprograme el envío (desde `first_attempt`) sin retener su hilo."""
+        if not self.token or not self.phone_number_id:
+            logger.error("Token de WhatsApp o ID de número no configurados.")
+            record_error('whatsapp_send')
+            return False, None
+        import requests
+        if isinstance(message_data, PreparedPayload):
+            # Plantilla estática: solo se antepone el destinatario al JSON ya serializado
+            body = {'data': f'{{"messaging_product":"whatsapp","to":{json.dumps(to_number)},{message_data.encoded}'.encode('utf-8')}
+        else:
+            body = {'json': {"messaging_product": "whatsapp", "to": to_number, **message_data}}
+        for attempt in range(first_attempt, self.max_retries + 1):
+            if self.rate_limiter:
+                # Cada intento cuenta contra el presupuesto, también los reintentos
+                if not defer:
+                    self.rate_limiter.acquire(to_number)
+                elif wait := self.rate_limiter.try_acquire(to_number):
+                    metrics.observe('bot_rate_limit_wait_seconds', wait, handler=current_handler())
+                    raise SendDeferred(wait, attempt)
+            delay = None
+            try:
+                response = self._post(body)
+            except requests.exceptions.RequestException as e:
+                if not self._failed_to_connect(e):
+                    # Un timeout de lectura o una conexión cortada tras enviar pueden significar que Meta sí lo
+                    # recibió: no se reintenta para no duplicar el mensaje.
+                    logger.error(f"Error enviando mensaje a {to_number}: {e}")
+                    record_error('whatsapp_send')
+                    return False, None
+                # La conexión ni siquiera se abrió: el mensaje no llegó a Meta, es seguro reintentar.
+                error = e
+            else:
+                if response.status_code not in self.RETRY_STATUS:
+                    if response.ok:
+                        logger.info(f"Mensaje enviado a {to_number}.")
+                        return True, None
+                    logger.error(f"Error enviando mensaje a {to_number}: {response.status_code} {response.text}")
+                    record_error('whatsapp_send')
+                    return False, self._error_code(response)
+                error = f"{response.status_code} {response.text}"
+                if response.status_code == 429:
+                    delay = self._throttle(to_number, response, attempt)
+                    if self.rate_limiter:
+                        # La pausa ya la impone el limitador al próximo intento, junto con el resto de envíos afectados
+                        if attempt < self.max_retries:
+                            logger.warning(f"Límite de Meta alcanzado enviando a {to_number}; reintento en {delay:.2f}s")
+                        continue
+            if attempt < self.max_retries:
+                delay = delay if delay is not None else self._backoff_delay(attempt)
+                logger.warning(f"Reintentando envío a {to_number} en {delay:.2f}s ({error})")
+                if defer:
+                    raise SendDeferred(delay, attempt + 1)
+                time.sleep(delay)
+        logger.error(f"Error enviando mensaje a {to_number} tras {self.max_retries + 1} intentos: {error}")
+        record_error('whatsapp_send')
+        return False, None
 
-def send_image_message(to_number, image_url):
-    send_whatsapp_message(to_number, {"type": "image", "image": {"link": image_url}})
+    def _throttle(self, to_number, response, attempt):
+        """Aplica el Retry-After de un 429 (o el backoff si no viene) al limitador compartido. Devuelve la pausa."""
+        try:
+            delay = min(float(response.headers.get('Retry-After')), WHATSAPP_MAX_RETRY_AFTER)
+        except (TypeError, ValueError):
+            delay = self._backoff_delay(attempt)
+        pair_limited = self._error_code(response) == self.PAIR_RATE_LIMIT_CODE
+        if self.rate_limiter:
+            self.rate_limiter.throttle(delay, to_number if pair_limited else None)
+        return delay
+
+    @timed('media_upload')
+    def upload_media(self, image_url):
+        """Descarga la imagen de nuestro hosting y la sube al endpoint de media. Devuelve el id de media o None."""
+        if not self.token or not self.phone_number_id:
+            return None
+        import requests
+        try:
+            # Descarga sin la sesión de la Graph API: el token de WhatsApp no debe viajar a otro host
+            image = requests.get(image_url, timeout=self.timeout)
+            image.raise_for_status()
+            mime_type = image.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+            filename = image_url.split('?')[0].rsplit('/', 1)[-1] or 'imagen'
+            # Content-Type: None quita el application/json de la sesión para que requests arme el multipart
+            response = self.session.post(self.media_url, data={'messaging_product': 'whatsapp', 'type': mime_type},
+                                         files={'file': (filename, image.content, mime_type)},
+                                         headers={'Content-Type': None}, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json().get('id')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Error subiendo la imagen {image_url} a WhatsApp: {e}")
+            record_error('media_upload')
+            return None
+
+    def send_many(self, to_number, payloads, delays=None):
+        """Envía varios mensajes a un mismo cliente, en orden y por la misma conexión. Devuelve un bool por mensaje."""
+        results = []
+        for idx, message_data in enumerate(payloads):
+            if delays and delays[idx]:
+                time.sleep(delays[idx])
+            results.append(self.send(to_number, message_data))
+        return results
+
+whatsapp_client = WhatsAppClient(
+    WHATSAPP_TOKEN, PHONE_NUMBER_ID, WHATSAPP_API_VERSION,
+    WHATSAPP_CONNECT_TIMEOUT, WHATSAPP_READ_TIMEOUT,
+    WHATSAPP_MAX_RETRIES, WHATSAPP_RETRY_BACKOFF, WHATSAPP_POOL_SIZE,
+    rate_limiter=SendRateLimiter(WHATSAPP_MAX_PER_SECOND, WHATSAPP_RECIPIENT_PER_SECOND, WHATSAPP_RECIPIENT_BURST)
+)
+
+class MediaCache:
+    """Ids de media de WhatsApp por URL de imagen, con su vencimiento. Se guardan también en Firestore para
+    compartirlos entre instancias; una URL nueva (o un id vencido) se vuelve a subir."""
+    COLLECTION = 'media_whatsapp'
+
+    def __init__(self, client, ttl, max_size):
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # url -> (media_id, vence)
+        self._lock = threading.Lock()
+        self._url_locks = {}  # url -> [lock, hilos que lo usan]; solo viven mientras hay una subida en curso
+
+    def _doc_id(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _url_lock(self, url):
+        with self._lock:
+            entry = self._url_locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._url_locks[url]
+
+    def _cached(self, url, now):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(url)
+                return entry[0]
+            return None
+
+    def _store(self, url, media_id, expires_at):
+        with self._lock:
+            self._entries[url] = (media_id, expires_at)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def media_id(self, url):
+        """Id de media vigente para `url`, subiendo la imagen si hace falta. None si no se pudo obtener."""
+        now = datetime.now(timezone.utc)
+        if media_id := self._cached(url, now):
+            return media_id
+        # Una sola subida por URL aunque varios envíos la pidan a la vez
+        with self._url_lock(url):
+            if media_id := self._cached(url, now):
+                return media_id
+            if get_db():
+                try:
+                    data = db.get(self.COLLECTION, self._doc_id(url))
+                    if data and data.get('url') == url and data.get('expires_at') and data['expires_at'] > now:
+                        self._store(url, data['media_id'], data['expires_at'])
+                        return data['media_id']
+                except Exception as e:
+                    logger.error(f"Error leyendo el id de media de {url}: {e}")
+            if not (media_id := self.client.upload_media(url)):
+                return None
+            expires_at = now + self.ttl
+            self._store(url, media_id, expires_at)
+            if get_db():
+                try:
+                    db.set(self.COLLECTION, self._doc_id(url), {'url': url, 'media_id': media_id, 'expires_at': expires_at})
+                except Exception as e:
+                    logger.error(f"Error guardando el id de media de {url}: {e}")
+            logger.info(f"Imagen {url} subida a WhatsApp (media {media_id}).")
+            return media_id
+
+    def invalidate(self, url):
+        with self._lock:
+            self._entries.pop(url, None)
+        if get_db():
+            try:
+                db.delete(self.COLLECTION, self._doc_id(url))
+            except Exception as e:
+                logger.error(f"Error invalidando el id de media de {url}: {e}")
+
+media_cache = MediaCache(whatsapp_client, MEDIA_ID_TTL, MEDIA_CACHE_MAX)
+
+def deliver_whatsapp_message(to_number, message_data, first_attempt=0, defer=False):
+    """Hace la llamada real a la API de WhatsApp. Devuelve True si el mensaje fue aceptado.
+    `first_attempt` y `defer` pasan a WhatsAppClient.send_status (defer=True puede lanzar SendDeferred)."""
+    if WHATSAPP_MEDIA_UPLOAD and message_data.get('type') == 'image' and (link := message_data['image'].get('link')):
+        # La subida (si hace falta) ocurre aquí, en el hilo de envío, no en el handler
+        if media_id := media_cache.media_id(link):
+            sent, error_code = whatsapp_client.send_status(to_number, image_payload(media_id=media_id), first_attempt, defer)
+            if sent or error_code not in WhatsAppClient.MEDIA_ERROR_CODES:
+                return sent
+            # Meta descartó el id antes de tiempo: se olvida y este envío sale por link
+            media_cache.invalidate(link)
+    return whatsapp_client.send_status(to_number, message_data, first_attempt, defer)[0]
+
+def _deliver(to_number, message_data, handler, first_attempt=0):
+    """Tarea de outbound_scheduler. El envío corre en otro hilo: se conserva la etiqueta del handler que lo encoló.
+    Si el limitador o un reintento piden esperar, el envío vuelve al frente de la cola del número con esa pausa
+    (la lleva DelayScheduler) y el hilo queda libre para otros clientes. Devuelve None si quedó diferido."""
+    with metrics_handler(handler):
+        try:
+            return deliver_whatsapp_message(to_number, message_data, first_attempt, defer=True)
+        except SendDeferred as deferred:
+            outbound_scheduler.defer(to_number, deferred.wait, _deliver, to_number, message_data, handler, deferred.attempt)
+            return None
+
+def send_whatsapp_message(to_number, message_data, delay=0):
+    """Encola un mensaje para el cliente. `delay` son los segundos de pausa respecto al mensaje anterior al mismo número."""
+    if OUTBOUND_ASYNC:
+        outbound_scheduler.submit_after(to_number, delay, _deliver, to_number, message_data, current_handler())
+    else:
+        if delay:
+            time.sleep(delay)
+        deliver_whatsapp_message(to_number, message_data)
+
+def schedule_messages(to_number, steps):
+    """Encola una secuencia ordenada de (message_data, delay) para un mismo cliente."""
+    if OUTBOUND_ASYNC:
+        for message_data, delay in steps:
+            outbound_scheduler.submit_after(to_number, delay, _deliver, to_number, message_data, current_handler())
+    else:
+        with metrics_handler(current_handler()):
+            whatsapp_client.send_many(to_number, [message_data for message_data, _ in steps], delays=[delay for _, delay in steps])
+
+def deliver_batch(jobs, deadline):
+    """Reparte secuencias {clave: (número, pasos)} en outbound_scheduler: en paralelo entre números y en orden para
+    cada uno, con las pausas en DelayScheduler. Solo arranca las secuencias que caben hasta `deadline`
+    (time.monotonic) según el presupuesto de envíos por segundo; al vencer el plazo cancela los pasos que aún no
+    empezaron. Una secuencia se corta en su primer fallo, así que los mensajes aceptados son siempre los primeros.
+    Devuelve {clave: (estado, mensajes aceptados)} con estado 'enviado', 'parcial', 'error', 'no_enviado'
+    (ningún mensaje salió: es seguro reenviarlo) o 'en_curso' (un envío seguía en vuelo al responder)."""
+    remaining = max(deadline - time.monotonic(), 0)
+    # Mensajes que caben en lo que queda del plazo, con un 20 % de margen: los limita el ritmo global hacia Meta
+    # y lo que el pool puede despachar (una llamada cada WHATSAPP_SEND_LATENCY segundos por hilo)
+    per_second = OUTBOUND_MAX_WORKERS / max(WHATSAPP_SEND_LATENCY, 0.01)
+    if WHATSAPP_MAX_PER_SECOND > 0:
+        per_second = min(per_second, WHATSAPP_MAX_PER_SECOND)
+    budget = per_second * remaining * 0.8
+    done = threading.Condition()
+    state = {}  # clave -> {'total', 'sent': [bool por mensaje], 'sending', 'cancelled'}
+
+    def step(key, to_number, message_data, handler, first_attempt=0):
+        with done:
+            job = state[key]
+            if job['cancelled']:
+                return
+            job['sending'] = True
+        try:
+            with metrics_handler(handler):
+                sent = deliver_whatsapp_message(to_number, message_data, first_attempt, defer=True)
+        except SendDeferred as deferred:
+            # Igual que en _deliver: la espera la lleva DelayScheduler, no este hilo
+            with done:
+                job['sending'] = False
+                done.notify_all()
+            outbound_scheduler.defer(to_number, deferred.wait, step, key, to_number, message_data, handler, deferred.attempt)
+            return
+        except Exception as e:
+            logger.error(f"Error en envío masivo a {to_number}: {e}")
+            sent = False
+        with done:
+            job['sending'] = False
+            job['sent'].append(sent)
+            # Tras un fallo no sale nada más de la secuencia: el reenvío retoma desde el mensaje que falló
+            job['cancelled'] = job['cancelled'] or not sent
+            done.notify_all()
+
+    def finished(job):
+        return len(job['sent']) == job['total'] or (job['cancelled'] and not job['sending'])
+
+    handler, used = current_handler(), 0
+    for key, (to_number, steps) in jobs.items():
+        if sum(delay for _, delay in steps) >= remaining or used + len(steps) > budget:
+            continue
+        used += len(steps)
+        state[key] = {'total': len(steps), 'sent': [], 'sending': False, 'cancelled': False}
+        for message_data, delay in steps:
+            outbound_scheduler.submit_after(to_number, delay, step, key, to_number, message_data, handler)
+
+    with done:
+        done.wait_for(lambda: all(finished(job) for job in state.values()), max(deadline - time.monotonic(), 0))
+        for job in state.values():
+            job['cancelled'] = True
+        # Un mensaje ya en vuelo no se puede cancelar: se le da un margen corto para saber si salió
+        done.wait_for(lambda: not any(job['sending'] for job in state.values()), TRACKING_CANCEL_GRACE)
+        results = {}
+        for key in jobs:
+            job = state.get(key)
+            sent = job['sent'] if job else []
+            if job and job['sending']:
+                status = 'en_curso'
+            elif not sent:
+                status = 'no_enviado'
+            elif all(sent) and len(sent) == job['total']:
+                status = 'enviado'
+            else:
+                status = 'parcial' if any(sent) else 'error'
+            results[key] = (status, sum(sent))
+        return results
+
+def text_payload(text):
+    return {"type": "text", "text": {"body": text}}
+
+def image_payload(image_url=None, media_id=None):
+    return {"type": "image", "image": {"id": media_id} if media_id else {"link": image_url}}
+
+def list_payload(body_text, button_text, rows):
+    """Mensaje interactivo de lista (una sección). Cada fila: {'id', 'title', 'description' opcional}."""
+    rows = [{"id": r['id'], "title": r['title'], **({"description": r['description']} if r.get('description') else {})} for r in rows]
+    return {"type": "interactive", "interactive": {"type": "list", "body": {"text": body_text}, "action": {"button": button_text, "sections": [{"rows": rows}]}}}
+
+def send_text_message(to_number, text, delay=0):
+    send_whatsapp_message(to_number, text_payload(text), delay=delay)
+
+def send_image_message(to_number, image_url, delay=0):
+    send_whatsapp_message(to_number, image_payload(image_url), delay=delay)
+
+# ------------------------------------------------------------------------------
+# PLANTILLAS DE MENSAJES
+# ------------------------------------------------------------------------------
+# Textos y botones de la conversación. Se pueden editar desde Firestore en configuracion_general.plantillas
+# ({nombre: {'texto': ..., 'botones': [...]}}); los huecos {asi} se rellenan al enviar. Los huecos que
+# dependen solo de la configuración (ruc_empresa, yape_numero, titular_yape, adelanto_shalom) se fijan al
+# compilar la plantilla, y una plantilla sin huecos restantes queda con su payload ya serializado.
+BOTONES_OCASION = [{'id': 'es_regalo', 'title': '🎁 Es para un regalo'}, {'id': 'es_para_mi', 'title': '💖 Es para mí'}]
+BOTONES_COMPRA = [{'id': 'si_coordinar', 'title': '✅ Sí, coordinar'}, {'id': 'no_gracias', 'title': 'No, gracias'}]
+BOTONES_UPSELL = [{'id': 'oferta', 'title': '🔥 Quiero la oferta'}, {'id': 'continuar', 'title': 'Continuar con uno'}]
+BOTONES_UBICACION = [{'id': 'lima', 'title': '📍 Lima'}, {'id': 'provincia', 'title': '🚚 Provincia'}]
+BOTONES_ACUERDO_SHALOM = [{'id': 'si_acuerdo', 'title': '✅ Sí, de acuerdo'}, {'id': 'no_acuerdo', 'title': 'No en este momento'}]
+BOTONES_EXPERIENCIA_SHALOM = [{'id': 'si_conozco', 'title': '✅ Sí, ya conozco'}, {'id': 'no_conozco', 'title': 'No, explícame más'}]
+BOTONES_AGENCIA_SHALOM = [{'id': 'shalom_knows_addr_yes', 'title': 'Sí, la conozco'}, {'id': 'shalom_knows_addr_no', 'title': 'No, necesito buscar'}]
+BOTONES_CONFIRMACION = [{'id': 'si_correcto', 'title': '✅ Sí, todo correcto'}, {'id': 'corregir', 'title': '📝 Corregir datos'}]
+BOTONES_PAGO_LIMA = [{'id': 'si_proceder', 'title': '💖 ¡Sí, lo quiero!'}, {'id': 'no_proceder', 'title': 'Ahora no, gracias'}]
+BOTONES_CONFIRMO_ENTREGA = [{'id': 'confirmo_entrega_lima', 'title': '✅ CONFIRMO'}]
+BOTONES_MENU = [{'id': '1', 'title': '🛍️ Ver Colección'}, {'id': '2', 'title': '❓ Preguntas'}]
+
+_RESUMEN_PEDIDO = ("*Resumen del Pedido*\n"
+                   "💎 {product_name}\n"
+                   "💵 Total: S/ {product_price:.2f}\n"
+                   "🚚 Envío: *{destino}* - ¡Gratis!\n"
+                   "💳 Pago: {metodo_pago}\n\n"
+                   "*Datos de Entrega*\n"
+                   "{detalles_cliente}\n\n"
+                   "¿Confirmas que todo es correcto?")
+_DATOS_YAPE = ("💳 *YAPE / PLIN:* {yape_numero}\n"
+               "👤 *Titular:* {titular_yape}\n\n"
+               "Una vez realizado, envíame la *captura de pantalla* para validar.")
+
+DEFAULT_TEMPLATES = {
+    # --- Etapa inicial ---
+    'bienvenida_producto': {'texto': (
+        "¡Hola {user_name}! Estás a punto de descubrir el *secreto* del Collar Mágico Girasol Radiant. 🤫✨\n"
+        "No es solo una joya, es una pieza que *se conecta contigo*, cambiando de color para reflejar tu propia energía. 💖\n"
+        "Debido a su diseño único, tenemos *pocas unidades disponibles* en esta campaña. ⚠️\n"
+        "Puedes llevarte la tuya por *S/ 69.00* (incluye *envío gratis* a todo el Perú 🇵🇪🚚).")},
+    'pregunta_ocasion': {'texto': "¿Esta *magia* es para ti o para sorprender a alguien especial? 🎁", 'botones': BOTONES_OCASION},
+    'reprompt_ocasion': {'texto': "Espero haber aclarado tu duda. 😊 Continuando... ¿esta magia es para ti o es un regalo?", 'botones': BOTONES_OCASION},
+    'menu_principal': {'texto': "{mensaje_bienvenida}", 'botones': BOTONES_MENU},
+    # --- Presentación y upsell ---
+    'detalles_producto': {'texto': (
+        "¡Maravillosa elección! ✨ El *{nombre}* es pura energía. Aquí tienes todos los detalles:\n\n"
+        "💎 *Material:* {material}\n"
+        "🔮 *La Magia:* {magia}\n"
+        "🎁 *Presentación:* {empaque}")},
+    'pregunta_compra': {'texto': (
+        "Para tu total seguridad, somos Daaqui Joyas, un negocio formal con *RUC {ruc_empresa}*. ¡Tu compra es 100% segura! 🇵🇪\n\n"
+        "¿Te gustaría coordinar tu pedido ahora para asegurar el tuyo?"), 'botones': BOTONES_COMPRA},
+    'reprompt_compra': {'texto': "Continuando con tu pedido... 😊\n\n¿Te gustaría coordinar ahora para asegurar el tuyo?", 'botones': BOTONES_COMPRA},
+    'oferta_upsell': {'texto': (
+        "¡Excelente elección! Pero espera... por decidir llevar tu collar, ¡acabas de desbloquear una oferta exclusiva! ✨\n\n"
+        "Añade un segundo Collar Mágico y te incluimos de regalo dos cadenas de diseño italiano.\n\n"
+        "Tu pedido se ampliaría a:\n"
+        "✨ 2 Collares Mágicos\n🎁 2 Cadenas de Regalo\n🎀 2 Cajitas Premium\n"
+        "💎 Todo por un único pago de S/ 99.00")},
+    'pregunta_upsell': {'texto': "Para continuar con tu pedido, ¿cuál será tu elección?", 'botones': BOTONES_UPSELL},
+    'reprompt_upsell': {'texto': "Aclarada tu duda, para continuar con tu pedido, ¿cuál será tu elección?", 'botones': BOTONES_UPSELL},
+    # --- Ubicación ---
+    'pregunta_ubicacion': {'texto': "¡Perfecto! Tu joya está casi en camino. Para coordinar tu envío gratis, indícame si el envío es para:", 'botones': BOTONES_UBICACION},
+    'reprompt_ubicacion': {'texto': "Espero haber aclarado tu duda. Continuando... Para coordinar tu envío gratis, indícame si es para:", 'botones': BOTONES_UBICACION},
+    'ubicacion_invalida': {'texto': "Por favor, elige una de las dos opciones del menú:", 'botones': BOTONES_UBICACION},
+    'pedir_distrito_lima': {'texto': "¡Genial! ✨ Para saber qué tipo de envío te corresponde, por favor, dime: ¿en qué distrito te encuentras? 📍"},
+    'pedir_provincia_distrito': {'texto': "¡Entendido! Para continuar, indícame tu *provincia y distrito*. ✍🏽\n\n📝 *Ej: Arequipa, Arequipa*"},
+    'cobertura_lima': {'texto': (
+        "¡Excelente! Tenemos cobertura en *{distrito}*. 🏙️\n\n"
+        "Para registrar tu pedido, envíame en *un solo mensaje* tu *Nombre, Dirección exacta* y *Referencia*.\n\n"
+        "📝 *Ej: Ana Pérez, Jr. Gamarra 123, Depto 501. Al lado de la farmacia.*")},
+    # --- Shalom ---
+    'propuesta_shalom_provincia': {'texto': (
+        "¡Genial! Prepararemos tu envío para *{provincia}* vía Shalom.\n\n"
+        "Nuestros despachos a provincia se están agendando rápidamente ⚠️. Para *asegurar y priorizar* tu paquete en la próxima salida, solicitamos un adelanto de *S/ {adelanto_shalom:.2f}* como compromiso de recojo.\n\n"
+        "¿Procedemos?"), 'botones': BOTONES_ACUERDO_SHALOM},
+    'propuesta_shalom_lima': {'texto': (
+        "¡Genial! Prepararemos tu envío para *{distrito}* vía *Shalom*.\n\n"
+        "Nuestros despachos se están agendando rápidamente ⚠️. Para *asegurar y priorizar* tu paquete en la próxima salida, solicitamos un adelanto de *S/ {adelanto_shalom:.2f}* como compromiso de recojo.\n\n"
+        "¿Procedemos?"), 'botones': BOTONES_ACUERDO_SHALOM},
+    'reprompt_acuerdo_shalom': {'texto': (
+        "Aclarada tu duda. 😊 Para continuar, te recuerdo que para asegurar tu paquete, solicitamos un adelanto de S/ {adelanto_shalom:.2f} como compromiso de recojo.\n\n"
+        "¿Procedemos?"), 'botones': BOTONES_ACUERDO_SHALOM},
+    'pregunta_experiencia_shalom': {'texto': "¡Genial! Para hacer el proceso más fácil, cuéntame: ¿alguna vez has recogido un pedido en una agencia Shalom? 🙋🏽‍♀️", 'botones': BOTONES_EXPERIENCIA_SHALOM},
+    'reprompt_experiencia_shalom': {'texto': "Aclarada tu duda. 😊 Para continuar, cuéntame, ¿alguna vez has recogido un pedido en una agencia Shalom?", 'botones': BOTONES_EXPERIENCIA_SHALOM},
+    'pedir_datos_shalom': {'texto': (
+        "¡Excelente! Entonces ya conoces el proceso. ✅\n\n"
+        "Para terminar, bríndame en un solo mensaje tu *Nombre Completo, DNI* y la *dirección exacta de la agencia Shalom* donde recogerás. ✍🏽\n\n"
+        "📝 *Ej: Juan Quispe, 45678901, Av. Pardo 123, Miraflores.*")},
+    'explicacion_shalom': {'texto': (
+        "¡No te preocupes! Te explico: Shalom es una empresa de envíos. Te damos un código de seguimiento, y cuando tu pedido llega a la agencia, nos yapeas el saldo restante. Apenas confirmemos, te damos la clave secreta para el recojo. ¡Es 100% seguro! 🔒\n\n"
+        "¿Conoces la dirección de alguna agencia Shalom cerca a ti?"), 'botones': BOTONES_AGENCIA_SHALOM},
+    'reprompt_agencia_shalom': {'texto': "Aclarada tu duda. 😊 Continuando, ¿conoces la dirección de alguna agencia Shalom cerca a ti?", 'botones': BOTONES_AGENCIA_SHALOM},
+    'pedir_datos_agencia': {'texto': "¡Perfecto! Por favor, bríndame en un solo mensaje tu *Nombre Completo, DNI* y la *dirección de esa agencia Shalom*. ✍🏽"},
+    'sin_agencia_shalom': {'texto': "Entiendo. 😔 Te recomiendo buscar en Google 'Shalom agencias' para encontrar la más cercana. Cuando la tengas, puedes iniciar la conversación de nuevo. ¡Gracias por tu interés!"},
+    # --- Confirmación y pago ---
+    'resumen_pedido': {'texto': "¡Gracias! Revisa que todo esté correcto:\n\n" + _RESUMEN_PEDIDO, 'botones': BOTONES_CONFIRMACION},
+    'reprompt_resumen_pedido': {'texto': "Espero haber aclarado tu duda. 😊 Por favor, revisa nuevamente que todo esté correcto y confirma tu pedido:\n\n" + _RESUMEN_PEDIDO, 'botones': BOTONES_CONFIRMACION},
+    'adelanto_lima': {'texto': (
+        "¡Perfecto! Tu pedido contra entrega está listo para ser agendado. ✨\n\n"
+        "Nuestras rutas de reparto para mañana 🚚 ya se están llenando y tenemos *cupos limitados* ⚠️. Para asegurar tu espacio y priorizar tu entrega, solo solicitamos un adelanto de *S/ 10.00*.\n\n"
+        "Este pequeño monto confirma tu compromiso y nos permite seguir ofreciendo *envío gratis* a clientes serios como tú. Por supuesto, se descuenta del total.")},
+    'pregunta_pago_lima': {'texto': "¡Casi es tuyo! ✨ Tu Collar Mágico está esperando. ¿Aseguramos tu joya?", 'botones': BOTONES_PAGO_LIMA},
+    'reprompt_pago_lima': {'texto': "Aclarada tu duda. 😊 Para continuar, ¿aseguramos tu joya?", 'botones': BOTONES_PAGO_LIMA},
+    'datos_pago': {'texto': "¡Genial! Puedes realizar el adelanto de *S/ {adelanto:.2f}* a:\n\n" + _DATOS_YAPE},
+    # --- Venta confirmada ---
+    'resumen_venta_lima': {'texto': (
+        "¡Adelanto confirmado, gracias! ✨ Aquí tienes el resumen final de tu pedido y los detalles de la entrega:\n\n"
+        "*Tu Pedido en Detalle:*\n"
+        "💰 *Costo Total:* S/ {precio_venta:.2f}\n"
+        "✅ *Adelanto Recibido:* - S/ {adelanto_recibido:.2f}\n"
+        "💵 *Saldo a Pagar al recibir:* S/ {saldo_restante:.2f}\n\n"
+        "*Entrega Programada:*\n"
+        "🗓️ *Día:* {dia_entrega_titulo}\n"
+        "⏰ *Horario:* {horario}\n\n"
+        "A continuación, te pediré un último paso para asegurar tu envío.")},
+    'solicitud_confirmacion_lima': {'texto': (
+        "¡Ya casi es tuya! 💎\n\n"
+        "Para garantizar una entrega exitosa *{dia_entrega}*, por favor confirma que habrá alguien disponible para recibir tu joya y pagar el saldo 💵.\n\n"
+        "👉 Solo presiona *CONFIRMO* y tu pedido quedará asegurado en la ruta. 🚚✨"), 'botones': BOTONES_CONFIRMO_ENTREGA},
+    'resumen_venta_shalom': {'texto': (
+        "¡Adelanto confirmado, gracias! ✨ Aquí tienes el resumen final de tu pedido:\n\n"
+        "*Tu Pedido en Detalle:*\n"
+        "💰 *Costo Total:* S/ {precio_venta:.2f}\n"
+        "✅ *Adelanto Recibido:* - S/ {adelanto_recibido:.2f}\n"
+        "------------------------------------\n"
+        "💵 *Saldo a Pagar:* S/ {saldo_restante:.2f}")},
+    'proximos_pasos_shalom': {'texto': (
+        "📝 *Próximos Pasos:*\n\n"
+        "⏳ En las próximas 24h hábiles te enviaremos tu código de seguimiento 📲. El tiempo de entrega en agencia es de *{tiempo_entrega}* 📦.")},
+    'reprompt_confirmacion_lima': {'texto': "Espero haber aclarado tu duda. 😊 Para finalizar, solo necesito que confirmes que habrá alguien disponible para recibir tu joya y pagar el saldo el día {dia_entrega}.", 'botones': BOTONES_CONFIRMO_ENTREGA},
+    'pedir_confirmacion_lima': {'texto': "Por favor, para asegurar tu pedido, presiona el botón de confirmación.", 'botones': BOTONES_CONFIRMO_ENTREGA},
+    'pedido_confirmado_lima': {'texto': (
+        "¡Listo! ✅ Tu pedido ha sido *confirmado en la ruta* 🚚.\n\n"
+        "De parte de todo el equipo de *Daaqui Joyas*, ¡muchas gracias por tu compra! 🎉😊")},
+    # --- Seguimiento Shalom (/api/send-tracking) ---
+    'seguimiento_datos': {'texto': (
+        "¡Hola {customer_name}! 👋🏽✨\n\n¡Excelentes noticias! Tu pedido de Daaqui Joyas ha sido enviado. 🚚\n\n"
+        "Datos para seguimiento Shalom:\n👉🏽 *Nro. de Orden:* {nro_orden}{linea_codigo_recojo}"
+        "\n\nA continuación, los pasos a seguir:")},
+    'seguimiento_pasos': {'texto': (
+        "*Pasos para una entrega exitosa:* 👇\n\n"
+        "*1. HAZ EL SEGUIMIENTO:* 📲\nDescarga la app *\"Mi Shalom\"*. Si eres nuevo, regístrate. Con los datos de arriba, podrás ver el estado de tu paquete.\n\n"
+        "*2. PAGA EL SALDO CUANDO LLEGUE:* 💳\nCuando la app confirme que tu pedido llegó a la agencia, yapea o plinea el saldo restante. Haz este paso *antes de ir a la agencia*.\n\n"
+        "*3. AVISA Y RECIBE TU CLAVE:* 🔑\nApenas nos envíes la captura de tu pago, lo validaremos y te daremos la *clave secreta de recojo*. ¡La necesitarás junto a tu DNI! 🎁")},
+    'seguimiento_cierre': {'texto': (
+        "✨ *¡Ya casi es tuya! Tu último paso es el más importante.* ✨\n\n"
+        "Para darte atención prioritaria, responde este chat con la **captura de tu pago**.\n\n"
+        "¡Estaremos atentos para enviarte tu clave al instante! La necesitarás junto a tu DNI para recibir tu joya. 🎁")},
+}
 
-def send_interactive_message(to_number, body_text, buttons):
-    button_payload = [{"type": "reply", "reply": {"id": b.get('id'), "title": b.get('title')}} for b in buttons[:3]]
-    message_data = {"type": "interactive", "interactive": {"type": "button", "body": {"text": body_text}, "action": {"buttons": button_payload}}}
-    send_whatsapp_message(to_number, message_data)
+class PreparedPayload(dict):
+    """message_data de una plantilla sin huecos, con su JSON ya serializado (sin la llave de apertura)."""
+    def __init__(self, message_data):
+        super().__init__(message_data)
+        self.encoded = json.dumps(message_data, ensure_ascii=False, separators=(',', ':'))[1:]
+
+class MessageTemplate:
+    """Texto (y botones) de un mensaje. Sin huecos guarda el payload listo; con huecos solo formatea el texto al enviar."""
+    _formatter = string.Formatter()
+
+    def __init__(self, text, buttons=None, config_values=None):
+        self.text = self._bind(text, config_values or {})
+        self.slots = frozenset(field for _, field, _, _ in self._formatter.parse(self.text) if field is not None)
+        self.button_ids = [b.get('id') for b in buttons[:3]] if buttons else []
+        # El bloque de botones no depende de los huecos: se arma una vez y se comparte entre envíos
+        self._action = {"buttons": [{"type": "reply", "reply": {"id": b.get('id'), "title": b.get('title')}} for b in buttons[:3]]} if buttons else None
+        self.static = None if self.slots else PreparedPayload(self._payload(self.text.format()))
+
+    @classmethod
+    def _bind(cls, text, values):
+        """Fija los huecos que dependen solo de la configuración y deja el resto para render()."""
+        parts = []
+        for literal, field, spec, conversion in cls._formatter.parse(text):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if field in values:
+                value = cls._formatter.convert_field(values[field], conversion)
+                parts.append(format(value, spec).replace('{', '{{').replace('}', '}}'))
+            else:
+                parts.append('{' + field + (f'!{conversion}' if conversion else '') + (f':{spec}' if spec else '') + '}')
+        return ''.join(parts)
+
+    def _payload(self, text):
+        if self._action is None:
+            return text_payload(text)
+        return {"type": "interactive", "interactive": {"type": "button", "body": {"text": text}, "action": self._action}}
+
+    def render(self, **values):
+        if self.static is not None:
+            return self.static
+        return self._payload(self.text.format(**values))
+
+def build_message_templates():
+    general = CONFIG_SNAPSHOT['docs'].get('configuracion_general') or {}
+    overrides = general.get('plantillas') or {}
+    if not isinstance(overrides, dict):
+        logger.error("configuracion_general.plantillas debe ser un objeto {nombre: plantilla}; se usan las predeterminadas")
+        overrides = {}
+    config_values = {
+        'ruc_empresa': RUC_EMPRESA, 'yape_numero': YAPE_NUMERO, 'titular_yape': TITULAR_YAPE,
+        'adelanto_shalom': float(BUSINESS_RULES.get('adelanto_shalom', 20)),
+    }
+    templates = {}
+    for name, default in DEFAULT_TEMPLATES.items():
+        templates[name] = template = MessageTemplate(default['texto'], default.get('botones'), config_values)
+        if not (override := overrides.get(name)):
+            continue
+        try:
+            custom = MessageTemplate(override.get('texto', default['texto']), override.get('botones', default.get('botones')), config_values)
+            # Los handlers solo saben rellenar sus huecos y reconocer sus ids de botón
+            if unknown := custom.slots - template.slots:
+                raise ValueError(f"huecos desconocidos {sorted(unknown)}")
+            if custom.button_ids != template.button_ids:
+                raise ValueError("los botones deben conservar sus ids")
+            templates[name] = custom
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.error(f"Plantilla '{name}' de la configuración inválida, se usa la predeterminada: {e}")
+    return templates
+
+def get_message_templates():
+    return derived_from_config('message_templates', build_message_templates)
+
+def render_template(name, **values):
+    return get_message_templates()[name].render(**values)
+
+def send_template(to_number, name, delay=0, **values):
+    send_whatsapp_message(to_number, render_template(name, **values), delay=delay)
 
 # ==============================================================================
 # 4. FUNCIONES DE INTERACCIÓN CON FIRESTORE
 # ==============================================================================
-def get_session(user_id):
-    if not db: return None
+_FIELD_DELETED = object()  # marca interna: campo eliminado de la sesión, pendiente de borrar en Firestore
+
+class Session(dict):
+    """Sesión de conversación que recuerda qué campos cambiaron desde la última escritura."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dirty = set()
+        self._deleted = set()
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self._dirty.add(key)
+            self._deleted.discard(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self._dirty.discard(key)
+            self._deleted.add(key)
+        return super().pop(key, *default)
+
+    def changes(self):
+        """Campos modificados desde la última escritura (los eliminados llevan la marca _FIELD_DELETED)."""
+        changed = {key: self[key] for key in self._dirty}
+        changed.update({key: _FIELD_DELETED for key in self._deleted})
+        return changed
+
+    def mark_clean(self):
+        self._dirty.clear()
+        self._deleted.clear()
+
+class SessionCache:
+    """Caché de sesiones con TTL y desalojo LRU. Las escrituras se agrupan por usuario y se envían a Firestore en segundo plano.
+    Cada escritura lleva un campo 'revision' nuevo: una entrada con más de `revalidate_after` segundos solo se
+    sirve si su revisión sigue siendo la guardada, así que lo que escribió otra instancia no se pisa con un estado viejo."""
+    def __init__(self, max_size, ttl_seconds, flush_delay, revalidate_after):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.flush_delay = flush_delay
+        self.revalidate_after = revalidate_after
+        self._entries = OrderedDict()  # user_id -> (sesión o None si no existe, momento de carga)
+        self._pending = {}  # user_id -> ('merge' | 'replace' | 'delete', datos)
+        self._lock = threading.RLock()
+        self._flush_scheduled = False
+
+    def get(self, user_id):
+        """Devuelve (encontrado, sesión). Una sesión None en caché significa que se sabe que no existe."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False, None
+            session, loaded_at = entry
+            # Con escrituras pendientes la caché es lo más reciente: no se vence ni se contrasta
+            age = time.monotonic() - loaded_at if user_id not in self._pending else 0
+            if age > self.ttl:
+                del self._entries[user_id]
+                return False, None
+        if age > self.revalidate_after:
+            current = self._is_current(user_id, session)
+            with self._lock:
+                if self._entries.get(user_id) is entry:
+                    if current:
+                        self._entries[user_id] = (session, time.monotonic())
+                    else:
+                        del self._entries[user_id]
+            if not current:
+                return False, None
+        with self._lock:
+            if user_id in self._entries:
+                self._entries.move_to_end(user_id)
+        return True, (Session(session) if session is not None else None)
+
+    @timed('session_check')
+    def _is_current(self, user_id, session):
+        """True si la sesión guardada sigue en la revisión de la caché (o, si la caché dice que no existe, sigue sin existir)."""
+        try:
+            doc = get_session_store().get_all('sessions', [user_id], fields=['revision']).get(user_id)
+        except Exception as e:
+            # Sin poder comprobarlo se sirve la caché: releer la sesión completa fallaría igual
+            logger.warning(f"No se pudo comprobar la sesión de {user_id}: {e}")
+            return True
+        if doc is None or session is None:
+            return doc is None and session is None
+        return doc.data.get('revision') == session.get('revision')
+
+    def put(self, user_id, session):
+        with self._lock:
+            self._entries[user_id] = (dict(session) if session is not None else None, time.monotonic())
+            self._entries.move_to_end(user_id)
+            # Nunca se desaloja una sesión con escrituras pendientes
+            for old_id in list(self._entries):
+                if len(self._entries) <= self.max_size:
+                    break
+                if old_id not in self._pending:
+                    del self._entries[old_id]
+
+    def save(self, user_id, session_data, changes):
+        """Guarda la sesión completa en caché y acumula solo los campos modificados para Firestore."""
+        with self._lock:
+            self.put(user_id, session_data)
+            op, data = self._pending.get(user_id, ('merge', {}))
+            if op == 'delete':
+                # Tras un borrado, la nueva sesión debe reemplazar el documento completo
+                op, data, changes = 'replace', {}, session_data
+            self._pending[user_id] = (op, {**data, **changes})
+            self._schedule_flush()
+
+    def delete(self, user_id):
+        with self._lock:
+            self.put(user_id, None)
+            self._pending[user_id] = ('delete', None)
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            delay_scheduler.call_later(self.flush_delay, self.flush)
+
+    def flush(self, user_id=None):
+        """Escribe en Firestore las operaciones pendientes (todas o solo las de un usuario). Es síncrono."""
+        with self._lock:
+            if user_id is None:
+                batch, self._pending = self._pending, {}
+                self._flush_scheduled = False
+            else:
+                batch = {user_id: self._pending.pop(user_id)} if user_id in self._pending else {}
+        for uid, (op, data) in batch.items():
+            try:
+                with timed('session_write'):
+                    self._write(uid, op, data)
+            except Exception as e:
+                logger.error(f"Error guardando sesión para {uid}: {e}")
+                with self._lock:
+                    # Se reintenta en el próximo flush, salvo que ya exista una operación más reciente
+                    if uid not in self._pending:
+                        self._pending[uid] = (op, data)
+                        self._schedule_flush()
+
+    def _write(self, uid, op, data):
+        store = get_session_store()
+        if op == 'delete':
+            store.delete('sessions', uid)
+        else:
+            if op == 'merge':
+                fields = {k: (DELETE_FIELD if v is _FIELD_DELETED else v) for k, v in data.items()}
+            else:
+                fields = {k: v for k, v in data.items() if v is not _FIELD_DELETED}
+            store.set('sessions', uid, {**fields, 'last_updated': SERVER_TIMESTAMP}, merge=(op == 'merge'))
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def mark_persisted(self, user_id, session_data):
+        """Registra en caché una sesión que ya se escribió en Firestore por otra vía (p. ej. un batch)."""
+        with self._lock:
+            self._pending.pop(user_id, None)
+            if session_data is not None:
+                session_data = {**session_data, 'last_updated': datetime.now(timezone.utc)}
+            self.put(user_id, session_data)
+
+session_cache = SessionCache(SESSION_CACHE_MAX, SESSION_CACHE_TTL, SESSION_FLUSH_DELAY, SESSION_CACHE_REVALIDATE)
+
+class SessionBatch:
+    """Sesión de un usuario mientras se procesa un lote de sus mensajes: los handlers leen y escriben en memoria
+    y solo el estado final se guarda (una vez) al cerrar el lote."""
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loaded = False
+        self.session = None
+        self.final_op = None  # None (nada que guardar) | 'save' | 'delete'
+        self.deleted = False  # hubo un borrado antes del estado final: se reemplaza el documento completo
+        self.changes = {}
+        self.products = {}
+
+    def load(self, session):
+        self.loaded, self.session = True, session
+
+    def save(self, session_data, changes):
+        if not isinstance(session_data, Session):
+            session_data = Session(session_data)
+        # La expiración se renueva ya en memoria para que los siguientes mensajes del lote no la vean vencida
+        now = datetime.now(timezone.utc)
+        dict.__setitem__(session_data, 'last_updated', now)
+        dict.__setitem__(session_data, 'expires_at', now + SESSION_TTL)
+        self.loaded, self.session, self.final_op = True, session_data, 'save'
+        self.changes.update(changes)
+
+    def delete(self):
+        self.loaded, self.session, self.final_op = True, None, 'delete'
+        self.deleted, self.changes = True, {}
+
+    def persisted(self, session_data):
+        """La sesión se escribió por otra vía (el batch de la venta): lo acumulado ya no debe guardarse."""
+        self.loaded, self.final_op, self.deleted, self.changes = True, None, False, {}
+        self.session = Session(session_data) if session_data is not None else None
+
+    def commit(self):
+        if self.final_op == 'delete':
+            session_cache.delete(self.user_id)
+        elif self.final_op == 'save':
+            if self.deleted:
+                session_cache.delete(self.user_id)  # la caché convierte el guardado siguiente en un reemplazo
+            _persist_session(self.user_id, self.session, dict(self.session) if self.deleted else self.changes)
+
+_session_batches = threading.local()
+
+def current_session_batch(user_id):
+    batch = getattr(_session_batches, 'batch', None)
+    return batch if batch is not None and batch.user_id == user_id else None
+
+@contextmanager
+def session_batch(user_id):
+    """Agrupa las lecturas y escrituras de sesión de `user_id` hechas en este hilo y las persiste al salir."""
+    batch = _session_batches.batch = SessionBatch(user_id)
     try:
-        doc = db.collection('sessions').document(user_id).get()
-        return doc.to_dict() if doc.exists else None
-    except Exception as e:
-        logger.error(f"Error obteniendo sesión para {user_id}: {e}")
-        return None
+        yield batch
+    finally:
+        _session_batches.batch = None
+        if get_session_store():
+            batch.commit()
 
+@timed('get_session')
+def get_session(user_id):
+    if not (store := get_session_store()): return None
+    if (batch := current_session_batch(user_id)) and batch.loaded:
+        return batch.session
+    found, session = session_cache.get(user_id)
+    if not found:
+        try:
+            data = store.get('sessions', user_id)
+            session = Session(data) if data is not None else None
+            session_cache.put(user_id, session)
+        except Exception as e:
+            logger.error(f"Error obteniendo sesión para {user_id}: {e}")
+            record_error('get_session')
+            return None
+    if batch:
+        batch.load(session)
+    return session
+
+@timed('save_session')
 def save_session(user_id, session_data):
-    if not db: return
-    try:
-        session_data['last_updated'] = firestore.SERVER_TIMESTAMP
-        db.collection('sessions').document(user_id).set(session_data, merge=True)
-    except Exception as e:
-        logger.error(f"Error guardando sesión para {user_id}: {e}")	
-
+    if not get_session_store(): return
+    if isinstance(session_data, Session):
+        # Solo viajan los campos modificados; si no cambió nada no se escribe
+        changes = session_data.changes()
+        if not changes:
+            return
+    else:
+        changes = dict(session_data)
+    if batch := current_session_batch(user_id):
+        batch.save(session_data, changes)
+        if isinstance(session_data, Session):
+            session_data.mark_clean()
+        return
+    _persist_session(user_id, session_data, changes)
+
+def new_session_revision():
+    return uuid.uuid4().hex[:16]
+
+def _persist_session(user_id, session_data, changes):
+    # En caché se guarda la hora local para que el control de expiración funcione sin releer Firestore
+    now = datetime.now(timezone.utc)
+    dict.__setitem__(session_data, 'last_updated', now)
+    dict.__setitem__(session_data, 'expires_at', now + SESSION_TTL)
+    dict.__setitem__(session_data, 'revision', new_session_revision())
+    changes['expires_at'] = session_data['expires_at']
+    changes['revision'] = session_data['revision']
+    session_cache.save(user_id, session_data, changes)
+    if isinstance(session_data, Session):
+        session_data.mark_clean()
+
+@timed('delete_session')
 def delete_session(user_id):
-    if not db: return
-    try:
-        db.collection('sessions').document(user_id).delete()
-    except Exception as e:
-        logger.error(f"Error eliminando sesión para {user_id}: {e}")
+    if not get_session_store(): return
+    if batch := current_session_batch(user_id):
+        batch.delete()
+        return
+    session_cache.delete(user_id)
+
+def is_session_expired(session):
+    """Decide la expiración con los datos de la propia sesión, sin consultar Firestore."""
+    now = datetime.now(timezone.utc)
+    if expires_at := session.get('expires_at'):
+        if expires_at.tzinfo is None: expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return now >= expires_at
+    # Sesiones anteriores a expires_at: se usa last_updated
+    if last_update_time := session.get('last_updated'):
+        if last_update_time.tzinfo is None: last_update_time = last_update_time.replace(tzinfo=timezone.utc)
+        return now - last_update_time > SESSION_TTL
+    # Sin ninguna marca de tiempo no hay forma de saber su edad: se descarta en el siguiente mensaje
+    return True
+
+def sweep_expired_sessions(page_size=SESSION_SWEEP_PAGE_SIZE, max_pages=SESSION_SWEEP_MAX_PAGES):
+    """Borra en lotes paginados las sesiones vencidas. Devuelve cuántas eliminó.
+    Además de expires_at se recorre last_updated: las sesiones guardadas antes de que existiera
+    expires_at solo tienen esa marca (y con ella expires_at habría vencido igualmente)."""
+    if not (store := get_session_store()): return 0
+    now = datetime.now(timezone.utc)
+    deleted = 0
+    for field, cutoff in (('expires_at', now), ('last_updated', now - SESSION_TTL)):
+        for _ in range(max_pages):
+            ids = store.ids_where_less('sessions', field, cutoff, page_size)
+            if not ids:
+                break
+            store.commit([('delete', 'sessions', uid) for uid in ids])
+            deleted += len(ids)
+            if len(ids) < page_size:
+                break
+    logger.info(f"🧹 {deleted} sesiones expiradas eliminadas.")
+    return deleted
+
+def flush_sessions(user_id=None):
+    """Fuerza la escritura síncrona de las sesiones pendientes (punto de control)."""
+    if not get_session_store(): return
+    session_cache.flush(user_id)
+
+class ProductCache:
+    """Caché de documentos de 'productos' con TTL, número de versión e invalidación explícita.
+    Los diccionarios devueltos se comparten entre llamadas: son de solo lectura.
+    Lleva además el conjunto de ids existentes para rechazar en memoria los ids que no son productos."""
+    def __init__(self, max_size, ttl_seconds, index_ttl):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.index_ttl = index_ttl
+        self.version = 0
+        self._products = OrderedDict()  # product_id -> (datos o None si no existe, momento de carga)
+        self._ids = None  # frozenset de ids existentes; None mientras no se haya cargado
+        self._ids_loaded_at = 0.0
+        self._ids_refreshing = False
+        self._lock = threading.Lock()
+
+    def _set_ids(self, ids, loaded_at):
+        # Se reemplaza el conjunto completo: los lectores no toman el lock
+        self._ids = frozenset(ids)
+        self._ids_loaded_at = loaded_at
+
+    def _refresh_ids(self):
+        try:
+            loaded_at = time.monotonic()
+            with timed('product_index'):
+                ids = db.list_ids('productos')
+            with self._lock:
+                self._set_ids(ids, loaded_at)
+        except Exception as e:
+            logger.error(f"Error refrescando el índice de productos: {e}")
+        finally:
+            with self._lock:
+                self._ids_refreshing = False
+
+    def is_known(self, product_id):
+        """False solo si hay índice y el id no está en él (ni lo referencia la configuración). Sin E/S."""
+        ids = self._ids
+        stale = ids is None or time.monotonic() - self._ids_loaded_at > self.index_ttl
+        if stale and not self._ids_refreshing and db is not None:
+            # Se vuelve a comprobar con el lock: solo una llamada lanza el refresco
+            with self._lock:
+                start = not self._ids_refreshing
+                self._ids_refreshing = True
+            if start:
+                threading.Thread(target=self._refresh_ids, daemon=True).start()
+        if ids is None:
+            return True
+        return product_id in ids or product_id in get_config_product_ids()
+
+    def _store(self, product_id, product_data, loaded_at):
+        self._products[product_id] = (product_data, loaded_at)
+        self._products.move_to_end(product_id)
+        while len(self._products) > self.max_size:
+            self._products.popitem(last=False)
+
+    def get(self, product_id):
+        if not product_id or not get_db() or not self.is_known(product_id):
+            return None
+        with self._lock:
+            entry = self._products.get(product_id)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self._products.move_to_end(product_id)
+                return entry[0]
+        try:
+            with timed('product_fetch'):
+                product_data = db.get('productos', product_id)
+        except Exception as e:
+            logger.error(f"Error obteniendo producto {product_id}: {e}")
+            return None
+        with self._lock:
+            self._store(product_id, product_data, time.monotonic())
+        return product_data
+
+    def warm(self):
+        """Carga toda la colección de una vez para que el embudo no lea productos en la ruta caliente."""
+        if not get_db():
+            return 0
+        loaded_at = time.monotonic()
+        with timed('product_warm'):
+            products = dict(db.stream('productos'))
+        with self._lock:
+            self._products.clear()
+            for product_id, product_data in products.items():
+                self._store(product_id, product_data, loaded_at)
+            self._set_ids(products, loaded_at)
+            self.version += 1
+        logger.info(f"✅ Caché de productos cargada ({len(products)} productos, versión {self.version}).")
+        return len(products)
+
+    def invalidate(self, product_id=None):
+        with self._lock:
+            if product_id is None:
+                self._products.clear()
+                self._ids_loaded_at = 0.0  # el próximo uso refresca el índice
+            else:
+                self._products.pop(product_id, None)
+                if self._ids is not None:
+                    # Puede ser un producto recién creado: se admite hasta el próximo refresco del índice
+                    self._set_ids(self._ids | {product_id}, self._ids_loaded_at)
+            self.version += 1
+
+product_cache = ProductCache(PRODUCT_CACHE_MAX, PRODUCT_CACHE_TTL, PRODUCT_INDEX_TTL)
+
+def get_config_product_ids():
+    """Ids de producto que nombra la configuración (catálogo y anuncio principal)."""
+    def build():
+        ids = {info.get('product_id') for info in CATALOGO_PRODUCTOS.values() if isinstance(info, dict)}
+        ids.add(CAMPAIGNS_CONFIG.get('anuncio_principal', {}).get('producto_id'))
+        ids.discard(None)
+        return frozenset(ids)
+    return derived_from_config('config_product_ids', build)
+
+def get_product(product_id):
+    return product_cache.get(product_id)
+
+class MessageDeduplicator:
+    """LRU en memoria con TTL para los ids de mensaje, respaldado por una marca en Firestore entre instancias.
+    La marca nace 'en_proceso' con una reserva corta y pasa a 'procesado' cuando el turno terminó y su sesión
+    quedó guardada; si el turno falla se borra. Así un reenvío de Meta solo se descarta si el mensaje ya se
+    procesó o si otra instancia lo está procesando ahora mismo."""
+    COLLECTION = 'mensajes_procesados'
+
+    def __init__(self, max_size, ttl_seconds, lease_seconds):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.lease = lease_seconds
+        self._seen = OrderedDict()
+        self._claimed = set()  # ids cuya marca en Firestore reservó esta instancia y aún no se cerró
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _doc_id(message_id):
+        return message_id.replace('/', '_')
+
+    def _seen_locally(self, message_id):
+        now = time.monotonic()
+        with self._lock:
+            seen_at = self._seen.get(message_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen.move_to_end(message_id)
+                return True
+            self._seen[message_id] = now
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def _claim(self, doc_id):
+        """Reserva la marca del mensaje. False si ya se procesó o si otra instancia tiene la reserva vigente."""
+        now = datetime.now(timezone.utc)
+        marker = {'estado': 'en_proceso', 'reservado_hasta': now + timedelta(seconds=self.lease),
+                  'expires_at': now + timedelta(seconds=self.ttl)}
+        # create() falla si el documento ya existe: una sola escritura decide quién procesa el mensaje.
+        if db.create(self.COLLECTION, doc_id, marker):
+            return True
+        stored = db.get_all(self.COLLECTION, [doc_id]).get(doc_id)
+        if stored is None:
+            return db.create(self.COLLECTION, doc_id, marker)
+        # Las marcas anteriores a este esquema no tienen estado: esos mensajes ya se procesaron
+        if stored.data.get('estado', 'procesado') == 'procesado':
+            return False
+        reserved_until = stored.data.get('reservado_hasta')
+        if reserved_until is not None and reserved_until.tzinfo is None:
+            reserved_until = reserved_until.replace(tzinfo=timezone.utc)
+        if reserved_until is not None and reserved_until > now:
+            return False
+        # La instancia que lo reservó no terminó: se retoma con una escritura condicional
+        return db.update_if_unchanged(self.COLLECTION, doc_id, stored.version, marker)
+
+    def is_duplicate(self, message_id):
+        if not message_id:
+            return False
+        if self._seen_locally(message_id):
+            return True
+        if not get_db():
+            return False
+        try:
+            if not self._claim(self._doc_id(message_id)):
+                return True
+            with self._lock:
+                self._claimed.add(message_id)
+        except Exception as e:
+            # Si Firestore falla preferimos procesar el mensaje antes que perderlo.
+            logger.warning(f"No se pudo registrar el mensaje {message_id}: {e}")
+        return False
+
+    def mark_processed(self, message_ids):
+        """Cierra las marcas que reservó esta instancia: el mensaje ya no se vuelve a procesar."""
+        with self._lock:
+            ids = [message_id for message_id in message_ids if message_id in self._claimed]
+            self._claimed.difference_update(ids)
+        if not ids:
+            return
+        try:
+            db.commit([('set', self.COLLECTION, self._doc_id(message_id), {'estado': 'procesado'}, True) for message_id in ids])
+        except Exception as e:
+            # La reserva vencerá sola; en el peor caso un reenvío se procesa dos veces
+            logger.warning(f"No se pudieron cerrar las marcas de {ids}: {e}")
+
+    def release(self, message_ids):
+        """Olvida los mensajes cuyo turno falló, en memoria y en Firestore, para que su reenvío se procese."""
+        with self._lock:
+            for message_id in message_ids:
+                self._seen.pop(message_id, None)
+            ids = [message_id for message_id in message_ids if message_id in self._claimed]
+            self._claimed.difference_update(ids)
+        if not ids:
+            return
+        try:
+            db.commit([('delete', self.COLLECTION, self._doc_id(message_id)) for message_id in ids])
+        except Exception as e:
+            logger.warning(f"No se pudieron liberar las marcas de {ids}: {e}")
+
+message_deduplicator = MessageDeduplicator(MESSAGE_DEDUP_MAX, MESSAGE_DEDUP_TTL, MESSAGE_DEDUP_LEASE)
 
 # Reemplaza tu función original con esta
-def save_completed_sale_and_customer(session_data):
-    if not db: return False, None
+@timed('sale_commit')
+def save_completed_sale_and_customer(session_data, next_session=None):
+    """Registra la venta, actualiza al cliente y guarda (o borra, si next_session es None) la sesión
+    en un único batch de Firestore: un solo viaje de red y la venta nunca queda a medias.
+    En el mismo batch van las entradas del outbox (hoja y aviso al administrador), que se procesan después.
+    Si las sesiones viven en otro almacenamiento (SESSION_STORAGE_BACKEND), la sesión se escribe después."""
+    if not get_db(): return False, None
     try:
         # --- INICIO DE LA CORRECCIÓN ---
         # Define la zona horaria de Perú (UTC-5)
@@ -197,17 +2233,31 @@ def save_completed_sale_and_customer(session_data):
             "cliente_id": customer_id, "estado_pedido": "Adelanto Pagado",
             "adelanto_recibido": adelanto, "saldo_restante": precio_total - adelanto
         }
-        db.collection('ventas').document(sale_id).set(sale_data)
-        logger.info(f"Venta {sale_id} guardada.")
-        
         customer_data = {
             "nombre_perfil_wa": session_data.get('user_name'),
             "provincia_ultimo_envio": session_data.get('provincia'), "distrito_ultimo_envio": session_data.get('distrito'),
-            "detalles_ultimo_envio": session_data.get('detalles_cliente'), "total_compras": firestore.Increment(1),
+            "detalles_ultimo_envio": session_data.get('detalles_cliente'), "total_compras": Increment(1),
             "fecha_ultima_compra": now_in_peru # <-- CAMBIO 2: Usamos la hora de Perú
         }
-        db.collection('clientes').document(customer_id).set(customer_data, merge=True)
-        logger.info(f"Cliente {customer_id} creado/actualizado.")
+        outbox = outbox_writes(sale_data)
+        writes = [('set', 'ventas', sale_id, sale_data, False), ('set', 'clientes', customer_id, customer_data, True), *outbox]
+        if next_session is None:
+            session_write = ('delete', 'sessions', customer_id)
+        else:
+            next_session = {**next_session, 'expires_at': datetime.now(timezone.utc) + SESSION_TTL, 'revision': new_session_revision()}
+            session_write = ('set', 'sessions', customer_id, {**next_session, 'last_updated': SERVER_TIMESTAMP}, True)
+        session_storage = get_session_store()
+        if session_storage is db:
+            writes.append(session_write)
+        db.commit(writes)
+        if session_storage is not db:
+            session_storage.commit([session_write])
+        # La sesión ya quedó escrita en el batch: se descarta cualquier escritura diferida pendiente
+        session_cache.mark_persisted(customer_id, next_session)
+        if batch := current_session_batch(customer_id):
+            batch.persisted(next_session)
+        outbox_drainer.schedule(new_entries=len(outbox))
+        logger.info(f"Venta {sale_id} guardada y cliente {customer_id} creado/actualizado.")
         return True, sale_data
     except Exception as e:
         logger.error(f"Error guardando venta y cliente: {e}")
@@ -219,25 +2269,73 @@ def save_completed_sale_and_customer(session_data):
 def strip_accents(text):
     return ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
 
+_DISTRICT_FILLERS = re.compile(r'\b(?:soy de|vivo en|estoy en|es en|mi distrito es|el distrito es)\b|^de\b')
+
+def normalize_district_text(text):
+    """Minúsculas, sin tildes, sin signos de puntuación y con espacios simples."""
+    return ' '.join(re.sub(r'[^a-z0-9 ]', ' ', strip_accents(text.lower())).split())
+
+class DistrictIndex:
+    """Índice de distritos precalculado por versión de BUSINESS_RULES: nombres normalizados, abreviaturas,
+    prefijos de cada palabra y candidatos para errores de tipeo. Las búsquedas no recorren las listas."""
+    def __init__(self, business_rules):
+        self._by_name = {}  # nombre normalizado -> (nombre canónico, clase de cobertura, prioridad)
+        self._by_prefix = {}  # prefijo de palabra -> nombres normalizados que la contienen
+        self._by_initial = {}  # primera letra -> nombres normalizados (candidatos difusos)
+        # Un distrito que figura en ambas listas cuenta como CON_COBERTURA
+        for status, key in (('CON_COBERTURA', 'distritos_cobertura_delivery'), ('SIN_COBERTURA', 'distritos_lima_total')):
+            for district in business_rules.get(key, []):
+                name = normalize_district_text(district)
+                if not name or name in self._by_name:
+                    continue
+                self._by_name[name] = (district.title(), status, len(self._by_name))
+                for token in name.split():
+                    for end in range(1, len(token) + 1):
+                        self._by_prefix.setdefault(token[:end], set()).add(name)
+                self._by_initial.setdefault(name[0], []).append(name)
+        self._abbreviations = {}
+        for abbr, full_name in business_rules.get('abreviaturas_distritos', {}).items():
+            if (abbr_norm := normalize_district_text(abbr)) and (full_norm := normalize_district_text(full_name)):
+                self._abbreviations[abbr_norm] = full_norm
+        alternatives = '|'.join(re.escape(abbr) for abbr in sorted(self._abbreviations, key=len, reverse=True))
+        self._abbr_pattern = re.compile(rf'\b(?:{alternatives})\b') if alternatives else None
+
+    def _result(self, name):
+        canonical, status, _ = self._by_name[name]
+        return canonical, status
+
+    def lookup(self, text):
+        """Devuelve (distrito canónico, 'CON_COBERTURA' | 'SIN_COBERTURA') o (None, 'NO_ENCONTRADO')."""
+        query = ' '.join(_DISTRICT_FILLERS.sub(' ', normalize_district_text(text)).split())
+        if not query:
+            return None, 'NO_ENCONTRADO'
+        if self._abbr_pattern and (match := self._abbr_pattern.search(query)):
+            query = self._abbreviations[match.group(0)]
+        if query in self._by_name:
+            return self._result(query)
+        # Coincidencia parcial: cada palabra escrita debe ser prefijo de una palabra del distrito
+        candidates = None
+        for token in query.split():
+            names = self._by_prefix.get(token)
+            if not names:
+                candidates = None
+                break
+            candidates = names if candidates is None else candidates & names
+        if candidates:
+            matches = [name for name in candidates if query in name]
+            if matches:
+                return self._result(min(matches, key=lambda name: self._by_name[name][2]))
+        # Errores de tipeo: se compara solo con los distritos que empiezan con la misma letra
+        close = difflib.get_close_matches(query, self._by_initial.get(query[0], []), n=1, cutoff=0.8)
+        if close:
+            return self._result(close[0])
+        return None, 'NO_ENCONTRADO'
+
+def get_district_index():
+    return derived_from_config('district_index', lambda: DistrictIndex(BUSINESS_RULES))
+
 def normalize_and_check_district(text):
-    clean_text = re.sub(r'soy de|vivo en|estoy en|es en|de', '', text, flags=re.IGNORECASE).strip()
-    normalized_input = strip_accents(clean_text.lower())
-    
-    abreviaturas = BUSINESS_RULES.get('abreviaturas_distritos', {})
-    for abbr, full_name in abreviaturas.items():
-        if abbr in normalized_input:
-            normalized_input = strip_accents(full_name.lower())
-            break
-            
-    distritos_cobertura = BUSINESS_RULES.get('distritos_cobertura_delivery', [])
-    if any(normalized_input in strip_accents(d.lower()) for d in distritos_cobertura):
-        return next((d.title() for d in distritos_cobertura if normalized_input in strip_accents(d.lower())), None), 'CON_COBERTURA'
-        
-    distritos_totales = BUSINESS_RULES.get('distritos_lima_total', [])
-    if any(normalized_input in strip_accents(d.lower()) for d in distritos_totales):
-        return next((d.title() for d in distritos_totales if normalized_input in strip_accents(d.lower())), None), 'SIN_COBERTURA'
-        
-    return None, 'NO_ENCONTRADO'
+    return get_district_index().lookup(text)
 
 def parse_province_district(text):
     clean_text = re.sub(r'soy de|vivo en|mi ciudad es|el distrito es', '', text, flags=re.IGNORECASE).strip()
@@ -256,70 +2354,372 @@ def get_delivery_day_message():
     # La lógica se mantiene, pero ahora usa la hora correcta de Perú
     return BUSINESS_RULES.get('mensaje_dia_habil', 'mañana') if now_in_peru.weekday() < 4 else BUSINESS_RULES.get('mensaje_fin_de_semana', 'el Lunes')
 
+def normalize_text(text):
+    return strip_accents(text.lower())
+
+class KeywordMatcher:
+    """Autómata Aho-Corasick sobre palabras clave normalizadas (minúsculas, sin tildes).
+    Encuentra todas las claves presentes en una sola pasada por el texto."""
+    def __init__(self, keyword_map, priority=()):
+        order = {key: idx for idx, key in enumerate(priority)}
+        # Orden determinista: primero la prioridad configurada, luego alfabético
+        self._rank = {key: (order.get(key, len(order)), key) for key in keyword_map}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [frozenset()]
+        for key, keywords in keyword_map.items():
+            for keyword in keywords:
+                if normalized := normalize_text(keyword):
+                    self._add(normalized, key)
+        self._build()
+
+    def _add(self, word, key):
+        node = 0
+        for char in word:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(frozenset())
+            node = next_node
+        self._out[node] = self._out[node] | {key}
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_node] = self._goto[fail].get(char, 0)
+                self._out[next_node] = self._out[next_node] | self._out[self._fail[next_node]]
+
+    def match(self, text):
+        """Devuelve las claves encontradas en el texto, ordenadas por prioridad."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        found = set()
+        for char in normalize_text(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found |= out[node]
+        return sorted(found, key=self._rank.__getitem__)
+
+def get_faq_matcher():
+    general = CONFIG_SNAPSHOT['docs'].get('configuracion_general') or {}
+    return derived_from_config('faq_matcher', lambda: KeywordMatcher(FAQ_KEYWORD_MAP, general.get('faq_prioridad', [])))
+
+LIST_MAX_ROWS = 10  # límites de WhatsApp para mensajes de lista
+LIST_TITLE_MAX = 24
+LIST_DESCRIPTION_MAX = 72
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+class MenuIndex:
+    """Menú compilado una vez por versión de configuración: orden estable, elección en O(1) por número escrito
+    o por id de fila, y el mensaje ya armado (lista interactiva, o texto numerado si no cabe en una lista)."""
+    def __init__(self, entries, intro, button_text):
+        # entries: lista ordenada de (número, id de fila, título, valor)
+        self._choices = {row_id: value for _, row_id, _, value in entries}
+        # Lo escrito a mano tiene prioridad sobre un id de fila igual
+        self._choices.update({str(number): value for number, _, _, value in entries})
+        self.empty = not entries
+        if entries and len(entries) <= LIST_MAX_ROWS:
+            rows = [{'id': row_id, 'title': _truncate(title, LIST_TITLE_MAX),
+                     'description': _truncate(title, LIST_DESCRIPTION_MAX) if len(title) > LIST_TITLE_MAX else None}
+                    for _, row_id, title, _ in entries]
+            self.payload = PreparedPayload(list_payload(intro, button_text, rows))
+        else:
+            listado = "\n".join(f"{number}️⃣ {title}" for number, _, title, _ in entries)
+            self.payload = PreparedPayload(text_payload(f"{intro}\n\n{listado}"))
+
+    def choose(self, text):
+        return self._choices.get(text.strip())
+
+def get_catalog_menu():
+    """Catálogo en el orden de sus claves; las filas van con el id del producto.
+    WhatsApp rechaza la lista entera si una fila no tiene título: sin 'nombre' se muestra el id."""
+    def build():
+        items = [info for _, info in sorted(CATALOGO_PRODUCTOS.items()) if isinstance(info, dict) and info.get('product_id')]
+        entries = [(idx, info['product_id'], info.get('nombre') or info['product_id'], info['product_id']) for idx, info in enumerate(items, 1)]
+        return MenuIndex(entries, "¡Genial! Estas son nuestras colecciones. Elige una para ver detalles:", "Ver colecciones")
+    return derived_from_config('catalog_menu', build)
+
+def get_faq_menu():
+    """Menú de preguntas frecuentes, numerado con las claves de MENU_FAQ."""
+    def build():
+        entries = [(key, f"faq_{key}", info.get('pregunta') or f"Pregunta {key}", info) for key, info in sorted(MENU_FAQ.items()) if isinstance(info, dict)]
+        return MenuIndex(entries, "¡Claro! Nuestras dudas más comunes. Elige una para ver la respuesta:", "Ver preguntas")
+    return derived_from_config('faq_menu', build)
+
+def find_faq_matches(text):
+    return get_faq_matcher().match(text)
+
 def check_and_handle_faq(from_number, text):
-    text_lower = text.lower()
-    for key, keywords in FAQ_KEYWORD_MAP.items():
-        if any(keyword in text_lower for keyword in keywords):
-            response_text = FAQ_RESPONSES.get(key)
-            if response_text:
-                send_text_message(from_number, response_text)
-                return True
+    # Filtro de interrupciones compartido por todos los handlers
+    for key in find_faq_matches(text):
+        response_text = FAQ_RESPONSES.get(key)
+        if response_text:
+            send_text_message(from_number, response_text)
+            return True
     return False
 
-# Reemplaza la función en tu archivo con esta versión final y definitiva
-def guardar_pedido_en_sheet(sale_data):
-    if not worksheet_pedidos:
-        logger.error("[Sheets] La conexión no está inicializada.")
-        return False
-    try:
-        peru_tz = timezone(timedelta(hours=-5))
-        timestamp_peru = datetime.now(peru_tz).strftime("%d/%m/%Y %H:%M:%S")
-        
-        nueva_fila = [
-            timestamp_peru,
-            sale_data.get('id_venta', 'N/A'),
-            sale_data.get('producto_nombre', 'N/A'),
-            sale_data.get('precio_venta', 0),
-            sale_data.get('tipo_envio', 'N/A'),
-            sale_data.get('metodo_pago', 'N/A'),
-            sale_data.get('adelanto_recibido', 0),
-            sale_data.get('saldo_restante', 0),
-            sale_data.get('provincia', 'N/A'),
-            sale_data.get('distrito', 'N/A'),
-            sale_data.get('detalles_cliente', 'N/A'),
-            sale_data.get('cliente_id', 'N/A')
-        ]
-        
-        # --- INICIO DE LA CORRECCIÓN ---
-        # 1. Encontrar la primera fila vacía
-        columna_a = worksheet_pedidos.col_values(1)
-        indice_fila_vacia = len(columna_a) + 1
-        
-        # 2. Definir el rango a actualizar (Ej: "A2:L2")
-        letra_ultima_columna = chr(ord('A') + len(nueva_fila) - 1)
-        rango_a_actualizar = f"A{indice_fila_vacia}:{letra_ultima_columna}{indice_fila_vacia}"
-        
-        # 3. Actualizar el rango con los datos, sin insertar ni mover filas
-        worksheet_pedidos.update(rango_a_actualizar, [nueva_fila])
-        # --- FIN DE LA CORRECCIÓN ---
+class SheetsOrderExporter:
+    """Escribe lotes de pedidos en la hoja 'Pedidos' con un solo append.
+    La siguiente fila libre se lleva en memoria: la columna A solo se lee una vez por instancia."""
+    ID_COLUMN = 2  # columna B: id_venta
+
+    def __init__(self):
+        self._next_row = None
+        self._lock = threading.Lock()
+
+    def _already_written(self, worksheet):
+        """Ids de venta escritos desde la última fila conocida, para no duplicar filas al reintentar."""
+        if self._next_row is None:
+            return set(worksheet.col_values(self.ID_COLUMN))
+        column = chr(ord('A') + self.ID_COLUMN - 1)
+        return {cells[0] for cells in worksheet.get(f"{column}{self._next_row}:{column}") if cells}
+
+    @timed('sheets_flush')
+    def write(self, rows, verify=False):
+        """Escribe las filas y devuelve los ids de venta que NO quedaron en la hoja (vacío si todo salió bien).
+        Con verify=True antes se descartan las filas cuyo id ya está en la hoja, para que un reintento no duplique."""
+        with self._lock:
+            worksheet = get_worksheet_pedidos()
+            if not worksheet:
+                logger.error("[Sheets] La conexión no está inicializada.")
+                return {row[self.ID_COLUMN - 1] for row in rows}
+            try:
+                if verify:
+                    written = set(worksheet.col_values(self.ID_COLUMN))
+                    rows = [row for row in rows if row[self.ID_COLUMN - 1] not in written]
+                    if not rows:
+                        return set()
+                if self._next_row is None:
+                    self._next_row = len(worksheet.col_values(1)) + 1
+                # OVERWRITE escribe en las filas vacías sin insertar ni mover filas; el append es atómico en la API,
+                # así que dos instancias no pueden pisarse la misma fila.
+                response = worksheet.append_rows(rows, insert_data_option='OVERWRITE', table_range=f"A{self._next_row}")
+                updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+                if match := re.search(r'[A-Z]+(\d+)$', updated_range):
+                    self._next_row = int(match.group(1)) + 1
+                else:
+                    self._next_row += len(rows)
+                logger.info(f"[Sheets] {len(rows)} pedido(s) guardados ({updated_range or 'rango desconocido'}).")
+                return set()
+            except Exception as e:
+                logger.error(f"[Sheets] ERROR INESPERADO al guardar el lote: {e}")
+                record_error('sheets_flush')
+                pending = {row[self.ID_COLUMN - 1] for row in rows}
+                try:
+                    # El append pudo haberse aplicado aunque la respuesta fallara
+                    pending -= self._already_written(worksheet)
+                    self._next_row = None
+                except Exception as check_error:
+                    logger.error(f"[Sheets] No se pudo verificar el lote fallido: {check_error}")
+                return pending
+
+sheets_exporter = SheetsOrderExporter()
+
+def fila_pedido(sale_data):
+    """Fila de la hoja 'Pedidos' para una venta (la fecha es la de la venta, no la de la escritura)."""
+    peru_tz = timezone(timedelta(hours=-5))
+    fecha = sale_data.get('fecha') or datetime.now(peru_tz)
+    return [
+        fecha.astimezone(peru_tz).strftime("%d/%m/%Y %H:%M:%S"),
+        sale_data.get('id_venta', 'N/A'),
+        sale_data.get('producto_nombre', 'N/A'),
+        sale_data.get('precio_venta', 0),
+        sale_data.get('tipo_envio', 'N/A'),
+        sale_data.get('metodo_pago', 'N/A'),
+        sale_data.get('adelanto_recibido', 0),
+        sale_data.get('saldo_restante', 0),
+        sale_data.get('provincia', 'N/A'),
+        sale_data.get('distrito', 'N/A'),
+        sale_data.get('detalles_cliente', 'N/A'),
+        sale_data.get('cliente_id', 'N/A')
+    ]
 
-        logger.info(f"[Sheets] Pedido {sale_data.get('id_venta')} guardado en la fila {indice_fila_vacia}.")
-        return True
-    except Exception as e:
-        logger.error(f"[Sheets] ERROR INESPERADO al guardar: {e}")
-        return False
+def guardar_pedidos_en_sheet(entries):
+    """Handler del outbox: las ventas del lote van en un solo append. Idempotente por id_venta."""
+    rows = [fila_pedido(data['venta']) for _, data in entries]
+    # Una entrada ya reclamada pudo escribirse antes de que su instancia fallara: se verifica la hoja
+    failed = sheets_exporter.write(rows, verify=any(data.get('reclamado') for _, data in entries))
+    return {entry_id for entry_id, data in entries if data['id_venta'] not in failed}
+
+def avisar_venta_al_admin(entries):
+    """Handler del outbox: un mensaje al administrador por venta."""
+    done = set()
+    for entry_id, data in entries:
+        sale_data = data['venta']
+        admin_message = (f"🎉 ¡Nueva Venta Confirmada! 🎉\n"
+                         f"Producto: {sale_data.get('producto_nombre')}\nTipo: {sale_data.get('tipo_envio')}\n"
+                         f"Cliente: {sale_data.get('cliente_id')}\nDetalles:\n{sale_data.get('detalles_cliente')}")
+        if deliver_whatsapp_message(data['para'], text_payload(admin_message)):
+            done.add(entry_id)
+    return done
+
+OUTBOX_COLLECTION = 'outbox'
+OUTBOX_HANDLERS = {'pedido_sheet': guardar_pedidos_en_sheet, 'aviso_admin': avisar_venta_al_admin}
+
+def outbox_writes(sale_data):
+    """Entradas del outbox de una venta, para el mismo commit que la venta. El id (id_venta + tipo) las hace únicas."""
+    entries = {'pedido_sheet': {}}
+    if ADMIN_WHATSAPP_NUMBER:
+        entries['aviso_admin'] = {'para': ADMIN_WHATSAPP_NUMBER}
+    now = datetime.now(timezone.utc)
+    return [('set', OUTBOX_COLLECTION, f"{sale_data['id_venta']}_{tipo}",
+             {**extra, 'tipo': tipo, 'id_venta': sale_data['id_venta'], 'venta': sale_data, 'estado': 'pendiente',
+              'intentos': 0, 'proximo_intento': now, 'creado': SERVER_TIMESTAMP}, False)
+            for tipo, extra in entries.items()]
+
+class OutboxDrainer:
+    """Procesa en segundo plano las entradas vencidas del outbox (proximo_intento < ahora), agrupadas por tipo.
+    Cada entrada se reclama con una escritura condicional (update_if_unchanged sobre la versión leída) que mueve
+    proximo_intento a ahora + lease: si dos instancias leen la misma entrada, solo una gana el reclamo y solo esa
+    la procesa. Si la ganadora muere a mitad, la entrada vuelve a estar lista al vencer el plazo.
+    Las que agotan los intentos quedan 'fallido' hasta que se reenvían con replay()."""
+    def __init__(self, handlers, batch_size, max_attempts, backoff, lease, delay, check_interval):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = timedelta(seconds=lease)
+        self.delay = delay
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._scheduled = False
+        self._last_drain = time.monotonic()
+        self._pending = 0  # entradas que esta instancia sabe pendientes
+
+    def schedule(self, delay=None, new_entries=1):
+        with self._lock:
+            self._pending += new_entries
+            if not self._scheduled:
+                self._scheduled = True
+                delay_scheduler.call_later(self.delay if delay is None else delay, self._run)
+
+    def maybe_schedule(self):
+        """Llamado desde el webhook: como mucho cada check_interval, drena lo que otras instancias dejaron."""
+        if time.monotonic() - self._last_drain >= self.check_interval:
+            self._last_drain = time.monotonic()
+            self.schedule(new_entries=0)
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def _run(self):
+        with self._lock:
+            self._scheduled = False
+        with metrics_handler('outbox'):
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"[Outbox] Error procesando el outbox: {e}")
+                record_error('outbox_drain')
+
+    def _process(self, tipo, group):
+        if (handler := self.handlers.get(tipo)) is None:
+            return set(), f"Tipo desconocido: {tipo}"
+        try:
+            return handler(group), None
+        except Exception as e:
+            logger.error(f"[Outbox] Error en '{tipo}': {e}")
+            return set(), str(e)
+
+    @timed('outbox_drain')
+    def drain(self):
+        """Procesa un lote de entradas vencidas. Devuelve cuántas quedaron hechas, para reintento y fallidas."""
+        result = {'hechas': 0, 'reintento': 0, 'fallidas': 0}
+        if not get_db():
+            return result
+        with self._drain_lock:
+            self._last_drain = time.monotonic()
+            now = datetime.now(timezone.utc)
+            ids = db.ids_where_less(OUTBOX_COLLECTION, 'proximo_intento', now, self.batch_size)
+            stored = db.get_all(OUTBOX_COLLECTION, ids) if ids else {}
+            claim = {'proximo_intento': now + self.lease, 'reclamado': True}
+            # Solo se procesan las entradas que siguen vencidas al releerlas y cuyo reclamo ganó esta instancia
+            entries = {entry_id: doc.data for entry_id, doc in stored.items()
+                       if doc.data.get('estado') == 'pendiente' and doc.data.get('proximo_intento') is not None
+                       and doc.data['proximo_intento'] < now
+                       and db.update_if_unchanged(OUTBOX_COLLECTION, entry_id, doc.version, claim)}
+            if not entries:
+                with self._lock:
+                    self._pending = 0
+                return result
+            groups = {}
+            for entry_id, data in entries.items():
+                groups.setdefault(data.get('tipo'), []).append((entry_id, data))
+            writes, retry_in = [], None
+            for tipo, group in groups.items():
+                done, error = self._process(tipo, group)
+                now = datetime.now(timezone.utc)
+                for entry_id, data in group:
+                    if entry_id in done:
+                        update = {'estado': 'hecho', 'proximo_intento': DELETE_FIELD, 'ultimo_error': DELETE_FIELD,
+                                  'procesado': SERVER_TIMESTAMP, 'expires_at': now + OUTBOX_RETENTION}
+                        result['hechas'] += 1
+                    else:
+                        attempts = data.get('intentos', 0) + 1
+                        update = {'intentos': attempts, 'ultimo_error': error or 'No se completó'}
+                        if attempts >= self.max_attempts:
+                            update.update(estado='fallido', proximo_intento=DELETE_FIELD)
+                            logger.error(f"[Outbox] {entry_id} falló {attempts} veces; queda para /api/outbox/replay.")
+                            result['fallidas'] += 1
+                        else:
+                            wait = self.backoff * 2 ** (attempts - 1)
+                            update['proximo_intento'] = now + timedelta(seconds=wait)
+                            retry_in = wait if retry_in is None else min(retry_in, wait)
+                            result['reintento'] += 1
+                    metrics.inc('bot_outbox_total', tipo=tipo or 'desconocido', estado=update.get('estado', 'reintento'))
+                    writes.append(('set', OUTBOX_COLLECTION, entry_id, update, True))
+            db.commit(writes)
+            with self._lock:
+                self._pending = result['reintento']
+            logger.info(f"[Outbox] Lote procesado: {result}")
+        if len(ids) >= self.batch_size:
+            self.schedule(0, new_entries=0)
+        elif retry_in is not None:
+            self.schedule(retry_in, new_entries=0)
+        return result
+
+    def replay(self, entry_ids=None, limit=None):
+        """Vuelve a dejar pendientes (con los intentos en cero) las entradas indicadas, o las fallidas si no se indica
+        ninguna. Las ya hechas no se tocan. Devuelve los ids reencolados."""
+        if not get_db():
+            return []
+        if entry_ids is None:
+            entry_ids = db.ids_where_equal(OUTBOX_COLLECTION, 'estado', 'fallido', limit or self.batch_size)
+        stored = db.get_all(OUTBOX_COLLECTION, entry_ids) if entry_ids else {}
+        ids = [entry_id for entry_id, doc in stored.items() if doc.data.get('estado') != 'hecho']
+        now = datetime.now(timezone.utc)
+        if ids:
+            db.commit([('set', OUTBOX_COLLECTION, entry_id, {'estado': 'pendiente', 'intentos': 0, 'proximo_intento': now}, True)
+                       for entry_id in ids])
+        return ids
+
+outbox_drainer = OutboxDrainer(OUTBOX_HANDLERS, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BACKOFF,
+                               OUTBOX_LEASE, OUTBOX_DRAIN_DELAY, OUTBOX_CHECK_INTERVAL)
 
 # ==============================================================================
 # 6. LÓGICA DE LA CONVERSACIÓN - ETAPA INICIAL
 # ==============================================================================
 def start_sales_flow(from_number, user_name, product_id):
     """Inicia un flujo de venta: guarda la sesión y envía el mensaje de bienvenida."""
-    product_doc = db.collection('productos').document(product_id).get()
-    if not product_doc.exists:
+    product_data = get_product(product_id)
+    if not product_data:
         send_text_message(from_number, "Lo siento, hubo un problema al cargar la información del producto.")
         return
-        
-    product_data = product_doc.to_dict()
     
     # Paso 1: Guardar la sesión y establecer el estado para esperar la respuesta
     session_data = {
@@ -337,30 +2737,16 @@ def start_sales_flow(from_number, user_name, product_id):
     url_img = product_data.get('imagenes', {}).get('principal')
     if url_img:
         send_image_message(from_number, url_img)
-        time.sleep(1)
     
     # Paso 3: Enviar el nuevo mensaje de bienvenida para iniciar la conversación
-    send_welcome_message(from_number, user_name)
+    send_welcome_message(from_number, user_name, delay=1 if url_img else 0)
 
-def send_welcome_message(from_number, user_name):
+def send_welcome_message(from_number, user_name, delay=0):
     """Envía el mensaje de bienvenida persuasivo y luego la pregunta con botones."""
-    welcome_text = (
-        f"¡Hola {user_name}! Estás a punto de descubrir el *secreto* del Collar Mágico Girasol Radiant. 🤫✨\n"
-        "No es solo una joya, es una pieza que *se conecta contigo*, cambiando de color para reflejar tu propia energía. 💖\n"
-        "Debido a su diseño único, tenemos *pocas unidades disponibles* en esta campaña. ⚠️\n"
-        "Puedes llevarte la tuya por *S/ 69.00* (incluye *envío gratis* a todo el Perú 🇵🇪🚚)."
-    )
     # Primero enviamos el texto principal
-    send_text_message(from_number, welcome_text)
-    time.sleep(1.5) # Pausa para que el texto y los botones no lleguen juntos
-    
-    # Luego, enviamos la pregunta con los botones
-    question_text = "¿Esta *magia* es para ti o para sorprender a alguien especial? 🎁"
-    botones = [
-        {'id': 'es_regalo', 'title': '🎁 Es para un regalo'},
-        {'id': 'es_para_mi', 'title': '💖 Es para mí'}
-    ]
-    send_interactive_message(from_number, question_text, botones)
+    send_template(from_number, 'bienvenida_producto', delay=delay, user_name=user_name)
+    # Luego, enviamos la pregunta con los botones (con pausa para que no lleguen juntos)
+    send_template(from_number, 'pregunta_ocasion', delay=1.5)
 
 def handle_initial_message(from_number, user_name, text):
     # --- LÓGICA MEJORADA: LEE LA CONFIGURACIÓN DESDE FIREBASE ---
@@ -375,13 +2761,10 @@ def handle_initial_message(from_number, user_name, text):
         return
 
     # 2. Revisa si es un ID de producto (del menú del catálogo)
-    try:
-        if db.collection('productos').document(text).get().exists:
-            logger.info(f"ID de producto del catálogo detectado: {text}")
-            start_sales_flow(from_number, user_name, text)
-            return
-    except Exception:
-        pass 
+    if get_product(text):
+        logger.info(f"ID de producto del catálogo detectado: {text}")
+        start_sales_flow(from_number, user_name, text)
+        return
     
     # 3. Revisa si es una pregunta frecuente (FAQ)
     if check_and_handle_faq(from_number, text):
@@ -390,8 +2773,7 @@ def handle_initial_message(from_number, user_name, text):
     # 4. Si no, muestra el menú principal
     if MENU_PRINCIPAL:
         welcome_message = MENU_PRINCIPAL.get('mensaje_bienvenida', '¡Hola! ¿Cómo puedo ayudarte?')
-        botones = [{'id': '1', 'title': '🛍️ Ver Colección'}, {'id': '2', 'title': '❓ Preguntas'}]
-        send_interactive_message(from_number, welcome_message, botones)
+        send_template(from_number, 'menu_principal', mensaje_bienvenida=welcome_message)
         save_session(from_number, {"state": "awaiting_menu_choice", "user_name": user_name, "whatsapp_id": from_number})
     else:
         send_text_message(from_number, f"¡Hola {user_name}! 👋🏽✨ Bienvenida a *Daaqui Joyas*.")
@@ -399,19 +2781,15 @@ def handle_initial_message(from_number, user_name, text):
 def handle_menu_choice(from_number, text, session, product_data):
     choice = text.strip()
     if choice == '1':
-        if CATALOGO_PRODUCTOS:
-            mensaje = "¡Genial! Estas son nuestras colecciones. Elige una para ver detalles:"
-            catalogo_texto = "\n".join([f"{idx}️⃣ {v.get('nombre', '')}" for idx, (k, v) in enumerate(sorted(CATALOGO_PRODUCTOS.items()), 1)])
-            send_text_message(from_number, f"{mensaje}\n\n{catalogo_texto}")
+        if not (menu := get_catalog_menu()).empty:
+            send_whatsapp_message(from_number, menu.payload)
             session['state'] = 'awaiting_product_choice'
             save_session(from_number, session)
         else:
             send_text_message(from_number, "Lo siento, no pude cargar el catálogo.")
     elif choice == '2':
-        if MENU_FAQ:
-            mensaje = "¡Claro! Nuestras dudas más comunes. Elige una para ver la respuesta:"
-            faq_texto = "\n".join([f"{k}️⃣ {v.get('pregunta', '')}" for k, v in sorted(MENU_FAQ.items())])
-            send_text_message(from_number, f"{mensaje}\n\n{faq_texto}")
+        if not (menu := get_faq_menu()).empty:
+            send_whatsapp_message(from_number, menu.payload)
             session['state'] = 'awaiting_faq_choice'
             save_session(from_number, session)
         else:
@@ -420,18 +2798,13 @@ def handle_menu_choice(from_number, text, session, product_data):
         send_text_message(from_number, "Opción no válida. Elige una del menú.")
 
 def handle_product_choice(from_number, text, session, product_data):
-    choice = text.strip()
-    product_list = sorted(CATALOGO_PRODUCTOS.items())
-    if choice.isdigit() and 0 < int(choice) <= len(product_list):
-        product_info = product_list[int(choice) - 1][1] 
-        if product_id := product_info.get('product_id'):
-            handle_initial_message(from_number, session.get('user_name', 'Usuario'), product_id)
-            return
+    if product_id := get_catalog_menu().choose(text):
+        handle_initial_message(from_number, session.get('user_name', 'Usuario'), product_id)
+        return
     send_text_message(from_number, "Opción no válida. Elige un número del catálogo.")
 
 def handle_faq_choice(from_number, text, session, product_data):
-    choice = text.strip()
-    faq_info = MENU_FAQ.get(choice)
+    faq_info = get_faq_menu().choose(text)
     if faq_info and (clave := faq_info.get('clave_respuesta')):
         respuesta = FAQ_RESPONSES.get(clave, "No encontré una respuesta.")
         send_text_message(from_number, respuesta)
@@ -448,14 +2821,8 @@ def handle_occasion_response(from_number, text, session, product_data):
     if text not in ['es_regalo', 'es_para_mi']:
         # Si no es una opción, intenta manejarla como una FAQ
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5) # Pausa para que el usuario lea la respuesta
             # Vuelve a hacer la pregunta original con los botones
-            question_text = "Espero haber aclarado tu duda. 😊 Continuando... ¿esta magia es para ti o es un regalo?"
-            botones = [
-                {'id': 'es_regalo', 'title': '🎁 Es para un regalo'},
-                {'id': 'es_para_mi', 'title': '💖 Es para mí'}
-            ]
-            send_interactive_message(from_number, question_text, botones)
+            send_template(from_number, 'reprompt_ocasion', delay=1.5)
             return # Detiene la ejecución para esperar la nueva respuesta
         # Si no fue una FAQ, simplemente ignoramos y esperamos una respuesta válida (botón o nueva pregunta)
         # Podríamos opcionalmente reenviar los botones aquí, pero es mejor esperar para no ser spam.
@@ -466,20 +2833,14 @@ def handle_occasion_response(from_number, text, session, product_data):
     url_imagen_empaque = product_data.get('imagenes', {}).get('empaque')
     if url_imagen_empaque:
         send_image_message(from_number, url_imagen_empaque)
-        time.sleep(1)
     
     detalles = product_data.get('detalles', {})
-    mensaje_persuasion_1 = (f"¡Maravillosa elección! ✨ El *{product_data.get('nombre')}* es pura energía. Aquí tienes todos los detalles:\n\n"
-                            f"💎 *Material:* {detalles.get('material', 'alta calidad')}\n"
-                            f"🔮 *La Magia:* {detalles.get('magia', 'una pieza única')}\n"
-                            f"🎁 *Presentación:* {detalles.get('empaque', 'incluye empaque de regalo')}")
-    send_text_message(from_number, mensaje_persuasion_1)
-    time.sleep(1.5)
-    
-    mensaje_persuasion_2 = (f"Para tu total seguridad, somos Daaqui Joyas, un negocio formal con *RUC {RUC_EMPRESA}*. ¡Tu compra es 100% segura! 🇵🇪\n\n"
-                            "¿Te gustaría coordinar tu pedido ahora para asegurar el tuyo?")
-    botones_compra = [{'id': 'si_coordinar', 'title': '✅ Sí, coordinar'}, {'id': 'no_gracias', 'title': 'No, gracias'}]
-    send_interactive_message(from_number, mensaje_persuasion_2, botones_compra)
+    send_template(from_number, 'detalles_producto', delay=1 if url_imagen_empaque else 0,
+                  nombre=product_data.get('nombre'),
+                  material=detalles.get('material', 'alta calidad'),
+                  magia=detalles.get('magia', 'una pieza única'),
+                  empaque=detalles.get('empaque', 'incluye empaque de regalo'))
+    send_template(from_number, 'pregunta_compra', delay=1.5)
     
     # Actualizamos el estado al siguiente paso
     session['state'] = 'awaiting_purchase_decision'
@@ -491,11 +2852,8 @@ def handle_purchase_decision(from_number, text, session, product_data):
     if text not in ['si_coordinar', 'no_gracias']:
         # Si no es una opción, intenta manejarla como una FAQ
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5) # Pausa para que el usuario lea la respuesta de la FAQ
             # Vuelve a hacer la pregunta original con los botones
-            reprompt_message = ("Continuando con tu pedido... 😊\n\n¿Te gustaría coordinar ahora para asegurar el tuyo?")
-            botones = [{'id': 'si_coordinar', 'title': '✅ Sí, coordinar'}, {'id': 'no_gracias', 'title': 'No, gracias'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_compra', delay=1.5)
             return # Detiene la ejecución para esperar la nueva respuesta
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
@@ -503,19 +2861,9 @@ def handle_purchase_decision(from_number, text, session, product_data):
         url_imagen_upsell = product_data.get('imagenes', {}).get('upsell')
         if url_imagen_upsell:
             send_image_message(from_number, url_imagen_upsell)
-            time.sleep(1)
             
-        upsell_message_1 = (f"¡Excelente elección! Pero espera... por decidir llevar tu collar, ¡acabas de desbloquear una oferta exclusiva! ✨\n\n"
-                            "Añade un segundo Collar Mágico y te incluimos de regalo dos cadenas de diseño italiano.\n\n"
-                            "Tu pedido se ampliaría a:\n"
-                            "✨ 2 Collares Mágicos\n🎁 2 Cadenas de Regalo\n🎀 2 Cajitas Premium\n"
-                            "💎 Todo por un único pago de S/ 99.00")
-        send_text_message(from_number, upsell_message_1)
-        time.sleep(1.5)
-        
-        mensaje_decision = "Para continuar con tu pedido, ¿cuál será tu elección?"
-        botones = [{'id': 'oferta', 'title': '🔥 Quiero la oferta'}, {'id': 'continuar', 'title': 'Continuar con uno'}]
-        send_interactive_message(from_number, mensaje_decision, botones)
+        send_template(from_number, 'oferta_upsell', delay=1 if url_imagen_upsell else 0)
+        send_template(from_number, 'pregunta_upsell', delay=1.5)
         session['state'] = 'awaiting_upsell_decision'
         save_session(from_number, session)
     else: # Esto ahora solo se activará si el cliente presiona 'No, gracias'
@@ -526,10 +2874,7 @@ def handle_upsell_decision(from_number, text, session, product_data):
     # (El filtro inteligente para interrupciones se mantiene igual)
     if text not in ['oferta', 'continuar']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
-            reprompt_message = "Aclarada tu duda, para continuar con tu pedido, ¿cuál será tu elección?"
-            botones = [{'id': 'oferta', 'title': '🔥 Quiero la oferta'}, {'id': 'continuar', 'title': 'Continuar con uno'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_upsell', delay=1.5)
             return
 
     # --- LÓGICA MEJORADA: LEE LA OFERTA DESDE FIREBASE ---
@@ -546,11 +2891,8 @@ def handle_upsell_decision(from_number, text, session, product_data):
         session['is_upsell'] = False
         send_text_message(from_number, "¡Perfecto! Continuamos con tu collar individual. ✨")
     
-    time.sleep(1)
     
-    mensaje = "¡Perfecto! Tu joya está casi en camino. Para coordinar tu envío gratis, indícame si el envío es para:"
-    botones = [{'id': 'lima', 'title': '📍 Lima'}, {'id': 'provincia', 'title': '🚚 Provincia'}]
-    send_interactive_message(from_number, mensaje, botones)
+    send_template(from_number, 'pregunta_ubicacion', delay=1)
     session['state'] = 'awaiting_location'
     save_session(from_number, session)
 
@@ -558,39 +2900,26 @@ def handle_location(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['lima', 'provincia']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
-            reprompt_message = "Espero haber aclarado tu duda. Continuando... Para coordinar tu envío gratis, indícame si es para:"
-            botones = [{'id': 'lima', 'title': '📍 Lima'}, {'id': 'provincia', 'title': '🚚 Provincia'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_ubicacion', delay=1.5)
             return
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
     if text == 'lima':
         session.update({"state": "awaiting_lima_district", "provincia": "Lima"})
         save_session(from_number, session)
-        send_text_message(from_number, "¡Genial! ✨ Para saber qué tipo de envío te corresponde, por favor, dime: ¿en qué distrito te encuentras? 📍")
+        send_template(from_number, 'pedir_distrito_lima')
     elif text == 'provincia':
         session['state'] = 'awaiting_province_district'
         save_session(from_number, session)
-        send_text_message(from_number, "¡Entendido! Para continuar, indícame tu *provincia y distrito*. ✍🏽\n\n📝 *Ej: Arequipa, Arequipa*")
+        send_template(from_number, 'pedir_provincia_distrito')
     else:
         # Esta respuesta ahora es para cuando el cliente escribe algo que no es ni FAQ ni una opción válida
-        mensaje = "Por favor, elige una de las dos opciones del menú:"
-        botones = [{'id': 'lima', 'title': '📍 Lima'}, {'id': 'provincia', 'title': '🚚 Provincia'}]
-        send_interactive_message(from_number, mensaje, botones)
+        send_template(from_number, 'ubicacion_invalida')
 
 def handle_province_district(from_number, text, session, product_data):
     provincia, distrito = parse_province_district(text)
     session.update({"tipo_envio": "Provincia Shalom", "metodo_pago": "Adelanto y Saldo (Yape/Plin)", "provincia": provincia, "distrito": distrito})
-    adelanto = BUSINESS_RULES.get('adelanto_shalom', 20)
-    
-    # --- CORRECCIÓN DE FORMATO Y TEXTO ---
-    mensaje = (f"¡Genial! Prepararemos tu envío para *{provincia}* vía Shalom.\n\n"
-               f"Nuestros despachos a provincia se están agendando rápidamente ⚠️. Para *asegurar y priorizar* tu paquete en la próxima salida, solicitamos un adelanto de *S/ {adelanto:.2f}* como compromiso de recojo.\n\n"
-               "¿Procedemos?")
-    
-    botones = [{'id': 'si_acuerdo', 'title': '✅ Sí, de acuerdo'}, {'id': 'no_acuerdo', 'title': 'No en este momento'}]
-    send_interactive_message(from_number, mensaje, botones)
+    send_template(from_number, 'propuesta_shalom_provincia', provincia=provincia)
     session['state'] = 'awaiting_shalom_agreement'
     save_session(from_number, session)
 
@@ -601,39 +2930,28 @@ def handle_lima_district(from_number, text, session, product_data):
         if status == 'CON_COBERTURA':
             session.update({"state": "awaiting_delivery_details", "tipo_envio": "Lima Contra Entrega", "metodo_pago": "Contra Entrega (Efectivo/Yape/Plin)"})
             save_session(from_number, session)
-            mensaje = (f"¡Excelente! Tenemos cobertura en *{distrito}*. 🏙️\n\n"
-                       "Para registrar tu pedido, envíame en *un solo mensaje* tu *Nombre, Dirección exacta* y *Referencia*.\n\n"
-                       "📝 *Ej: Ana Pérez, Jr. Gamarra 123, Depto 501. Al lado de la farmacia.*")
-            send_text_message(from_number, mensaje)
+            send_template(from_number, 'cobertura_lima', distrito=distrito)
         elif status == 'SIN_COBERTURA':
             session.update({"tipo_envio": "Lima Shalom", "metodo_pago": "Adelanto y Saldo (Yape/Plin)"})
-            adelanto = BUSINESS_RULES.get('adelanto_shalom', 20)
-            
-            # --- CORRECCIÓN DE TEXTO PARA SER CONSISTENTE ---
-            mensaje = (f"¡Genial! Prepararemos tu envío para *{distrito}* vía *Shalom*.\n\n"
-                       f"Nuestros despachos se están agendando rápidamente ⚠️. Para *asegurar y priorizar* tu paquete en la próxima salida, solicitamos un adelanto de *S/ {adelanto:.2f}* como compromiso de recojo.\n\n"
-                       "¿Procedemos?")
-
-            botones = [{'id': 'si_acuerdo', 'title': '✅ Sí, de acuerdo'}, {'id': 'no_acuerdo', 'title': 'No en este momento'}]
-            send_interactive_message(from_number, mensaje, botones)
+            send_template(from_number, 'propuesta_shalom_lima', distrito=distrito)
             session['state'] = 'awaiting_shalom_agreement'
             save_session(from_number, session)
     else:
         send_text_message(from_number, "No pude reconocer ese distrito. Por favor, intenta escribirlo de nuevo.")
 
+def order_summary_values(session):
+    """Huecos de las plantillas resumen_pedido / reprompt_resumen_pedido."""
+    return {
+        'product_name': session.get('product_name', ''),
+        'product_price': session.get('product_price', 0),
+        'destino': session.get('distrito', session.get('provincia', '')),
+        'metodo_pago': session.get('metodo_pago', ''),
+        'detalles_cliente': session.get('detalles_cliente', ''),
+    }
+
 def handle_customer_details(from_number, text, session, product_data):
     session.update({"detalles_cliente": text})
-    resumen = ("¡Gracias! Revisa que todo esté correcto:\n\n"
-               f"*Resumen del Pedido*\n"
-               f"💎 {session.get('product_name', '')}\n"
-               f"💵 Total: S/ {session.get('product_price', 0):.2f}\n"
-               f"🚚 Envío: *{session.get('distrito', session.get('provincia', ''))}* - ¡Gratis!\n"
-               f"💳 Pago: {session.get('metodo_pago', '')}\n\n"
-               f"*Datos de Entrega*\n"
-               f"{session.get('detalles_cliente', '')}\n\n"
-               "¿Confirmas que todo es correcto?")
-    botones = [{'id': 'si_correcto', 'title': '✅ Sí, todo correcto'}, {'id': 'corregir', 'title': '📝 Corregir datos'}]
-    send_interactive_message(from_number, resumen, botones)
+    send_template(from_number, 'resumen_pedido', **order_summary_values(session))
     session['state'] = 'awaiting_final_confirmation'
     save_session(from_number, session)
 
@@ -641,22 +2959,15 @@ def handle_shalom_agreement(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['si_acuerdo', 'no_acuerdo']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
             # Vuelve a hacer la pregunta original
-            adelanto = BUSINESS_RULES.get('adelanto_shalom', 20)
-            reprompt_message = (f"Aclarada tu duda. 😊 Para continuar, te recuerdo que para asegurar tu paquete, solicitamos un adelanto de S/ {adelanto:.2f} como compromiso de recojo.\n\n"
-                                "¿Procedemos?")
-            botones = [{'id': 'si_acuerdo', 'title': '✅ Sí, de acuerdo'}, {'id': 'no_acuerdo', 'title': 'No en este momento'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_acuerdo_shalom', delay=1.5)
             return
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
     if text == 'si_acuerdo':
         session['state'] = 'awaiting_shalom_experience'
         save_session(from_number, session)
-        mensaje = "¡Genial! Para hacer el proceso más fácil, cuéntame: ¿alguna vez has recogido un pedido en una agencia Shalom? 🙋🏽‍♀️"
-        botones = [{'id': 'si_conozco', 'title': '✅ Sí, ya conozco'}, {'id': 'no_conozco', 'title': 'No, explícame más'}]
-        send_interactive_message(from_number, mensaje, botones)
+        send_template(from_number, 'pregunta_experiencia_shalom')
     else:
         delete_session(from_number)
         send_text_message(from_number, "Comprendo. Si cambias de opinión, aquí estaré. ¡Gracias! 😊")
@@ -665,71 +2976,43 @@ def handle_shalom_experience(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['si_conozco', 'no_conozco']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
             # Vuelve a hacer la pregunta original
-            reprompt_message = "Aclarada tu duda. 😊 Para continuar, cuéntame, ¿alguna vez has recogido un pedido en una agencia Shalom?"
-            botones = [{'id': 'si_conozco', 'title': '✅ Sí, ya conozco'}, {'id': 'no_conozco', 'title': 'No, explícame más'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_experiencia_shalom', delay=1.5)
             return
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
     if text == 'si_conozco':
         session['state'] = 'awaiting_shalom_details'
         save_session(from_number, session)
-        mensaje = ("¡Excelente! Entonces ya conoces el proceso. ✅\n\n"
-                   "Para terminar, bríndame en un solo mensaje tu *Nombre Completo, DNI* y la *dirección exacta de la agencia Shalom* donde recogerás. ✍🏽\n\n"
-                   "📝 *Ej: Juan Quispe, 45678901, Av. Pardo 123, Miraflores.*")
-        send_text_message(from_number, mensaje)
+        send_template(from_number, 'pedir_datos_shalom')
     else: # 'no_conozco'
         session['state'] = 'awaiting_shalom_agency_knowledge'
         save_session(from_number, session)
-        mensaje = ("¡No te preocupes! Te explico: Shalom es una empresa de envíos. Te damos un código de seguimiento, y cuando tu pedido llega a la agencia, nos yapeas el saldo restante. Apenas confirmemos, te damos la clave secreta para el recojo. ¡Es 100% seguro! 🔒\n\n"
-                   "¿Conoces la dirección de alguna agencia Shalom cerca a ti?")
-        
-        botones = [
-            {'id': 'shalom_knows_addr_yes', 'title': 'Sí, la conozco'},
-            {'id': 'shalom_knows_addr_no', 'title': 'No, necesito buscar'}
-        ]
-        send_interactive_message(from_number, mensaje, botones)
+        send_template(from_number, 'explicacion_shalom')
 
 def handle_shalom_agency_knowledge(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['shalom_knows_addr_yes', 'shalom_knows_addr_no']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
             # Vuelve a hacer la pregunta original
-            reprompt_message = "Aclarada tu duda. 😊 Continuando, ¿conoces la dirección de alguna agencia Shalom cerca a ti?"
-            botones = [{'id': 'shalom_knows_addr_yes', 'title': 'Sí, la conozco'}, {'id': 'shalom_knows_addr_no', 'title': 'No, necesito buscar'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_agencia_shalom', delay=1.5)
             return
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
     if text == 'shalom_knows_addr_yes':
         session['state'] = 'awaiting_shalom_details'
         save_session(from_number, session)
-        mensaje = ("¡Perfecto! Por favor, bríndame en un solo mensaje tu *Nombre Completo, DNI* y la *dirección de esa agencia Shalom*. ✍🏽")
-        send_text_message(from_number, mensaje)
+        send_template(from_number, 'pedir_datos_agencia')
     else: # 'shalom_knows_addr_no'
         delete_session(from_number)
-        send_text_message(from_number, "Entiendo. 😔 Te recomiendo buscar en Google 'Shalom agencias' para encontrar la más cercana. Cuando la tengas, puedes iniciar la conversación de nuevo. ¡Gracias por tu interés!")	
+        send_template(from_number, 'sin_agencia_shalom')	
 
 def handle_final_confirmation(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['si_correcto', 'corregir']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
             # Vuelve a hacer la pregunta original con el resumen del pedido
-            reprompt_message = ("Espero haber aclarado tu duda. 😊 Por favor, revisa nuevamente que todo esté correcto y confirma tu pedido:\n\n"
-                                f"*Resumen del Pedido*\n"
-                                f"💎 {session.get('product_name', '')}\n"
-                                f"💵 Total: S/ {session.get('product_price', 0):.2f}\n"
-                                f"🚚 Envío: *{session.get('distrito', session.get('provincia', ''))}* - ¡Gratis!\n"
-                                f"💳 Pago: {session.get('metodo_pago', '')}\n\n"
-                                f"*Datos de Entrega*\n"
-                                f"{session.get('detalles_cliente', '')}\n\n"
-                                "¿Confirmas que todo es correcto?")
-            botones = [{'id': 'si_correcto', 'title': '✅ Sí, todo correcto'}, {'id': 'corregir', 'title': '📝 Corregir datos'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_resumen_pedido', delay=1.5, **order_summary_values(session))
             return
 
     # --- LÓGICA ORIGINAL MODIFICADA ---
@@ -739,21 +3022,9 @@ def handle_final_confirmation(from_number, text, session, product_data):
             session.update({'adelanto': adelanto})
             
             # 1. Restaurar el mensaje persuasivo largo
-            mensaje_largo = (
-                "¡Perfecto! Tu pedido contra entrega está listo para ser agendado. ✨\n\n"
-                "Nuestras rutas de reparto para mañana 🚚 ya se están llenando y tenemos *cupos limitados* ⚠️. Para asegurar tu espacio y priorizar tu entrega, solo solicitamos un adelanto de *S/ 10.00*.\n\n"
-                "Este pequeño monto confirma tu compromiso y nos permite seguir ofreciendo *envío gratis* a clientes serios como tú. Por supuesto, se descuenta del total."
-            )
-            send_text_message(from_number, mensaje_largo)
-            time.sleep(2) # Pausa para leer el texto
-            
+            send_template(from_number, 'adelanto_lima')
             # 2. Usar la nueva pregunta y botones que elegiste
-            pregunta_final = "¡Casi es tuyo! ✨ Tu Collar Mágico está esperando. ¿Aseguramos tu joya?"
-            botones = [
-                {'id': 'si_proceder', 'title': '💖 ¡Sí, lo quiero!'},
-                {'id': 'no_proceder', 'title': 'Ahora no, gracias'}
-            ]
-            send_interactive_message(from_number, pregunta_final, botones)
+            send_template(from_number, 'pregunta_pago_lima', delay=2)
             
             session['state'] = 'awaiting_lima_payment_agreement'
             save_session(from_number, session)
@@ -761,11 +3032,7 @@ def handle_final_confirmation(from_number, text, session, product_data):
             adelanto = float(BUSINESS_RULES.get('adelanto_shalom', 20))
             session.update({'adelanto': adelanto, 'state': 'awaiting_shalom_payment'})
             save_session(from_number, session)
-            mensaje = (f"¡Genial! Puedes realizar el adelanto de *S/ {adelanto:.2f}* a:\n\n"
-                       f"💳 *YAPE / PLIN:* {YAPE_NUMERO}\n"
-                       f"👤 *Titular:* {TITULAR_YAPE}\n\n"
-                       "Una vez realizado, envíame la *captura de pantalla* para validar.")
-            send_text_message(from_number, mensaje)
+            send_template(from_number, 'datos_pago', adelanto=adelanto)
     else: # 'corregir'
         previous_state = 'awaiting_delivery_details' if session.get('tipo_envio') == 'Lima Contra Entrega' else 'awaiting_shalom_details'
         session['state'] = previous_state
@@ -776,78 +3043,44 @@ def handle_lima_payment_agreement(from_number, text, session, product_data):
     # --- INICIO DEL FILTRO INTELIGENTE PARA INTERRUPCIONES ---
     if text not in ['si_proceder', 'no_proceder']:
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
             # Vuelve a hacer la pregunta original
-            reprompt_message = "Aclarada tu duda. 😊 Para continuar, ¿aseguramos tu joya?"
-            botones = [
-                {'id': 'si_proceder', 'title': '💖 ¡Sí, lo quiero!'},
-                {'id': 'no_proceder', 'title': 'Ahora no, gracias'}
-            ]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_pago_lima', delay=1.5)
             return
 
     # --- LÓGICA ORIGINAL DE LA FUNCIÓN ---
     if text == 'si_proceder':
         session['state'] = 'awaiting_lima_payment'
         save_session(from_number, session)
-        mensaje = (f"¡Genial! Puedes realizar el adelanto de *S/ {session.get('adelanto', 10):.2f}* a:\n\n"
-                   f"💳 *YAPE / PLIN:* {YAPE_NUMERO}\n"
-                   f"👤 *Titular:* {TITULAR_YAPE}\n\n"
-                   "Una vez realizado, envíame la *captura de pantalla* para validar.")
-        send_text_message(from_number, mensaje)
+        send_template(from_number, 'datos_pago', adelanto=session.get('adelanto', 10))
     else: # 'no_proceder'
         delete_session(from_number)
         send_text_message(from_number, "Entendido. Si cambias de opinión, aquí estaré. ¡Gracias!")
 
 def handle_payment_received(from_number, text, session, product_data):
     if text == "COMPROBANTE_RECIBIDO":
-        guardado_exitoso, sale_data = save_completed_sale_and_customer(session)
+        # Punto de control: la venta, el cliente y la sesión se guardan juntos en un solo batch
+        es_lima_contra_entrega = session.get('tipo_envio') == 'Lima Contra Entrega'
+        next_session = {**session, 'state': 'awaiting_delivery_confirmation_lima'} if es_lima_contra_entrega else None
+        # La hoja 'Pedidos' y el aviso al administrador salen del outbox, sin hacer esperar al cliente
+        guardado_exitoso, sale_data = save_completed_sale_and_customer(session, next_session)
         if guardado_exitoso:
-            guardar_pedido_en_sheet(sale_data) 
-            if ADMIN_WHATSAPP_NUMBER:
-                admin_message = (f"🎉 ¡Nueva Venta Confirmada! 🎉\n"
-                                 f"Producto: {sale_data.get('producto_nombre')}\nTipo: {sale_data.get('tipo_envio')}\n"
-                                 f"Cliente: {sale_data.get('cliente_id')}\nDetalles:\n{sale_data.get('detalles_cliente')}")
-                send_text_message(ADMIN_WHATSAPP_NUMBER, admin_message)
-                
-            if session.get('tipo_envio') == 'Lima Contra Entrega':
+            if es_lima_contra_entrega:
                 dia_entrega = get_delivery_day_message()
                 horario = BUSINESS_RULES.get('horario_entrega_lima', 'durante el día')
-                mensaje_resumen = (f"¡Adelanto confirmado, gracias! ✨ Aquí tienes el resumen final de tu pedido y los detalles de la entrega:\n\n"
-                                   f"*Tu Pedido en Detalle:*\n"
-                                   f"💰 *Costo Total:* S/ {sale_data.get('precio_venta', 0):.2f}\n"
-                                   f"✅ *Adelanto Recibido:* - S/ {sale_data.get('adelanto_recibido', 0):.2f}\n"
-                                   f"💵 *Saldo a Pagar al recibir:* S/ {sale_data.get('saldo_restante', 0):.2f}\n\n"
-                                   f"*Entrega Programada:*\n"
-                                   f"🗓️ *Día:* {dia_entrega.title()}\n"
-                                   f"⏰ *Horario:* {horario}\n\n"
-                                   f"A continuación, te pediré un último paso para asegurar tu envío.")
-                send_text_message(from_number, mensaje_resumen)
-                time.sleep(1.5)
-                mensaje_solicitud = (f"¡Ya casi es tuya! 💎\n\n"
-                                     f"Para garantizar una entrega exitosa *{dia_entrega}*, por favor confirma que habrá alguien disponible para recibir tu joya y pagar el saldo 💵.\n\n"
-                                     f"👉 Solo presiona *CONFIRMO* y tu pedido quedará asegurado en la ruta. 🚚✨")
-                botones = [{'id': 'confirmo_entrega_lima', 'title': '✅ CONFIRMO'}]
-                send_interactive_message(from_number, mensaje_solicitud, botones)
+                send_template(from_number, 'resumen_venta_lima',
+                              precio_venta=sale_data.get('precio_venta', 0),
+                              adelanto_recibido=sale_data.get('adelanto_recibido', 0),
+                              saldo_restante=sale_data.get('saldo_restante', 0),
+                              dia_entrega_titulo=dia_entrega.title(), horario=horario)
+                send_template(from_number, 'solicitud_confirmacion_lima', delay=1.5, dia_entrega=dia_entrega)
                 session['state'] = 'awaiting_delivery_confirmation_lima'
-                save_session(from_number, session)
             else: # Shalom
-                # <-- INICIO DE LA MODIFICACIÓN -->
-                resumen_shalom = (f"¡Adelanto confirmado, gracias! ✨ Aquí tienes el resumen final de tu pedido:\n\n"
-                                  f"*Tu Pedido en Detalle:*\n"
-                                  f"💰 *Costo Total:* S/ {sale_data.get('precio_venta', 0):.2f}\n"
-                                  f"✅ *Adelanto Recibido:* - S/ {sale_data.get('adelanto_recibido', 0):.2f}\n"
-                                  f"------------------------------------\n"
-                                  f"💵 *Saldo a Pagar:* S/ {sale_data.get('saldo_restante', 0):.2f}")
-                send_text_message(from_number, resumen_shalom)
-                time.sleep(1.5)
-
+                send_template(from_number, 'resumen_venta_shalom',
+                              precio_venta=sale_data.get('precio_venta', 0),
+                              adelanto_recibido=sale_data.get('adelanto_recibido', 0),
+                              saldo_restante=sale_data.get('saldo_restante', 0))
                 tiempo_entrega = "1-2 días hábiles" if session.get('tipo_envio') == 'Lima Shalom' else "3-5 días hábiles"
-                proximos_pasos = (f"📝 *Próximos Pasos:*\n\n"
-                                  f"⏳ En las próximas 24h hábiles te enviaremos tu código de seguimiento 📲. El tiempo de entrega en agencia es de *{tiempo_entrega}* 📦.")
-                # <-- FIN DE LA MODIFICACIÓN -->
-                send_text_message(from_number, proximos_pasos)
-                delete_session(from_number)
+                send_template(from_number, 'proximos_pasos_shalom', delay=1.5, tiempo_entrega=tiempo_entrega)
         else:
             send_text_message(from_number, "¡Uy! Hubo un problema al registrar tu pedido. Un asesor se pondrá en contacto contigo.")
     else:
@@ -856,28 +3089,14 @@ def handle_payment_received(from_number, text, session, product_data):
 def handle_delivery_confirmation_lima(from_number, text, session, product_data):
     if 'confirmo' not in text.lower() and text != 'confirmo_entrega_lima':
         if check_and_handle_faq(from_number, text):
-            time.sleep(1.5)
-            dia_entrega = get_delivery_day_message()
-            reprompt_message = (f"Espero haber aclarado tu duda. 😊 Para finalizar, solo necesito que confirmes que habrá alguien disponible para recibir tu joya y pagar el saldo el día {dia_entrega}.")
-            botones = [{'id': 'confirmo_entrega_lima', 'title': '✅ CONFIRMO'}]
-            send_interactive_message(from_number, reprompt_message, botones)
+            send_template(from_number, 'reprompt_confirmacion_lima', delay=1.5, dia_entrega=get_delivery_day_message())
             return
 
     if 'confirmo' in text.lower() or text == 'confirmo_entrega_lima':
-        
-        # <-- INICIO DE LA MODIFICACIÓN 2 -->
-        mensaje_final = (
-            "¡Listo! ✅ Tu pedido ha sido *confirmado en la ruta* 🚚.\n\n"
-            "De parte de todo el equipo de *Daaqui Joyas*, ¡muchas gracias por tu compra! 🎉😊"
-        )
-        # <-- FIN DE LA MODIFICACIÓN 2 -->
-
-        send_text_message(from_number, mensaje_final)
+        send_template(from_number, 'pedido_confirmado_lima')
         delete_session(from_number)
     else:
-        mensaje_solicitud = ("Por favor, para asegurar tu pedido, presiona el botón de confirmación.")
-        botones = [{'id': 'confirmo_entrega_lima', 'title': '✅ CONFIRMO'}]
-        send_interactive_message(from_number, mensaje_solicitud, botones)
+        send_template(from_number, 'pedir_confirmacion_lima')
 
 # ==============================================================================
 # 8. MANEJADOR CENTRAL Y WEBHOOK
@@ -895,6 +3114,52 @@ STATE_HANDLERS = {
     "awaiting_delivery_confirmation_lima": handle_delivery_confirmation_lima,
 }
 
+message_workers = SerialKeyedExecutor(WEBHOOK_MAX_WORKERS, 'webhook', delay_scheduler)
+
+def extract_messages(data):
+    """Valida el payload del webhook y devuelve la lista de (message, contacts) a procesar."""
+    pending = []
+    if not isinstance(data, dict) or data.get('object') != 'whatsapp_business_account':
+        return pending
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            if change.get('field') == 'messages' and (value := change.get('value', {})):
+                if messages := value.get('messages'):
+                    for message in messages:
+                        if message.get('from'):
+                            pending.append((message, value.get('contacts', [])))
+    return pending
+
+def group_by_sender(pending):
+    """Agrupa los mensajes por número conservando el orden de llegada (de los números y dentro de cada uno)."""
+    groups = {}
+    for message, contacts in pending:
+        groups.setdefault(message.get('from'), []).append((message, contacts))
+    return groups
+
+def process_messages_safely(from_number, items):
+    """Procesa en orden los mensajes de un mismo cliente con una sola lectura y una sola escritura de su sesión.
+    Un mensaje cuenta como procesado (para la deduplicación) solo cuando terminó y su sesión quedó guardada."""
+    processed = []
+    try:
+        with metrics_handler('webhook'), session_batch(from_number):
+            for message, contacts in items:
+                try:
+                    # process_message cambia la etiqueta al handler de estado en cuanto lo conoce
+                    with timed('process_message'):
+                        process_message(message, contacts)
+                    processed.append(message.get('id'))
+                except Exception as e:
+                    logger.error(f"Error procesando un mensaje: {e}")
+                    message_deduplicator.release([message.get('id')])
+                finally:
+                    set_metrics_handler('webhook')
+    except Exception:
+        # No se pudo escribir la sesión: el reenvío de Meta debe procesar de nuevo estos mensajes
+        message_deduplicator.release(processed)
+        raise
+    message_deduplicator.mark_processed(processed)
+
 @app.route('/api/webhook', methods=['GET', 'POST'])
 def webhook():
     if request.method == 'GET':
@@ -902,73 +3167,104 @@ def webhook():
             return request.args.get('hub.challenge')
         return 'Forbidden', 403
     
-    data = request.get_json()
-    if data.get('object') == 'whatsapp_business_account':
-        for entry in data.get('entry', []):
-            for change in entry.get('changes', []):
-                if change.get('field') == 'messages' and (value := change.get('value', {})):
-                    if messages := value.get('messages'):
-                        for message in messages:
-                            try:
-                                process_message(message, value.get('contacts', []))
-                            except Exception as e:
-                                logger.error(f"Error procesando un mensaje: {e}")
+    maybe_refresh_config()
+    outbox_drainer.maybe_schedule()
+    data = request.get_json(silent=True)
+    senders = group_by_sender(extract_messages(data))
+    for from_number, items in senders.items():
+        if WEBHOOK_ASYNC:
+            # Se responde 200 de inmediato; el orden por cliente lo garantiza la cola por número.
+            message_workers.submit(from_number, process_messages_safely, from_number, items)
+        else:
+            process_messages_safely(from_number, items)
+    if not WEBHOOK_ASYNC:
+        finish_request(list(senders))
     return jsonify({'status': 'success'}), 200
 
+def finish_request(numbers):
+    """Antes de responder (ver REQUEST_DRAIN_TIMEOUT): espera, con tope, los envíos inmediatos a estos números
+    (y los que llevan pausa si REQUEST_DRAIN_DELAYED), escribe sus sesiones pendientes y procesa el outbox de las
+    ventas recién hechas, para que nada de eso dependa de hilos que una instancia congelada ya no ejecutaría."""
+    if REQUEST_DRAIN_TIMEOUT <= 0 or not numbers:
+        return
+    if OUTBOUND_ASYNC and not outbound_scheduler.wait_idle(numbers, REQUEST_DRAIN_TIMEOUT, include_delayed=REQUEST_DRAIN_DELAYED):
+        logger.warning(f"Quedan envíos en cola tras {REQUEST_DRAIN_TIMEOUT}s; siguen en segundo plano.")
+    for number in numbers:
+        flush_sessions(number)
+    if outbox_drainer.pending():
+        # Una venta de esta petición dejó entradas en el outbox: se procesan antes de responder
+        outbox_drainer.drain()
+
+def extract_text_body(message, session):
+    """Texto o id de botón que el handler debe recibir; None si el tipo de mensaje se ignora."""
+    message_type = message.get('type')
+    if message_type == 'text':
+        return message.get('text', {}).get('body', '')
+    if message_type == 'interactive' and (reply_type := message.get('interactive', {}).get('type')) in ('button_reply', 'list_reply'):
+        return message.get('interactive', {}).get(reply_type, {}).get('id', '')
+    if message_type == 'image' and session and session.get('state') in ['awaiting_lima_payment', 'awaiting_shalom_payment']:
+        return "COMPROBANTE_RECIBIDO"
+    return None
+
+def is_cancel_request(text):
+    text_lower = text.lower()
+    return any(palabra in text_lower for palabra in PALABRAS_CANCELACION)
+
 def process_message(message, contacts):
     from_number = message.get('from')
+    if message_deduplicator.is_duplicate(message.get('id')):
+        logger.info(f"Mensaje duplicado {message.get('id')} de {from_number} ignorado.")
+        return
     user_name = next((c.get('profile', {}).get('name', 'Usuario') for c in contacts if c.get('wa_id') == from_number), 'Usuario')
     session = get_session(from_number)
     
-    text_body = ""
-    message_type = message.get('type')
-    if message_type == 'text':
-        text_body = message.get('text', {}).get('body', '')
-    elif message_type == 'interactive' and message.get('interactive', {}).get('type') == 'button_reply':
-        text_body = message.get('interactive', {}).get('button_reply', {}).get('id', '')
-    elif message_type == 'image' and session and session.get('state') in ['awaiting_lima_payment', 'awaiting_shalom_payment']:
-        text_body = "COMPROBANTE_RECIBIDO"
-    else:
+    text_body = extract_text_body(message, session)
+    if text_body is None:
         return # Ignora otros tipos de mensajes
 
     logger.info(f"Procesando de {user_name} ({from_number}): '{text_body}'")
 
-    if any(palabra in text_body.lower() for palabra in PALABRAS_CANCELACION):
+    if is_cancel_request(text_body):
         if session:
             delete_session(from_number)
             send_text_message(from_number, "Hecho. He cancelado el proceso. Si necesitas algo más, escríbeme. 😊")
         return
 
     if not session:
+        set_metrics_handler('handle_initial_message')
         handle_initial_message(from_number, user_name, text_body)
         return
 
-    if 'last_updated' in session:
-        last_update_time = session['last_updated']
-        if last_update_time.tzinfo is None: last_update_time = last_update_time.replace(tzinfo=timezone.utc)
-        if datetime.now(timezone.utc) - last_update_time > timedelta(hours=2):
-            delete_session(from_number)
-            send_text_message(from_number, "Hola de nuevo. 😊 Parece que ha pasado un tiempo. Si necesitas algo, no dudes en preguntar.")
-            handle_initial_message(from_number, user_name, text_body)
-            return
+    if is_session_expired(session):
+        set_metrics_handler('handle_initial_message')
+        # Una sesión expirada se trata como inexistente (si venía de la caché, sin ir a Firestore)
+        delete_session(from_number)
+        send_text_message(from_number, "Hola de nuevo. 😊 Parece que ha pasado un tiempo. Si necesitas algo, no dudes en preguntar.")
+        handle_initial_message(from_number, user_name, text_body)
+        return
 
     current_state = session.get('state')
     handler_func = STATE_HANDLERS.get(current_state)
 
     if handler_func:
+        set_metrics_handler(handler_func.__name__)
         product_data = None
         if current_state not in ["awaiting_menu_choice", "awaiting_product_choice", "awaiting_faq_choice"]:
             if product_id := session.get('product_id'):
-                product_doc = db.collection('productos').document(product_id).get()
-                if product_doc.exists:
-                    product_data = product_doc.to_dict()
-                else:
+                # Dentro de un lote el producto se busca una sola vez
+                batch = current_session_batch(from_number)
+                if batch is None:
+                    product_data = get_product(product_id)
+                elif (product_data := batch.products.get(product_id)) is None:
+                    product_data = batch.products[product_id] = get_product(product_id)
+                if not product_data:
                     send_text_message(from_number, "Lo siento, este producto ya no está disponible.")
                     delete_session(from_number); return
             else:
                 send_text_message(from_number, "Hubo un problema con tu sesión. Empieza de nuevo.")
                 delete_session(from_number); return
-        handler_func(from_number, text_body, session, product_data)
+        with timed('handler'):
+            handler_func(from_number, text_body, session, product_data)
     else:
         logger.warning(f"No se encontró manejador para el estado: {current_state}")
         send_text_message(from_number, "Estoy un poco confundido. Si deseas reiniciar, escribe 'cancelar'.")
@@ -976,42 +3272,172 @@ def process_message(message, contacts):
 # ==============================================================================
 # 9. ENDPOINTS PARA AUTOMATIZACIONES (MAKE.COM)
 # ==============================================================================
+@app.route('/api/cache/productos/invalidate', methods=['POST'])
+def invalidate_product_cache():
+    if (auth_header := request.headers.get('Authorization')) is None or auth_header != f'Bearer {MAKE_SECRET_TOKEN}':
+        logger.warning("Acceso no autorizado a /api/cache/productos/invalidate")
+        return jsonify({'error': 'No autorizado'}), 401
+    maybe_refresh_config()
+
+    data = request.get_json(silent=True) or {}
+    product_cache.invalidate(data.get('product_id'))
+    if data.get('reload'):
+        product_cache.warm()
+    return jsonify({'status': 'caché invalidada', 'version': product_cache.version}), 200
+
+@app.route('/api/sessions/sweep', methods=['POST'])
+def sweep_sessions():
+    if (auth_header := request.headers.get('Authorization')) is None or auth_header != f'Bearer {MAKE_SECRET_TOKEN}':
+        logger.warning("Acceso no autorizado a /api/sessions/sweep")
+        return jsonify({'error': 'No autorizado'}), 401
+    try:
+        return jsonify({'status': 'ok', 'eliminadas': sweep_expired_sessions()}), 200
+    except Exception as e:
+        logger.error(f"Error limpiando sesiones expiradas: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/outbox/replay', methods=['POST'])
+def replay_outbox():
+    """Reprocesa entradas atascadas del outbox: las indicadas en {"ids": [...]} o {"id_venta": ...},
+    o si no se indica nada, las fallidas. Además procesa en el momento todo lo que ya estaba vencido."""
+    if (auth_header := request.headers.get('Authorization')) is None or auth_header != f'Bearer {MAKE_SECRET_TOKEN}':
+        logger.warning("Acceso no autorizado a /api/outbox/replay")
+        return jsonify({'error': 'No autorizado'}), 401
+    maybe_refresh_config()
+    data = request.get_json(silent=True) or {}
+    entry_ids = data.get('ids')
+    if id_venta := data.get('id_venta'):
+        entry_ids = [f"{id_venta}_{tipo}" for tipo in OUTBOX_HANDLERS]
+    try:
+        reencoladas = outbox_drainer.replay(entry_ids, data.get('limite'))
+        return jsonify({'status': 'ok', 'reencoladas': reencoladas, **outbox_drainer.drain()}), 200
+    except Exception as e:
+        logger.error(f"Error reprocesando el outbox: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+def tracking_messages(customer_name, nro_orden, codigo_recojo, already_sent=0):
+    """Los tres mensajes de seguimiento Shalom como pasos (message_data, delay) para un mismo cliente.
+    `already_sent` omite los primeros mensajes (los que un envío anterior ya entregó)."""
+    linea_codigo_recojo = f"\n👉🏽 *Código de Recojo:* {codigo_recojo}" if codigo_recojo else ""
+    steps = [
+        (render_template('seguimiento_datos', customer_name=customer_name, nro_orden=nro_orden, linea_codigo_recojo=linea_codigo_recojo), 0),
+        (render_template('seguimiento_pasos'), TRACKING_MESSAGE_DELAY),
+        (render_template('seguimiento_cierre'), TRACKING_MESSAGE_DELAY),
+    ][already_sent:]
+    if steps:
+        steps[0] = (steps[0][0], 0)
+    return steps
+
+def get_customer_names(numbers):
+    """Nombre de perfil de varios clientes con un solo get_all. Los que no existen no aparecen en el resultado."""
+    names = {}
+    if numbers and get_db():
+        for number, doc in db.get_all('clientes', numbers, fields=['nombre_perfil_wa']).items():
+            if name := (doc.data or {}).get('nombre_perfil_wa'):
+                names[number] = name
+    return names
+
 @app.route('/api/send-tracking', methods=['POST'])
 def send_tracking_code():
     if (auth_header := request.headers.get('Authorization')) is None or auth_header != f'Bearer {MAKE_SECRET_TOKEN}':
         logger.warning("Acceso no autorizado a /api/send-tracking")
         return jsonify({'error': 'No autorizado'}), 401
-    
-    data = request.get_json()
-    to_number, nro_orden, codigo_recojo = data.get('to_number'), data.get('nro_orden'), data.get('codigo_recojo')
-    
-    if not to_number or not nro_orden:
+    maybe_refresh_config()
+
+    # Acepta un solo envío (formato original) o una lista: [{...}, ...] o {"envios": [{...}, ...]}
+    data = request.get_json(silent=True)
+    single = isinstance(data, dict) and 'envios' not in data
+    entries = [data] if single else (data.get('envios') if isinstance(data, dict) else data)
+    if not isinstance(entries, list) or not entries:
+        logger.error("Solicitud de Make.com sin envíos")
+        return jsonify({'error': 'Faltan parámetros'}), 400
+
+    # Un reenvío puede traer el 'mensajes_enviados' de la respuesta anterior: esos mensajes no se repiten
+    resultados, valid = [], {}
+    for idx, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        to_number, nro_orden = entry.get('to_number'), entry.get('nro_orden')
+        already_sent = entry.get('mensajes_enviados') or 0
+        resultados.append({'to_number': to_number, 'nro_orden': nro_orden, 'status': 'error'})
+        if not to_number or not nro_orden:
+            resultados[idx]['error'] = 'Faltan parámetros'
+            continue
+        if not isinstance(already_sent, int) or isinstance(already_sent, bool) or already_sent < 0:
+            resultados[idx]['error'] = 'mensajes_enviados inválido'
+            continue
+        valid[idx] = (str(to_number), nro_orden, entry.get('codigo_recojo'), already_sent)
+
+    if single and not valid:
         logger.error("Faltan parámetros en la solicitud de Make.com")
         return jsonify({'error': 'Faltan parámetros'}), 400
-    
+
     try:
-        customer_name = "cliente"
-        if db and (customer_doc := db.collection('clientes').document(str(to_number)).get()).exists:
-            customer_name = customer_doc.to_dict().get('nombre_perfil_wa', 'cliente')
-
-        message_1 = (f"¡Hola {customer_name}! 👋🏽✨\n\n¡Excelentes noticias! Tu pedido de Daaqui Joyas ha sido enviado. 🚚\n\n"
-                     f"Datos para seguimiento Shalom:\n👉🏽 *Nro. de Orden:* {nro_orden}" +
-                     (f"\n👉🏽 *Código de Recojo:* {codigo_recojo}" if codigo_recojo else "") +
-                     "\n\nA continuación, los pasos a seguir:")
-        send_text_message(str(to_number), message_1)
-        time.sleep(2)
-        message_2 = ("*Pasos para una entrega exitosa:* 👇\n\n"
-                     "*1. HAZ EL SEGUIMIENTO:* 📲\nDescarga la app *\"Mi Shalom\"*. Si eres nuevo, regístrate. Con los datos de arriba, podrás ver el estado de tu paquete.\n\n"
-                     "*2. PAGA EL SALDO CUANDO LLEGUE:* 💳\nCuando la app confirme que tu pedido llegó a la agencia, yapea o plinea el saldo restante. Haz este paso *antes de ir a la agencia*.\n\n"
-                     "*3. AVISA Y RECIBE TU CLAVE:* 🔑\nApenas nos envíes la captura de tu pago, lo validaremos y te daremos la *clave secreta de recojo*. ¡La necesitarás junto a tu DNI! 🎁")
-        send_text_message(str(to_number), message_2)
-        time.sleep(2)
-        message_3 = ("✨ *¡Ya casi es tuya! Tu último paso es el más importante.* ✨\n\n"
-                     "Para darte atención prioritaria, responde este chat con la **captura de tu pago**.\n\n"
-                     "¡Estaremos atentos para enviarte tu clave al instante! La necesitarás junto a tu DNI para recibir tu joya. 🎁")
-        send_text_message(str(to_number), message_3)
-
-        return jsonify({'status': 'mensajes enviados'}), 200
+        names = get_customer_names(list({to_number for to_number, _, _, _ in valid.values()}))
+    except Exception as e:
+        # Sin nombres se saluda de forma genérica: no vale la pena perder el lote por esto
+        logger.error(f"Error leyendo clientes para send-tracking: {e}")
+        names = {}
+    jobs = {idx: (to_number, tracking_messages(names.get(to_number, 'cliente'), nro_orden, codigo_recojo, already_sent))
+            for idx, (to_number, nro_orden, codigo_recojo, already_sent) in valid.items()}
+
+    try:
+        if single:
+            # Un solo cliente: misma respuesta de siempre, pero se espera (con tope) a que salgan los mensajes
+            to_number, steps = jobs[0]
+            schedule_messages(to_number, steps)
+            finish_request([to_number])
+            return jsonify({'status': 'mensajes enviados'}), 200
+
+        # Los mensajes_enviados que se devuelven incluyen los ya entregados antes, para reenviar la entrada tal cual
+        finished = deliver_batch(jobs, request_deadline(TRACKING_WAIT_TIMEOUT))
+        for idx, (status, accepted) in finished.items():
+            already_sent = valid[idx][3]
+            if status == 'no_enviado' and not jobs[idx][1]:
+                status = 'enviado'
+            resultados[idx]['status'] = status
+            resultados[idx]['mensajes_enviados'] = already_sent + accepted
+            if status == 'no_enviado':
+                resultados[idx]['error'] = 'No cupo en esta llamada; reenvíalo en otro lote'
+            elif status == 'en_curso':
+                resultados[idx]['error'] = 'Un mensaje seguía en envío; confírmalo antes de reenviar'
+        resumen = {}
+        for resultado in resultados:
+            resumen[resultado['status']] = resumen.get(resultado['status'], 0) + 1
+        logger.info(f"[send-tracking] Lote de {len(entries)} envíos: {resumen}")
+        return jsonify({'status': 'ok', 'resumen': resumen, 'resultados': resultados}), 200
     except Exception as e:
         logger.error(f"Error crítico en send_tracking_code: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.before_request
+def mark_request_start():
+    _metrics_local.request_started = time.monotonic()
+
+@app.after_request
+def count_request(response):
+    metrics.inc('bot_requests_total', endpoint=request.endpoint or 'desconocido', method=request.method, status=response.status_code)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    token = request.args.get('token') or (request.headers.get('Authorization') or '').removeprefix('Bearer ')
+    if not METRICS_TOKEN or token != METRICS_TOKEN:
+        logger.warning("Acceso no autorizado a /api/metrics")
+        return jsonify({'error': 'No autorizado'}), 401
+    gauges = [
+        ('bot_queue_pending', {'queue': 'outbound'}, outbound_scheduler.pending()),
+        ('bot_queue_pending', {'queue': 'webhook'}, message_workers.pending()),
+        ('bot_queue_pending', {'queue': 'outbox'}, outbox_drainer.pending()),
+        ('bot_queue_pending', {'queue': 'sessions'}, session_cache.pending()),
+        ('bot_queue_pending', {'queue': 'rate_limit'}, whatsapp_client.rate_limiter.waiting),
+        ('bot_config_version', {}, CONFIG_VERSION),
+        ('bot_product_cache_version', {}, product_cache.version),
+    ]
+    gauges += [('bot_startup_milliseconds', {'stage': stage}, ms) for stage, ms in STARTUP_TIMINGS.items()]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# ==============================================================================
+# 10. REPORTE DE ARRANQUE
+# ==============================================================================
+STARTUP_TIMINGS['import'] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+logger.info(f"⏱️ Arranque: import={STARTUP_TIMINGS['import']}ms (Firebase, Sheets y la configuración se cargan en el primer uso)")
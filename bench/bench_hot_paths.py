@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# ==========================================================
+# MICRO-BENCHMARKS DE LAS RUTAS CALIENTES DE TEXTO (sin red)
+# ==========================================================
+# Uso (desde la raíz del repositorio, con requirements.txt instalado):
+#   python bench/bench_hot_paths.py                       # todos los benchmarks
+#   python bench/bench_hot_paths.py -k district           # solo los que contienen "district"
+#   python bench/bench_hot_paths.py --json bench_output.txt
+#   python bench/bench_hot_paths.py --baseline bench_output.txt   # compara con una corrida anterior
+#
+# Reporta operaciones por segundo (cada operación procesa todos los mensajes de
+# fixtures.MENSAJES) y el pico de memoria asignada por operación según tracemalloc.
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+# El bot no debe tocar la red: almacenamiento en memoria, sin credenciales y con envío en línea
+# (que además se anula abajo)
+os.environ.setdefault('OUTBOUND_ASYNC', '0')
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.pop('FIREBASE_SERVICE_ACCOUNT_JSON', None)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'api'))
+sys.path.insert(0, BENCH_DIR)
+
+import index as bot  # noqa: E402
+import fixtures  # noqa: E402
+
+def setup_bot():
+    # Los logs por mensaje distorsionan las mediciones
+    bot.logger.setLevel(logging.WARNING)
+    bot.send_whatsapp_message = lambda to_number, message_data, delay=0: None
+    if store := bot.get_db():
+        # La configuración y el catálogo se siembran en el almacenamiento local y se cargan como en producción
+        for doc_id, data in {**fixtures.config_docs(), **fixtures.CONVERSACION_CONFIG}.items():
+            store.set('configuracion', doc_id, data)
+        for product_id, data in fixtures.PRODUCTOS.items():
+            store.set('productos', product_id, data)
+        bot.ensure_initialized()
+    else:
+        bot.publish_config(fixtures.config_docs(), {})
+
+def bench_cases():
+    mensajes = fixtures.MENSAJES
+    messages = fixtures.webhook_messages()
+    session = {'state': 'awaiting_occasion_response'}
+    docs = fixtures.config_docs()
+
+    def strip_accents():
+        for text in mensajes:
+            bot.strip_accents(text)
+
+    def normalize_and_check_district():
+        for text in mensajes:
+            bot.normalize_and_check_district(text)
+
+    def parse_province_district():
+        for text in mensajes:
+            bot.parse_province_district(text)
+
+    def check_and_handle_faq():
+        for text in mensajes:
+            bot.check_and_handle_faq('51999999999', text)
+
+    def cancel_words_scan():
+        for text in mensajes:
+            bot.is_cancel_request(text)
+
+    def extract_text_body():
+        for message in messages:
+            bot.extract_text_body(message, session)
+
+    def build_district_index():
+        bot.DistrictIndex(docs['reglas_envio'])
+
+    def build_faq_matcher():
+        bot.KeywordMatcher(fixtures.FAQ_KEYWORD_MAP, ['pago', 'precio', 'envio'])
+
+    message_ids = itertools.count()
+
+    def conversation_flow():
+        # Embudo completo de un cliente (sesión, productos y deduplicación contra el almacenamiento local)
+        batch = [(message, fixtures.CONVERSACION_CONTACTOS)
+                 for message in fixtures.conversation_messages(next(message_ids))]
+        bot.process_messages_safely(fixtures.CONVERSACION_CLIENTE, batch)
+        bot.flush_sessions()
+
+    return {
+        'strip_accents': strip_accents,
+        'normalize_and_check_district': normalize_and_check_district,
+        'parse_province_district': parse_province_district,
+        'check_and_handle_faq': check_and_handle_faq,
+        'cancel_words_scan': cancel_words_scan,
+        'extract_text_body': extract_text_body,
+        'build_district_index': build_district_index,
+        'build_faq_matcher': build_faq_matcher,
+        'conversation_flow': conversation_flow,
+    }
+
+def measure(func, min_time):
+    func()  # calentamiento (construye los índices derivados de la configuración)
+    iterations, elapsed = 0, 0.0
+    started = time.perf_counter()
+    while elapsed < min_time:
+        func()
+        iterations += 1
+        elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'ops_per_sec': iterations / elapsed, 'peak_bytes_per_op': peak - baseline}
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks de las rutas calientes de texto del bot.')
+    parser.add_argument('-k', dest='filter', default='', help='solo benchmarks cuyo nombre contenga este texto')
+    parser.add_argument('--min-time', type=float, default=0.5, help='segundos mínimos por benchmark')
+    parser.add_argument('--json', dest='json_path', help='guarda los resultados en este archivo')
+    parser.add_argument('--baseline', help='resultados JSON de una corrida anterior para comparar')
+    args = parser.parse_args()
+
+    setup_bot()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+
+    results = {}
+    print(f"{'benchmark':<32}{'ops/s':>14}{'pico B/op':>14}{'vs base':>10}")
+    for name, func in bench_cases().items():
+        if args.filter not in name:
+            continue
+        results[name] = result = measure(func, args.min_time)
+        delta = ''
+        if previous := baseline.get(name):
+            delta = f"{(result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100:+.1f}%"
+        print(f"{name:<32}{result['ops_per_sec']:>14,.1f}{result['peak_bytes_per_op']:>14,}{delta:>10}")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == '__main__':
+    main()
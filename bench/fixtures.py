@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# ==========================================================
+# FIXTURES PARA LOS BENCHMARKS: configuración y mensajes realistas
+# ==========================================================
+# Los nombres de distritos son reales (Lima Metropolitana, Callao y capitales de
+# provincia); la lista se completa con combinaciones frecuentes en el Perú
+# ("San ...", "Santa ...") hasta superar los cientos de entradas, como ocurriría
+# al ampliar la cobertura a todo el país.
+
+DISTRITOS_LIMA_COBERTURA = [
+    'Miraflores', 'San Isidro', 'Santiago de Surco', 'San Borja', 'Barranco', 'Surquillo', 'Lince',
+    'Jesús María', 'Magdalena del Mar', 'Pueblo Libre', 'San Miguel', 'La Molina', 'Breña',
+    'La Victoria', 'Lima', 'Rímac', 'San Luis', 'Ate', 'Santa Anita', 'El Agustino',
+    'Chorrillos', 'San Juan de Miraflores', 'Los Olivos', 'Independencia', 'San Martín de Porres',
+    'Comas', 'San Juan de Lurigancho',
+]
+
+DISTRITOS_LIMA_RESTO = [
+    'Villa El Salvador', 'Villa María del Triunfo', 'Carabayllo', 'Puente Piedra', 'Ancón',
+    'Santa Rosa', 'Lurigancho', 'Chaclacayo', 'Cieneguilla', 'Pachacámac', 'Lurín',
+    'Punta Hermosa', 'Punta Negra', 'San Bartolo', 'Santa María del Mar', 'Pucusana',
+    'Callao', 'Bellavista', 'Carmen de la Legua Reynoso', 'La Perla', 'La Punta', 'Ventanilla',
+    'Mi Perú',
+]
+
+DISTRITOS_PROVINCIAS = [
+    'Arequipa', 'Cayma', 'Cerro Colorado', 'Yanahuara', 'Paucarpata', 'Socabaya', 'Mariano Melgar',
+    'Miraflores de Arequipa', 'José Luis Bustamante y Rivero', 'Sachaca', 'Hunter', 'Tiabaya',
+    'Cusco', 'Wanchaq', 'San Sebastián', 'San Jerónimo', 'Santiago', 'Saylla', 'Poroy',
+    'Trujillo', 'Víctor Larco Herrera', 'La Esperanza', 'El Porvenir', 'Florencia de Mora',
+    'Huanchaco', 'Laredo', 'Moche', 'Salaverry', 'Chiclayo', 'José Leonardo Ortiz',
+    'La Victoria de Chiclayo', 'Pimentel', 'Lambayeque', 'Ferreñafe', 'Piura', 'Castilla',
+    'Veintiséis de Octubre', 'Sullana', 'Talara', 'Paita', 'Tumbes', 'Zorritos', 'Iquitos',
+    'Punchana', 'Belén', 'San Juan Bautista', 'Pucallpa', 'Yarinacocha', 'Manantay', 'Huancayo',
+    'El Tambo', 'Chilca', 'Jauja', 'Tarma', 'La Oroya', 'Huánuco', 'Amarilis', 'Pillco Marca',
+    'Tingo María', 'Cajamarca', 'Baños del Inca', 'Jaén', 'Chota', 'Ica', 'Parcona',
+    'La Tinguiña', 'Subtanjalla', 'Chincha Alta', 'Pisco', 'Nasca', 'Puno', 'Juliaca',
+    'Ilave', 'Tacna', 'Gregorio Albarracín Lanchipa', 'Ciudad Nueva', 'Alto de la Alianza',
+    'Moquegua', 'Ilo', 'Ayacucho', 'Carmen Alto', 'Jesús Nazareno', 'Huamanga', 'Huanta',
+    'Abancay', 'Andahuaylas', 'Huancavelica', 'Huaraz', 'Independencia de Huaraz', 'Chimbote',
+    'Nuevo Chimbote', 'Casma', 'Huacho', 'Huaral', 'Barranca', 'Cañete', 'San Vicente de Cañete',
+    'Chachapoyas', 'Bagua Grande', 'Moyobamba', 'Tarapoto', 'Morales', 'La Banda de Shilcayo',
+    'Puerto Maldonado', 'Tambopata', 'Cerro de Pasco', 'Yanacancha', 'Oxapampa',
+]
+
+_SANTOS = ['Pedro', 'Pablo', 'José', 'Juan', 'Antonio', 'Francisco', 'Marcos', 'Lucas', 'Mateo',
+           'Andrés', 'Felipe', 'Bartolomé', 'Tomás', 'Simón', 'Judas', 'Matías', 'Lorenzo',
+           'Agustín', 'Ignacio', 'Cristóbal', 'Martín', 'Nicolás', 'Rafael', 'Gabriel', 'Miguel']
+_SANTAS = ['Ana', 'Rosa', 'Lucía', 'Cruz', 'María', 'Catalina', 'Bárbara', 'Teresa', 'Inés',
+           'Clara', 'Isabel', 'Mónica', 'Cecilia', 'Eulalia']
+_LUGARES = ['de Quives', 'de Chuschi', 'del Mar', 'de Sacco', 'de Huayllay', 'de Ocros', 'de Cusi',
+            'de Lloc', 'de Tarma', 'de Pisac']
+
+DISTRITOS_GENERADOS = ([f'San {santo} {lugar}' for santo in _SANTOS for lugar in _LUGARES[:6]] +
+                       [f'Santa {santa} {lugar}' for santa in _SANTAS for lugar in _LUGARES[4:]])
+
+ABREVIATURAS = {
+    'sjl': 'San Juan de Lurigancho', 'sjm': 'San Juan de Miraflores', 'smp': 'San Martín de Porres',
+    'vmt': 'Villa María del Triunfo', 'ves': 'Villa El Salvador', 'surco': 'Santiago de Surco',
+    'magdalena': 'Magdalena del Mar', 'jesus maria': 'Jesús María', 'cercado': 'Lima',
+}
+
+FAQ_KEYWORD_MAP = {
+    'envio': ['envío', 'envio', 'delivery', 'despacho', 'mandan', 'envían', 'llega a', 'hacen envíos',
+              'cuánto demora', 'cuanto demora', 'tiempo de entrega', 'a provincia', 'shalom', 'olva',
+              'courier', 'recojo', 'agencia'],
+    'precio': ['precio', 'cuánto cuesta', 'cuanto cuesta', 'cuánto sale', 'cuanto sale', 'costo',
+               'valor', 'cuánto es', 'cuanto es', 'a cuánto', 'a cuanto', 'cuánto vale', 'cuanto vale',
+               'oferta', 'descuento', 'promoción', 'promo'],
+    'pago': ['yape', 'plin', 'tarjeta', 'transferencia', 'depósito', 'deposito', 'pago', 'pagar',
+             'contra entrega', 'contraentrega', 'efectivo', 'bcp', 'interbank', 'bbva', 'cuotas'],
+    'material': ['material', 'de qué es', 'de que es', 'acero', 'plata', 'oro', 'baño', 'quirúrgico',
+                 'quirurgico', 'hipoalergénico', 'hipoalergenico', 'se oxida', 'se pela', 'pierde color',
+                 'destiñe', 'alergia'],
+    'garantia': ['garantía', 'garantia', 'devolución', 'devolucion', 'cambio', 'reclamo', 'si no me gusta',
+                 'defecto', 'falla', 'roto', 'reembolso'],
+    'tienda': ['tienda física', 'tienda fisica', 'dirección', 'direccion', 'dónde están', 'donde estan',
+               'local', 'ubicación', 'ubicacion', 'puedo ir', 'showroom', 'recoger en tienda'],
+    'confianza': ['es seguro', 'confiable', 'estafa', 'ruc', 'empresa formal', 'factura', 'boleta',
+                  'referencias', 'testimonios', 'reseñas', 'opiniones'],
+    'magia': ['cambia de color', 'cómo funciona', 'como funciona', 'magia', 'energía', 'energia',
+              'temperatura', 'estado de ánimo', 'estado de animo', 'brilla'],
+    'empaque': ['empaque', 'caja', 'cajita', 'regalo', 'envoltura', 'bolsita', 'tarjeta de regalo',
+                'dedicatoria'],
+    'medidas': ['medida', 'tamaño', 'tamano', 'largo', 'cadena', 'centímetros', 'centimetros', 'grosor',
+                'peso', 'dije'],
+    'stock': ['stock', 'disponible', 'quedan', 'hay más', 'hay mas', 'agotado', 'unidades', 'colores',
+              'modelos', 'otros diseños'],
+    'horario': ['horario', 'a qué hora', 'a que hora', 'atienden', 'domingo', 'sábado', 'sabado',
+                'feriado', 'hoy mismo', 'mañana'],
+    'mayorista': ['por mayor', 'mayorista', 'al por mayor', 'docena', 'reventa', 'revender', 'distribuidor'],
+    'cuidados': ['cuidado', 'limpiar', 'mojar', 'ducha', 'mar', 'piscina', 'perfume', 'crema', 'guardar'],
+    'personalizado': ['personalizado', 'grabado', 'iniciales', 'nombre', 'fecha especial', 'a pedido'],
+}
+# Variantes con errores de tipeo frecuentes para llegar a cientos de palabras clave
+for _key, _keywords in list(FAQ_KEYWORD_MAP.items()):
+    FAQ_KEYWORD_MAP[_key] = _keywords + [kw.replace('s', 'z', 1) for kw in _keywords if 's' in kw] + \
+        [kw.replace('c', 'k', 1) for kw in _keywords if 'c' in kw]
+
+PALABRAS_CANCELACION = ['cancelar', 'cancela', 'ya no', 'no quiero', 'salir', 'detener', 'basta',
+                        'anular', 'olvídalo', 'olvidalo', 'stop']
+
+MENSAJES = [
+    'Hola!! buenas tardes 😊 quisiera info del collar',
+    'cuanto cuesta el collar magico?? y hacen envios a provincia',
+    'Soy de SJL, llega hasta alla?',
+    'vivo en san juan de miraflores',
+    'Estoy en miraflorez',
+    'es en surco cerca al jockey plaza',
+    'MAGDALENA',
+    'Jesus Maria',
+    'carabaylo',
+    'santa anita por la carretera central',
+    'Arequipa, Cayma',
+    'Trujillo - La Esperanza',
+    'cusco/wanchaq',
+    'de qué material es? se oxida con el agua de la ducha?',
+    'Aceptan yape o plin? o solo contra entrega',
+    'q tal, tienen tienda fisica? puedo ir a recoger',
+    'es seguro comprar? tienen RUC?',
+    'ya no gracias, cancelar',
+    'mmm déjame pensarlo 🤔',
+    'Sí, para mi mamá por su cumpleaños 🎂🎁 viene en cajita de regalo?',
+    'ok', 'Ok!!', 'si', 'no', 'gracias', '👍', '❤️❤️❤️',
+    'Ana Pérez, Jr. Gamarra 123, Depto 501. Al lado de la farmacia Inkafarma, frente al parque',
+    'Juan Quispe, 45678901, Av. Pardo 123, Miraflores. Agencia Shalom de la av. Arequipa',
+    'Buenas noches disculpe la hora, quería saber si el collar cambia de color de verdad o es foto editada '
+    'porque una vez compré algo parecido y a la semana se peló todo, además quiero saber cuánto demora a Piura',
+]
+
+def config_docs():
+    """Documentos de 'configuracion' tal como los publicaría load_config()."""
+    return {
+        'reglas_envio': {
+            'distritos_cobertura_delivery': DISTRITOS_LIMA_COBERTURA,
+            'distritos_lima_total': DISTRITOS_LIMA_COBERTURA + DISTRITOS_LIMA_RESTO + DISTRITOS_PROVINCIAS + DISTRITOS_GENERADOS,
+            'abreviaturas_distritos': ABREVIATURAS,
+            'adelanto_shalom': 20,
+            'adelanto_lima_delivery': 10,
+        },
+        'respuestas_faq': {key: f'Respuesta para {key}.' for key in FAQ_KEYWORD_MAP},
+        'configuracion_general': {
+            'palabras_cancelacion': PALABRAS_CANCELACION,
+            'faq_keyword_map': FAQ_KEYWORD_MAP,
+            'faq_prioridad': ['pago', 'precio', 'envio'],
+        },
+        'datos_negocio': {'ruc': '20600000001', 'titular_yape': 'Daaqui Joyas', 'yape_numero': '999999999'},
+    }
+
+def webhook_messages():
+    """Mensajes entrantes tal como llegan en el webhook (texto y respuestas de botón)."""
+    messages = [{'from': '51999999999', 'id': f'wamid.{idx}', 'type': 'text', 'text': {'body': body}}
+                for idx, body in enumerate(MENSAJES)]
+    for idx, button_id in enumerate(['es_regalo', 'si_coordinar', 'oferta', 'lima', 'si_correcto']):
+        messages.append({'from': '51999999999', 'id': f'wamid.b{idx}', 'type': 'interactive',
+                         'interactive': {'type': 'button_reply', 'button_reply': {'id': button_id, 'title': button_id}}})
+    messages.append({'from': '51999999999', 'id': 'wamid.audio', 'type': 'audio', 'audio': {'id': '1'}})
+    return messages
+
+# --- EMBUDO DE CONVERSACIÓN (para el almacenamiento local) ---
+CONVERSACION_CLIENTE = '51988888888'
+CONVERSACION_CONTACTOS = [{'wa_id': CONVERSACION_CLIENTE, 'profile': {'name': 'Ana'}}]
+CONVERSACION_CONFIG = {
+    'campañas_y_ofertas': {'anuncio_principal': {'frase_exacta': 'Hola, quiero el collar mágico', 'producto_id': 'collar-magico'}},
+}
+PRODUCTOS = {
+    'collar-magico': {
+        'nombre': 'Collar Mágico Girasol', 'precio_base': 69, 'precio_oferta': 59,
+        'imagenes': {'principal': 'https://example.com/collar.jpg'},
+        'detalles': {'material': 'Acero quirúrgico', 'presentacion': 'Caja de regalo'},
+    },
+}
+
+def conversation_messages(run):
+    """Embudo de un cliente: anuncio, botones, una pregunta frecuente y la cancelación que reinicia la sesión."""
+    steps = [('text', 'Hola, quiero el collar mágico'), ('button', 'es_regalo'), ('button', 'si_coordinar'),
+             ('text', 'cuánto demora a Piura'), ('button', 'continuar'), ('text', 'cancelar')]
+    messages = []
+    for idx, (kind, value) in enumerate(steps):
+        message = {'from': CONVERSACION_CLIENTE, 'id': f'wamid.flow.{run}.{idx}'}
+        if kind == 'text':
+            message.update(type='text', text={'body': value})
+        else:
+            message.update(type='interactive', interactive={'type': 'button_reply', 'button_reply': {'id': value, 'title': value}})
+        messages.append(message)
+    return messages